@@ -21,7 +21,7 @@ import sys
 
 import geojson
 from codetiming import Timer
-from cpuinfo import get_cpu_info
+from osm_merge.lazyload import cpuCount
 from geojson import Feature, FeatureCollection, Polygon
 
 # from osm_merge.geosupport import GeoSupport
@@ -34,8 +34,7 @@ from shapely.geometry import Polygon, shape
 log = logging.getLogger(__name__)
 
 # The number of threads is based on the CPU cores
-info = get_cpu_info()
-cores = info["count"]
+cores = cpuCount()
 
 
 class ConflateBuildings(object):
@@ -35,7 +35,7 @@ from osm_merge.convert import escape
 from osm_rawdata.postgres import uriParser, DatabaseAccess, PostgresClient
 from codetiming import Timer
 import concurrent.futures
-from cpuinfo import get_cpu_info
+from osm_merge.lazyload import cpuCount
 from time import sleep
 from haversine import haversine, Unit
 from thefuzz import fuzz, process
@@ -46,8 +46,7 @@ from geosupport import GeoSupport
 log = logging.getLogger("conflator")
 
 # The number of threads is based on the CPU cores
-info = get_cpu_info()
-cores = info['count']
+cores = cpuCount()
 
 
 class ConflatePOI(object):
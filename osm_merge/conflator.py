@@ -29,36 +29,43 @@ from shapely.ops import transform, nearest_points, linemerge
 from shapely import wkt
 from progress.bar import Bar, PixelBar
 from progress.spinner import PixelSpinner
-import pyproj
-import asyncio
 from codetiming import Timer
 import concurrent.futures
-from cpuinfo import get_cpu_info
-from time import sleep
-from haversine import haversine, Unit
+import json
+import hashlib
+from functools import lru_cache
+from osm_merge.lazyload import cpuCount, lazyImport
+from time import sleep, perf_counter
 from thefuzz import fuzz, process
+import rapidfuzz
 from pathlib import Path
-from osm_merge.fieldwork.parsers import ODKParsers
 from osm_merge.osmfile import OsmFile
+from osm_merge.yamlfile import YamlFile
+from osm_merge.sinks import GeoJsonSink, GeoJsonSeqSink, OsmSink, PbfSink, OsmChangeSink
+from osm_merge.featurestore import FeatureStore, StoredFeature
+from osm_merge.profiler import startProfile
+import osm_merge as om
 from pathlib import Path
 # from spellchecker import SpellChecker
 # from osm_rawdata.pgasync import PostgresClient
-from tqdm import tqdm
-import tqdm.asyncio
-import xmltodict
+import tqdm
 from numpy import arccos, array
 from numpy.linalg import norm
 import math
 import numpy
+# These are only loaded when they're used, so the program starts faster
+pyproj = lazyImport("pyproj")
+parsers = lazyImport("osm_merge.fieldwork.parsers")
 
 # Instantiate logger
 log = logging.getLogger(__name__)
 
+rootdir = om.__path__[0]
+
 # The number of threads is based on the CPU cores
-info = get_cpu_info()
 # Try doubling the number of cores, since the CPU load is
 # still reasonable.
-cores = info['count']
+cores = cpuCount()
 
 # shut off warnings from pyproj
 import warnings
@@ -66,6 +73,374 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 # Shapely.distance doesn't like duplicate points
 warnings.simplefilter(action='ignore', category=RuntimeWarning)
 
+# Creating a pyproj Transformer is slow, so only one is made and
+# shared by everything that needs it.
+transformer = None
+
+# Change this when the format of the cached features changes, so the
+# old caches aren't used.
+CACHEVERSION = 1
+
+def getTransformer() -> "pyproj.Transformer":
+    """
+    Get the Transformer used to convert geometries so the results are
+    in meters instead of degrees of the earth's radius.
+
+    Returns:
+        (pyproj.Transformer): The EPSG:4326 to EPSG:3857 transformer
+    """
+    global transformer
+    if transformer is None:
+        transformer = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+    return transformer
+
+def shareFeatures(features: list) -> tuple:
+    """
+    Put the features in a FeatureStore in shared memory, so the worker
+    processes can all use them without each one getting a copy. The
+    coordinates are projected first, so the workers don't have to
+    project them again.
+
+    Args:
+        features (list): The features to share, or a FeatureStore
+
+    Returns:
+        (SharedMemory): The shared memory block, which the caller has to unlink
+        (dict): The layout of the store, for attachFeatures()
+    """
+    if isinstance(features, FeatureStore):
+        store = features
+    else:
+        store = FeatureStore.fromFeatures(features)
+    store.project(getTransformer())
+    return store.share()
+
+def attachFeatures(name: str,
+                   layout: dict,
+                   ) -> tuple:
+    """
+    Attach to a block of shared memory made by shareFeatures(). The
+    arrays are used in place, and each feature is only made when
+    it's used.
+
+    Args:
+        name (str): The name of the shared memory block
+        layout (dict): The layout of the store from shareFeatures()
+
+    Returns:
+        (SharedMemory): The shared memory block, which has to stay open
+        (FeatureStore): The features
+    """
+    return FeatureStore.attach(name, layout)
+
+@lru_cache(maxsize=None)
+def splitRef(ref: str) -> tuple:
+    """
+    Split a reference like "FR 123.4" into the prefix and the
+    number. The same refs get compared many times, so this is
+    cached.
+
+    Args:
+        ref (str): The reference to split
+
+    Returns:
+        (str): The prefix in upper case
+        (str): The number in upper case
+    """
+    tmp = ref.split(' ')
+    if len(tmp) < 2:
+        # A ref like "12" has no prefix, so it's all the number
+        return str(), ref.upper()
+    return tmp[0].upper(), tmp[1].upper()
+
+@lru_cache(maxsize=None)
+def normalizeRefs(ref: str) -> tuple:
+    """
+    Normalize a ref tag value so the same reference always matches,
+    whatever the capitalization or spacing. The USFS uses both FS and
+    FR as the prefix, so those are the same. The value may also have
+    multiple references separated by a semi-colon.
+
+    Args:
+        ref (str): The value of the ref tag
+
+    Returns:
+        (tuple): The normalized references
+    """
+    refs = list()
+    for value in str(ref).split(';'):
+        tmp = value.upper().split()
+        if len(tmp) == 0:
+            continue
+        if tmp[0] == "FS":
+            tmp[0] = "FR"
+        refs.append(' '.join(tmp))
+    return tuple(refs)
+
+def getRefs(feature: Feature) -> set:
+    """
+    Get all the normalized references of a feature.
+
+    Args:
+        feature (Feature): The feature to get the references of
+
+    Returns:
+        (set): The normalized values of the ref and ref:usfs tags
+    """
+    refs = set()
+    for key in ("ref", "ref:usfs"):
+        value = feature["properties"].get(key)
+        if value:
+            refs.update(normalizeRefs(value))
+    return refs
+
+# The abbreviations used in the external datasets, which get loaded
+# from the same config file the mvum utility uses.
+abbreviations = None
+
+def getAbbreviations() -> dict:
+    """
+    Get the table of abbreviations to expand in names.
+
+    Returns:
+        (dict): The abbreviations and what they expand to
+    """
+    global abbreviations
+    if abbreviations is None:
+        filespec = f"{rootdir}/utilities/mvum.yaml"
+        try:
+            abbreviations = YamlFile(filespec).getEntries()["abbreviations"]
+        except Exception as e:
+            log.error(f"Couldn't load the abbreviations from {filespec}: {e}")
+            abbreviations = dict()
+    return abbreviations
+
+@lru_cache(maxsize=None)
+def normalizeName(value: str) -> str:
+    """
+    Normalize a name or ref so it only has to be done once for each
+    value instead of for every pair of features that get compared.
+
+    Args:
+        value (str): The value of the tag
+
+    Returns:
+        (str): The lower-cased value
+    """
+    return value.lower()
+
+@lru_cache(maxsize=None)
+def expandName(value: str) -> str:
+    """
+    Expand all the abbreviations in a name, so "Bear Crk Rd" and
+    "Bear Creek Road" are the same.
+
+    Args:
+        value (str): The value of the tag
+
+    Returns:
+        (str): The lower-cased value with the abbreviations expanded
+    """
+    table = getAbbreviations()
+    words = [table.get(word, word) for word in value.title().split()]
+    return ' '.join(words).lower()
+
+@lru_cache(maxsize=65536)
+def nameRatio(value1: str,
+              value2: str,
+              ) -> int:
+    """
+    Get the fuzzy match ratio of two normalized values. This is the
+    same as thefuzz's ratio(), but many highways have the same name
+    or ref, so most of them are already cached.
+
+    Args:
+        value1 (str): The normalized value from the external dataset
+        value2 (str): The normalized value from the secondary dataset
+
+    Returns:
+        (int): The ratio between 0 and 100
+    """
+    return fuzz.ratio(value1, value2)
+
+# The cumulative time and number of calls of each stage, and counters
+# of what happened to the candidates. Each process has it's own, and
+# the ones from the worker processes get merged into the main one.
+report = {"timers": dict(), "counters": dict()}
+
+# The stages that are running, the innermost one last
+running = list()
+
+class StageTimer(object):
+    """
+    Add the time spent in a block of code to the report. A stage that
+    runs inside another one pauses it, so the time is only added to
+    the innermost stage, and the stages add up to the total.
+    """
+
+    def __init__(self,
+                 name: str,
+                 ):
+        """
+        Args:
+            name (str): The name of the stage
+
+        Returns:
+            (StageTimer): An instance of this object
+        """
+        self.name = name
+        self.start = 0.0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        now = perf_counter()
+        if len(running) > 0:
+            outer = running[-1]
+            outer.seconds += now - outer.start
+        running.append(self)
+        self.seconds = 0.0
+        self.start = now
+        return self
+
+    def __exit__(self, *args):
+        now = perf_counter()
+        self.seconds += now - self.start
+        running.remove(self)
+        if len(running) > 0:
+            running[-1].start = now
+        timer = report["timers"].get(self.name)
+        if timer is None:
+            timer = {"seconds": 0.0, "calls": 0}
+            report["timers"][self.name] = timer
+        timer["seconds"] += self.seconds
+        timer["calls"] += 1
+
+def countEvent(name: str,
+               value: int = 1,
+               ):
+    """
+    Add to one of the counters in the report.
+
+    Args:
+        name (str): The name of the counter
+        value (int): The amount to add
+    """
+    report["counters"][name] = report["counters"].get(name, 0) + value
+
+def getReport(reset: bool = False) -> dict:
+    """
+    Get the timers and counters for this process.
+
+    Args:
+        reset (bool): Whether to start over after getting them
+
+    Returns:
+        (dict): The timers and counters
+    """
+    global report
+    result = report
+    if reset:
+        report = {"timers": dict(), "counters": dict()}
+    return result
+
+def mergeReport(other: dict):
+    """
+    Add the timers and counters from another process to this one.
+
+    Args:
+        other (dict): The report from the other process
+    """
+    for name, timer in other["timers"].items():
+        mine = report["timers"].get(name)
+        if mine is None:
+            mine = {"seconds": 0.0, "calls": 0}
+            report["timers"][name] = mine
+        mine["seconds"] += timer["seconds"]
+        mine["calls"] += timer["calls"]
+    for name, value in other["counters"].items():
+        countEvent(name, value)
+
+def writeReport(filespec: str):
+    """
+    Write the timers and counters to a JSON file.
+
+    Args:
+        filespec (str): The output file name
+    """
+    with open(filespec, "w") as file:
+        json.dump(report, file, indent=4, sort_keys=True)
+    log.info(f"Wrote {filespec}")
+
+# Each worker process attaches to the shared secondary dataset once,
+# and keeps it along with the spatial index for all the chunks it
+# conflates.
+worker = dict()
+
+def initWorker(name: str,
+               layout: dict,
+               ):
+    """
+    Initialize a worker process for conflateData().
+
+    Args:
+        name (str): The name of the shared memory block with the secondary dataset
+        layout (dict): The layout of the shared secondary dataset
+    """
+    shm, features = attachFeatures(name, layout)
+    cutils = Conflator()
+    # The projected coordinates are shared too, so this only makes
+    # the spatial index from the bounding boxes.
+    cutils.makeIndex(features)
+    worker["shm"] = shm
+    worker["secondary"] = features
+    worker["cutils"] = cutils
+
+def conflateChunk(primary: list,
+                  informal: bool = False,
+                  threshold: float = 7.0,
+                  refdistance: float = 0.0,
+                  ) -> list:
+    """
+    Conflate a chunk of the primary dataset in a worker process
+    against the shared secondary dataset.
+
+    Args:
+        primary (list): The chunk of the external dataset to conflate
+        informal (bool): Whether to dump features in OSM not in external data
+        threshold (float): Threshold for distance calculations
+        refdistance (float): If set, features with the same ref within this distance are matched first
+
+    Returns:
+        (list):  The conflated output
+        (dict): The timers and counters from this chunk
+    """
+    result = conflateThread(primary, worker["secondary"], informal, threshold,
+                            refdistance=refdistance, cutils=worker["cutils"])
+    return result, getReport(True)
+
+def conflateTile(primary: list,
+                 secondary: list,
+                 informal: bool = False,
+                 threshold: float = 7.0,
+                 refdistance: float = 0.0,
+                 ) -> list:
+    """
+    Conflate a tile in a worker process.
+
+    Args:
+        primary (list): The primary features in the tile
+        secondary (list): The secondary features in the tile and it's halo
+        informal (bool): Whether to dump features in OSM not in external data
+        threshold (float): Threshold for distance calculations
+        refdistance (float): If set, features with the same ref within this distance are matched first
+
+    Returns:
+        (list):  The conflated output
+        (dict): The timers and counters from this tile
+    """
+    result = conflateThread(primary, secondary, informal, threshold, refdistance=refdistance)
+    return result, getReport(True)
+
 # # A function that returns the 'year' value:
 # def distSort(data: list):
 #     """
@@ -88,14 +463,162 @@ warnings.simplefilter(action='ignore', category=RuntimeWarning)
 #     """
 #     return data['angle']
 
+def hashFile(filespec: str) -> str:
+    """
+    Get the hash of a file, to see if it's changed.
+
+    Args:
+        filespec (str): The file to hash
+
+    Returns:
+        (str): The SHA256 hash of the file
+    """
+    sha = hashlib.sha256()
+    with open(filespec, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def hashFeature(feature: Feature) -> str:
+    """
+    Get a hash of the geometry and tags of a feature, to see if it's
+    changed since the last time it was conflated.
+
+    Args:
+        feature (Feature): The feature to hash
+
+    Returns:
+        (str): The SHA1 hash of the feature
+    """
+    sha = hashlib.sha1()
+    if feature["geometry"] is not None:
+        sha.update(shapely.to_wkb(shape(feature["geometry"])))
+    sha.update(json.dumps(feature["properties"], sort_keys=True, default=str).encode("utf-8"))
+    return sha.hexdigest()
+
+def writeFeature(sinks: list,
+                 output: int,
+                 feature: Feature,
+                 ):
+    """
+    Write a conflated feature to all the sinks for it's output.
+
+    Args:
+        sinks (list): The sinks for the features in the secondary dataset, and for the new ones
+        output (int): 0 for features that are in the secondary dataset, 1 for new ones
+        feature (Feature): The conflated feature
+    """
+    with StageTimer("write"):
+        for sink in sinks[output]:
+            sink.write(feature)
+
+def writeFeatures(sinks: list,
+                  output: int,
+                  features: list,
+                  workers: int = None,
+                  ):
+    """
+    Write a list of conflated features to all the sinks for it's
+    output. The sinks that can convert the features in other
+    processes do that.
+
+    Args:
+        sinks (list): The sinks for the features in the secondary dataset, and for the new ones
+        output (int): 0 for features that are in the secondary dataset, 1 for new ones
+        features (list): The conflated features
+        workers (int): The number of worker processes, all the cores by default
+    """
+    with StageTimer("write"):
+        for sink in sinks[output]:
+            sink.writeAll(features, workers)
+
+def readyResults(results: dict,
+                 order: list,
+                 ):
+    """
+    Get the results that are ready, in the same order as the primary
+    dataset. A result that finishes early waits for all the ones
+    before it. Each result is dropped once it's returned.
+
+    Args:
+        results (dict): The conflated output of each block that is done
+        order (list): The blocks not returned yet, in order
+
+    Returns:
+        (list): The conflated output of each block, as it's ready
+    """
+    while len(order) > 0 and order[0] in results:
+        yield results.pop(order.pop(0))
+
+def flushResults(results: dict,
+                 order: list,
+                 sinks: list,
+                 workers: int = None,
+                 ):
+    """
+    Write the results that are ready to the sinks, in the same order as
+    the primary dataset. A result that finishes early waits for all
+    the ones before it.
+
+    Args:
+        results (dict): The conflated output of each block that is done
+        order (list): The blocks not written yet, in order
+        sinks (list): The sinks for the features in the secondary dataset, and for the new ones
+        workers (int): The number of worker processes, all the cores by default
+    """
+    for result in readyResults(results, order):
+        for output in (0, 1):
+            writeFeatures(sinks, output, result[output], workers)
+
 def conflateThread(primary: list,
                    secondary: list,
                    informal: bool = False,
                    threshold: float = 7.0,
                    spellcheck: bool = True,
+                   refdistance: float = 0.0,
+                   cutils: "Conflator" = None,
+                   angle_threshold: float = 17.0,
+                   slope_threshold: float = 4.0,
+                   match_threshold: int = 80,
+                   table: list = None,
                    ) -> list:
     """
-    Conflate features from ODK against all the features in OSM.
+    Conflate features from ODK against all the features in OSM, and
+    collect all the results. See conflateFeatures() for the arguments.
+
+    Returns:
+        (list):  The conflated output
+    """
+    data = list()
+    newdata = list()
+    for output, feature, position in conflateFeatures(primary, secondary, informal, threshold, spellcheck,
+                                                      refdistance, cutils, angle_threshold, slope_threshold,
+                                                      match_threshold, table):
+        if output == 0:
+            data.append(feature)
+        else:
+            newdata.append(feature)
+
+    # log.debug(f"OLD: {len(data)}")
+    # log.debug(f"NEW: {len(newdata)}")
+    return [data, newdata]
+
+def conflateFeatures(primary: list,
+                     secondary: list,
+                     informal: bool = False,
+                     threshold: float = 7.0,
+                     spellcheck: bool = True,
+                     refdistance: float = 0.0,
+                     cutils: "Conflator" = None,
+                     angle_threshold: float = 17.0,
+                     slope_threshold: float = 4.0,
+                     match_threshold: int = 80,
+                     table: list = None,
+                     ):
+    """
+    Conflate features from ODK against all the features in OSM. The
+    results are yielded as soon as each primary feature is done, so
+    they can be written out without keeping them all in memory.
 
     Args:
         primary (list): The external dataset to conflate
@@ -103,9 +626,17 @@ def conflateThread(primary: list,
         threshold (int): Threshold for distance calculations
         informal (bool): Whether to dump features in OSM not in external data
         spellcheck (bool): Whether to also spell check string values
+        refdistance (float): If set, features with the same ref within this distance are matched first
+        cutils (Conflator): The instance that parsed the data, to reuse the projected geometries
+        angle_threshold (float): The maximum angle between two lines
+        slope_threshold (float): The maximum slope between two lines
+        match_threshold (int): The ratio for name and ref matching
+        table (list): The scores from Conflator.scorePairs(), instead of computing them
 
     Returns:
-        (list):  The conflated output
+        (int): 0 for features that are in the secondary dataset, 1 for new ones
+        (Feature): The conflated feature
+        (int): The position of the primary feature it came from
     """
     # log.debug(f"Dispatching thread ")
 
@@ -119,123 +650,119 @@ def conflateThread(primary: list,
     # we're standing in front of an amenity and recording that location
     # instead of in the building.
     # gps_accuracy = 10
-    # this is the treshold for fuzzy string matching
-    match_threshold = 80
-    data = list()
-    newdata = list()
     # New features not in OSM always use negative IDs
     odkid = -100
     osmid = 0
     nodes = dict()
     version = 0
 
-    cutils = Conflator()
+    if cutils is None:
+        cutils = Conflator()
     i = 0
 
     log.info(f"The primary dataset has {len(primary)} entries")
     log.info(f"The secondary dataset has {len(secondary)} entries")
-    
+
+    # When the scores are already in the table, the geometries
+    # aren't needed anymore.
+    if table is None:
+        # Each feature only gets projected once, and this does nothing
+        # for features that were projected when the file was parsed.
+        cutils.projectFeatures(primary)
+        cutils.projectFeatures(secondary)
+
+        # Load the secondary dataset into a spatial index once, so each
+        # primary feature only gets compared with the features near it
+        # instead of the entire dataset.
+        cutils.makeIndex(secondary)
+
     # Progress bar
     pbar = tqdm.tqdm(primary)
     for entry in pbar:
         # for entry in primary:
         i += 1
+        # The features are only output when the primary feature is
+        # done, since they all share it's tags.
+        data = list()
+        newdata = list()
         # timer.start()
         confidence = 0
         maybe = list()
         # If an OSM file is the primary, ignore the nodes that comprise the
         # LineString.
         # log.debug(f"ENTRY: {entry["properties"]}")
-        if entry["geometry"]["type"] == "Point":
+        if entry["geometry"] is None or entry["geometry"]["type"] == "Point":
             continue
 
         # print(f"PRIMARY: {entry["properties"]}")
-        for existing in secondary:
-            # FIXME: debug
-            if existing["geometry"]["type"] == "Point":
-                continue
-            if "id" in existing["properties"]:
-                foo = f'ID: {existing["properties"]["id"]}, '
-            else:
-                foo = str()
-            if "name" in existing["properties"]:
-                foo += f'name: {existing["properties"]["name"]}, '
-            if "highway" in existing["properties"]:
-                foo += f'highway: {existing["properties"]["highway"]}, '
-            if "ref" in existing["properties"]:
-                foo += f'ref: {existing["properties"]["ref"]}, '
-            if len(foo) < 0:
-                print(f"\tSECONDARY: {foo}")
-            feature = dict()
-            newtags = dict()
-            # log.debug(f"EXISTING: {existing["properties"]}")
-            if existing["geometry"] is not None:
-                if existing["geometry"]["type"] == "Point":
-                    # data.append(existing)
-                    continue
-            geom = None
-            # We could probably do this using GeoPandas or gdal, but that's
-            # going to do the same brute force thing anyway.
-
-            # If the input file is in OSM XML format, we don't want to
-            # conflate the nodes with no tags. They are used to build
-            # the geometry for the way, and after that aren't needed anymore.
-            # If the node has tags, then it's a POI, which we do conflate.
-            # log.debug(entry)
-            if entry["geometry"] is None or existing["geometry"] is None:
-                # Obviously can't do a distance comparison is a geometry is missing
-                continue
-            if entry["geometry"]["type"] == "Point": #  and len(entry["properties"]) <= 2:
-                continue
-            if existing["geometry"]["type"] == "Point": # and len(existing["properties"]) <= 2:
-                continue
-            # FIXME: some LineStrings are only two points, there two refs,
-            # but only one set of coordinates.
-            if existing["geometry"]["type"] == "LineString" and len(existing["geometry"]["coordinates"]) <= 1:
-                continue
-
+        # If the input file is in OSM XML format, we don't want to
+        # conflate the nodes with no tags. They are used to build
+        # the geometry for the way, and after that aren't needed anymore.
+        # The spatial index only contains features that can be conflated.
+        # If the ref matches a nearby feature exactly, it's already
+        # resolved, so there's no need for any of the fuzzy matching.
+        if table is not None:
+            byref = table[i - 1]["byref"]
+            candidates = table[i - 1]["candidates"]
+            scores = table[i - 1]["scores"]
+            ratios = table[i - 1]["ratios"]
+        else:
+            byref = False
+            if refdistance > 0:
+                candidates, scores = cutils.matchRefs(entry, refdistance)
+                byref = len(candidates) > 0
+                countEvent("matched by ref", len(candidates))
+            if not byref:
+                candidates = cutils.queryIndex(entry, threshold)
+                # Score all the candidates at once instead of one at a time.
+                scores = cutils.scoreCandidates(entry, candidates)
+            ratios = cutils.scoreTags(entry, candidates)
+        # Features with the same ref can be further away
+        limit = refdistance if byref else threshold
+        countEvent("primary features")
+        countEvent("candidates examined", len(candidates))
+        for index, existing in enumerate(candidates):
             angle = 0.0
             dist = float()
             slope = float()
             hits = 0
-            angle_threshold = 17.0 # 20.0 # the angle between two lines
-            slope_threshold = 4.0 # the slope between two lines
-            match_threshold = 80 # the ratio for name and ref matching
             name1 = None
             name2 = None
             match = False
-            try:
-                dist = cutils.getDistance(entry, existing)
-            except:
+            found = False
+            if scores["error"][index]:
+                countEvent("rejected by error")
                 log.error(f"getDistance() just had a weird error")
                 log.error(f"ENTRY: {entry}")
                 log.error(f"EXISTING: {existing}")
-                breakpoint()
                 continue
+            dist = scores["dist"][index]
 
             # This is only returned when the difference in linestring
             # length is large, which often means the OSM highway doesn't
             # exist in the external dataset.
             if dist < 0:
+                countEvent("rejected by length difference")
                 continue
             # log.debug(f"ENTRY: {dist}: {entry["properties"]}")
             # log.debug(f"EXISTING: {existing["properties"]}")
-            if abs(dist) >= threshold:
+            if abs(dist) >= limit:
+                countEvent("rejected by distance")
                 continue
             else:
                 # print("------------------------------------------------------")
                 if "id" not in existing["properties"]:
                     existing["properties"]["id"] = -1
-                try:
-                    slope, angle = cutils.getSlope(entry, existing)
-                except:
+                if not scores["valid"][index]:
+                    countEvent("rejected by error")
                     log.error(f"getSlope() just had a weird error")
                     print(f"\tENTRY: {entry["properties"]}")
                     print(f"\tEXISTING: {existing["properties"]}")
-                    # breakpoint()
-                    # slope, angle = cutils.getSlope(entry, existing)
                     continue
+                slope = scores["slope"][index]
+                angle = scores["angle"][index]
                 if abs(angle) > angle_threshold or abs(slope) > slope_threshold:
+                    countEvent("rejected by angle")
                     # print(f"\tOut of range: {slope} : {angle}")
                     # print(f"PRIMARY: {entry["properties"]}")
                     # print(f"SECONDARY: {existing["properties"]}")
@@ -243,7 +770,11 @@ def conflateThread(primary: list,
                 # log.debug(f"DIST: {dist}, ANGLE: {angle}, SLOPE: {slope}")
                 # log.debug(f"PRIMARY: {entry["properties"]}")
                 # log.debug(f"SECONDARY: {existing["properties"]}")
-                hits, tags = cutils.checkTags(entry, existing)
+                hits, tags = cutils.checkTags(entry, existing, ratios[index], match_threshold)
+                if byref:
+                    # The exact ref match is at least one hit, even if the
+                    # fuzzy match of the ref:usfs tag didn't count it.
+                    hits = max(hits, 1)
                 tags["debug"] = f"hits: {hits}, dist: {str(dist)[:7]}, slope: {str(slope)[:7]}, angle: {str(angle)[:7]}"
                 if "name" in existing["properties"]:
                     name2 = existing["properties"]["name"]
@@ -272,24 +803,24 @@ def conflateThread(primary: list,
                         # print(f"\tENTRY1: {entry["properties"]}")
                         # print(f"\tEXISTING1: {existing["properties"]}")
                         # maybe = list()
-                        break
+                        found = True
                 elif hits == 2 and dist == 0.0:
                     log.debug(f"\tName and ref matched, geom close")
                     # print(f"\tENTRY1: {entry["properties"]}")
                     # print(f"\tEXISTING1: {existing["properties"]}")
                     # hits = 0
                     maybe = list()
-                    break
+                    found = True
                 elif hits == 1 and dist <= 2.0:
                     if tags["name_ratio"] == 0 and tags["ref_ratio"] >= match_threshold:
                         log.debug(f"Ref matched, no name in data, geom close")
                         # breakpoint()
                         if "name" not in tags:
-                            break
+                            found = True
                     elif (tags["name_ratio"] >= match_threshold and tags["ref_ratio"] == 0):
                         log.debug(f"Name matched, no ref in data, geom close")
                         if "ref:usfs" not in tags:
-                            break
+                            found = True
                 elif hits == 0 and dist == 0.0:
                     log.debug(f"\tGeometry was close, OSM was probably lacking the name")
                     # print(f"\tENTRY2: {entry["properties"]}")
@@ -302,28 +833,29 @@ def conflateThread(primary: list,
                     # print(f"\tEXISTING4: {existing["properties"]}")
                     maybe = list()
                     hits = 0
-                    break
+                    found = True
                 elif hits == 1 and tags["name_ratio"] >= match_threshold:
                     if tags["name_ratio"] == 0 and tags["ref_ratio"] > 80:
                         log.debug(f"\tClose geometry match, ref match")
                         if not "name" in tags:
-                            break
+                            found = True
                     elif tags["name_ratio"] > 0 and tags["ref_ratio"] == 0:
                         log.debug(f"\tClose geometry match, name match, not ref")
                         if not "name" in tags:
-                            break
+                            found = True
                     else:
                         log.error(f"Name and ref don't match!")
                     # print(f"\tENTRY5: {entry["properties"]}")
                     # print(f"\tEXISTING5: {existing["properties"]}")
-                    hits += 1
+                    if not found:
+                        hits += 1
                 elif hits == 2:
                     if tags["name_ratio"] == match_threshold and tags["ref_ratio"] >= match_threshold:
                         log.debug(f"\tName matched and ref matched")
                         # print(f"\tENTRY6: {entry["properties"]}")
                         # print(f"\tEXISTING6: {existing["properties"]}")
                     hits += 1
-                    break
+                    found = True
                 elif hits == 0 and dist == 0.0:
                     log.debug(f"\tGeometry matched, no name or ref in OSM")
                     print(f"\tENTRY7: {entry["properties"]}")
@@ -335,6 +867,13 @@ def conflateThread(primary: list,
                     # print(f"\tEXISTING8: {existing["properties"]}")
                     hits += 1
 
+                # Only count the candidate once the number of hits is final
+                if found or hits > 0:
+                    countEvent(f"accepted with {hits} hits")
+                else:
+                    countEvent("rejected by tags")
+                if found:
+                    break
                 if hits > 0:
                     maybe.append({"hits": hits, "dist": dist, "angle": angle, "slope": slope, "name_ratio": tags["name_ratio"], "match": match, "ref_ratio": tags["ref_ratio"], "osm": existing})
                     # data.append(Feature(geometry=geom, properties=tags))
@@ -353,92 +892,93 @@ def conflateThread(primary: list,
                     log.debug(f"Have enough matches.")
                     break
 
-        # log.debug(f"MAYBE: {len(maybe)}")
-        if len(maybe) > 0:
-            # cache the refs to use in the OSM XML output file
-            refs = list()
-            # odk = dict()
-            # osm = dict()
-            slope = float()
-            angle = float()
-            dist = float()
-            # There are two parameters used to decide on the probably
-            # match. If we have at least 2 hits, it's very likely a
-            # good match, 3 is a perfect match.
-            best = None
-
-            # maybe.sort(key=distSort)
-            # maybe.sort(key=angleSort)
-            # maybe.sort(key=hitsSort)
-            best = 0
-            ratio = 0
-            closest = None
-            hits = 0
-            # Sometimes all the maybes are segments of the same highway.
-            for segment in maybe:
-                # FIXME: this is a test to see if adding the ratios, along with
-                # distance can find the best match in the maype list.
-                ratio =  segment["name_ratio"] + segment["ref_ratio"]
-                # if "name" in segment:
-                #     if segment["name"] == "Lost Man Trailhead Road":
-                #         breakpoint()
-                # print(f"RATIO: {ratio} - {segment["match"]}")
-                # It was a solid match, so doesn't go in any output files
-                if segment["hits"] >= hits:
-                    hits = segment["hits"]
-                    closest = segment
-                props = closest["osm"]["properties"]
-                tags = entry["properties"]
-                if "refs" in props:
-                    tags["refs"] = props["refs"]
-                if "osm_id" in props:
-                    tags["id"] = props["osm_id"]
-                elif "id" in props:
-                    tags["id"] =  props["id"]
-                if "version" in props:
-                    tags["version"] = props["version"]
-                else:
-                    tags["version"] = 1
-                if "name_ration" in segment:
-                    tags["name_ratio"] = segment["name_ratio"]
-                if "ref_ration" in segment:
-                    tags["ref_ratio"] = segment["ref_ratio"]
-
-                tags["debug"] = f"hits: {hits}, dist: {str(closest["dist"])[:7]}, slope: {str(closest["slope"])[:7]}, angle: {str(closest["angle"])[:7]}"
-                geom = shape(closest["osm"]["geometry"])
-                pname = str()
-                if "name" in entry["properties"]:
-                    pname = entry["properties"]["name"]
-                sname = str()
-                if "name" in props:
-                    sname = props["name"]
-                # print(f"ADDING: {pname} == {sname} dist: {str(closest["dist"])[:7]}, name: {closest["name_ratio"]}, ref: {closest["ref_ratio"]}, hits: {closest["hits"]}")
-                # if segment["hits"] == 1:
-                #     breakpoint()
-                # if hits >= 1:
-                data.append(Feature(geometry=geom, properties=tags))
-                # else:
-                #     data.append(Feature(geometry=segment["geometry"], properties=tags))
-
-            # data.append(Feature(geometry=geom, properties=tags))
-            # If no hits, it's new data. ODK data is always just a POI for now
-            if hits == 0 and dist <= threshold:
-                entry["properties"]["version"] = 1
-                entry["properties"]["informal"] = "yes"
-                entry["properties"]["fixme"] = "New features should be imported following OSM guidelines."
-                entry["properties"]["debug"] = f"hits: {hits}, dist: {str(dist)[:7]}"
-            entry["properties"]["slope"] = slope
-            entry["properties"]["angle"] = angle
-            # entry["properties"]["dist"] = dist
-            # log.debug(f"FOO({dist}): {entry}")
-            newdata.append(entry)
-
+        with StageTimer("output"):
+            # log.debug(f"MAYBE: {len(maybe)}")
+            if len(maybe) > 0:
+                # cache the refs to use in the OSM XML output file
+                refs = list()
+                # odk = dict()
+                # osm = dict()
+                slope = float()
+                angle = float()
+                dist = float()
+                # There are two parameters used to decide on the probably
+                # match. If we have at least 2 hits, it's very likely a
+                # good match, 3 is a perfect match.
+                best = None
+
+                # maybe.sort(key=distSort)
+                # maybe.sort(key=angleSort)
+                # maybe.sort(key=hitsSort)
+                best = 0
+                ratio = 0
+                closest = None
+                hits = 0
+                # Sometimes all the maybes are segments of the same highway.
+                for segment in maybe:
+                    # FIXME: this is a test to see if adding the ratios, along with
+                    # distance can find the best match in the maype list.
+                    ratio =  segment["name_ratio"] + segment["ref_ratio"]
+                    # if "name" in segment:
+                    #     if segment["name"] == "Lost Man Trailhead Road":
+                    #         breakpoint()
+                    # print(f"RATIO: {ratio} - {segment["match"]}")
+                    # It was a solid match, so doesn't go in any output files
+                    if segment["hits"] >= hits:
+                        hits = segment["hits"]
+                        closest = segment
+                    props = closest["osm"]["properties"]
+                    tags = entry["properties"]
+                    if "refs" in props:
+                        tags["refs"] = props["refs"]
+                    if "osm_id" in props:
+                        tags["id"] = props["osm_id"]
+                    elif "id" in props:
+                        tags["id"] =  props["id"]
+                    if "version" in props:
+                        tags["version"] = props["version"]
+                    else:
+                        tags["version"] = 1
+                    if "name_ration" in segment:
+                        tags["name_ratio"] = segment["name_ratio"]
+                    if "ref_ration" in segment:
+                        tags["ref_ratio"] = segment["ref_ratio"]
+
+                    tags["debug"] = f"hits: {hits}, dist: {str(closest["dist"])[:7]}, slope: {str(closest["slope"])[:7]}, angle: {str(closest["angle"])[:7]}"
+                    geom = shape(closest["osm"]["geometry"])
+                    pname = str()
+                    if "name" in entry["properties"]:
+                        pname = entry["properties"]["name"]
+                    sname = str()
+                    if "name" in props:
+                        sname = props["name"]
+                    # print(f"ADDING: {pname} == {sname} dist: {str(closest["dist"])[:7]}, name: {closest["name_ratio"]}, ref: {closest["ref_ratio"]}, hits: {closest["hits"]}")
+                    # if segment["hits"] == 1:
+                    #     breakpoint()
+                    # if hits >= 1:
+                    data.append(Feature(geometry=geom, properties=tags))
+                    # else:
+                    #     data.append(Feature(geometry=segment["geometry"], properties=tags))
+
+                # data.append(Feature(geometry=geom, properties=tags))
+                # If no hits, it's new data. ODK data is always just a POI for now
+                if hits == 0 and dist <= threshold:
+                    entry["properties"]["version"] = 1
+                    entry["properties"]["informal"] = "yes"
+                    entry["properties"]["fixme"] = "New features should be imported following OSM guidelines."
+                    entry["properties"]["debug"] = f"hits: {hits}, dist: {str(dist)[:7]}"
+                entry["properties"]["slope"] = slope
+                entry["properties"]["angle"] = angle
+                # entry["properties"]["dist"] = dist
+                # log.debug(f"FOO({dist}): {entry}")
+                newdata.append(entry)
+
+        for feature in data:
+            yield 0, feature, i - 1
+        for feature in newdata:
+            yield 1, feature, i - 1
         # timer.stop()
 
-    # log.debug(f"OLD: {len(data)}")
-    # log.debug(f"NEW: {len(newdata)}")
-    return [data, newdata]
-
 class Conflator(object):
     def __init__(self,
                  uri: str = None,
@@ -467,6 +1007,228 @@ class Conflator(object):
         self.tolerance = 7
         self.data = dict()
         self.analyze = ("building", "name", "amenity", "landuse", "cuisine", "tourism", "leisure")
+        # The spatial index of the secondary dataset, and the features
+        # that are in it.
+        self.index = None
+        self.source = None
+        self.indexed = list()
+        self.refs = dict()
+        # The cache of geometries already projected to meters, keyed by
+        # the id() of the feature. The feature is kept with the geometry
+        # so a reused id() can be detected.
+        self.projected = dict()
+
+    def projectFeatures(self,
+                        data: list,
+                        ):
+        """
+        Project the geometry of each feature to EPSG:3857 so distances
+        are in meters, and cache the results so this is only ever done
+        once for each feature. All the coordinates get transformed in a
+        single call instead of one call for each feature.
+
+        Args:
+            data (list): The features to project
+        """
+        with StageTimer("projection"):
+            if isinstance(data, FeatureStore):
+                data.project(getTransformer())
+                return
+            features = list()
+            geoms = list()
+            for feature in data:
+                if isinstance(feature, StoredFeature):
+                    feature.store.project(getTransformer())
+                    continue
+                if feature["geometry"] is None:
+                    continue
+                cached = self.projected.get(id(feature))
+                if cached is not None and cached[0] is feature:
+                    continue
+                try:
+                    geoms.append(shape(feature["geometry"]))
+                except Exception as e:
+                    # getProjected() will raise this again if the
+                    # feature actually gets used.
+                    log.debug(f"Can't project {feature['properties']}: {e}")
+                    continue
+                features.append(feature)
+
+            if len(geoms) == 0:
+                return
+
+            project = getTransformer()
+            projected = shapely.transform(numpy.array(geoms, dtype=object),
+                                          lambda coords: numpy.column_stack(project.transform(coords[:, 0], coords[:, 1])))
+            for feature, geom in zip(features, projected):
+                self.projected[id(feature)] = (feature, geom)
+
+    def getProjected(self,
+                     feature: Feature,
+                     ):
+        """
+        Get the projected geometry of a feature, projecting it now if
+        it isn't in the cache.
+
+        Args:
+            feature (Feature): The feature to get the geometry of
+
+        Returns:
+            (BaseGeometry): The geometry in EPSG:3857
+        """
+        if isinstance(feature, StoredFeature):
+            # The store has all the projected coordinates
+            feature.store.project(getTransformer())
+            return feature.store.getProjected(feature.position)
+        cached = self.projected.get(id(feature))
+        if cached is None or cached[0] is not feature:
+            self.projectFeatures([feature])
+            cached = self.projected.get(id(feature))
+            if cached is None:
+                # Let shapely raise the actual error
+                shape(feature["geometry"])
+        return cached[1]
+
+    def makeIndex(self,
+                  data: list,
+                  ):
+        """
+        Load the features that can be conflated into an STRtree, so
+        finding the ones near a feature doesn't require a scan of
+        the entire dataset. Features without a geometry, POIs, and
+        LineStrings without enough coordinates are never conflated,
+        so they aren't added to the index. Indexing the same list
+        again does nothing.
+
+        Args:
+            data (list): The features to index, usually the secondary dataset
+        """
+        if self.index is not None and data is self.source:
+            # Already indexed, which happens when a worker process
+            # conflates more than one chunk of data.
+            return
+        geoms = list()
+        self.source = data
+        self.indexed = list()
+        self.refs = dict()
+        if isinstance(data, FeatureStore):
+            self.makeStoreIndex(data)
+            return
+        for feature in data:
+            if feature["geometry"] is None:
+                continue
+            if feature["geometry"]["type"] == "Point":
+                continue
+            if feature["geometry"]["type"] == "LineString" and len(feature["geometry"]["coordinates"]) <= 1:
+                continue
+            geoms.append(shape(feature["geometry"]))
+            # A hash index of the normalized refs, which are often
+            # enough to match a highway.
+            for ref in getRefs(feature):
+                if ref not in self.refs:
+                    self.refs[ref] = list()
+                self.refs[ref].append(len(self.indexed))
+            self.indexed.append(feature)
+        self.index = shapely.STRtree(geoms)
+        log.debug(f"Indexed {len(self.indexed)} of {len(data)} features")
+
+    def makeStoreIndex(self,
+                       store: FeatureStore,
+                       ):
+        """
+        Index the features in a FeatureStore. This uses the bounding
+        boxes from the coordinate arrays, so the features and their
+        geometries don't all have to be made. The tree only uses the
+        bounding boxes anyway, so the results are the same.
+
+        Args:
+            store (FeatureStore): The features to index
+        """
+        store.finish()
+        bounds = store.getBounds()
+        counts = store.parts[store.offsets[1:]] - store.parts[store.offsets[:-1]]
+        keep = (store.types >= 0) & (store.types != 0)
+        keep &= ~((store.types == 1) & (counts <= 1))
+        positions = numpy.nonzero(keep)[0]
+        for index, position in enumerate(positions):
+            refs = set()
+            for key in ("ref", "ref:usfs"):
+                value = store.getTag(position, key)
+                if value:
+                    refs.update(normalizeRefs(value))
+            for ref in refs:
+                if ref not in self.refs:
+                    self.refs[ref] = list()
+                self.refs[ref].append(index)
+        self.index = shapely.STRtree(shapely.box(bounds[positions, 0], bounds[positions, 1],
+                                                 bounds[positions, 2], bounds[positions, 3]))
+        self.indexed = store.view(positions)
+        log.debug(f"Indexed {len(self.indexed)} of {len(store)} features")
+
+    def queryIndex(self,
+                   feature: Feature,
+                   threshold: float = 7.0,
+                   ) -> list:
+        """
+        Get the indexed features that may be within the threshold
+        distance of a feature. The bounding box of the feature is
+        expanded by the threshold, which is in meters, so it gets
+        converted to degrees first. Web Mercator never shrinks a
+        distance, so this never drops a feature getDistance() would
+        have kept. The candidates are returned in the same order as
+        the original dataset, so the results don't change.
+
+        Args:
+            feature (Feature): The feature to find the candidates for
+            threshold (float): Threshold for distance calculations in meters
+
+        Returns:
+            (list): The candidate features
+        """
+        with StageTimer("search"):
+            if self.index is None or feature["geometry"] is None:
+                return list()
+            degrees = math.degrees(threshold / 6378137.0)
+            minx, miny, maxx, maxy = shape(feature["geometry"]).bounds
+            bbox = shapely.box(minx - degrees, miny - degrees, maxx + degrees, maxy + degrees)
+            hits = numpy.sort(self.index.query(bbox))
+
+            return [self.indexed[i] for i in hits]
+
+    def matchRefs(self,
+                  feature: Feature,
+                  refdistance: float = 100.0,
+                  ) -> tuple:
+        """
+        Find the indexed features with exactly the same ref as a
+        feature, and within a generous distance of it. These are used
+        as the candidates instead of the ones near the feature, but
+        still go through the same checks.
+
+        Args:
+            feature (Feature): The feature from the external dataset
+            refdistance (float): The maximum distance in meters
+
+        Returns:
+            (list): The features with the same ref
+            (dict): Their scores from scoreCandidates()
+        """
+        with StageTimer("search"):
+            found = set()
+            for ref in getRefs(feature):
+                found.update(self.refs.get(ref, list()))
+        if len(found) == 0:
+            return list(), self.scoreCandidates(feature, list())
+
+        candidates = [self.indexed[i] for i in sorted(found)]
+        scores = self.scoreCandidates(feature, candidates)
+        keep = [index for index in range(len(candidates))
+                if not scores["error"][index] and scores["valid"][index]
+                and 0 <= scores["dist"][index] < refdistance]
+        candidates = [candidates[index] for index in keep]
+        scores = {key: [value[index] for index in keep] for key, value in scores.items()}
+
+        return candidates, scores
 
     def getSlope(self,
             newdata: Feature,
@@ -479,12 +1241,8 @@ class Conflator(object):
         # oldline = shape(olddata["geometry"])
         angle = 0.0
         # newline = shape(newdata["geometry"])
-        project = pyproj.Transformer.from_proj(
-            pyproj.Proj(init='epsg:4326'),
-            pyproj.Proj(init='epsg:3857')
-            )
-        newobj = transform(project.transform, shape(newdata["geometry"]))
-        oldobj = transform(project.transform, shape(olddata["geometry"]))
+        newobj = self.getProjected(newdata)
+        oldobj = self.getProjected(olddata)
         # if newline.type == "MultiLineString":
         #     lines = newline.geoms
         # elif newline.type == "GeometryCollection":
@@ -581,14 +1339,9 @@ class Conflator(object):
         # dist = shapely.hausdorff_distance(center, wkt)
         dist = float()
 
-        # Transform so the results are in meters instead of degress of the
-        # earth's radius.
-        project = pyproj.Transformer.from_proj(
-            pyproj.Proj(init='epsg:4326'),
-            pyproj.Proj(init='epsg:3857')
-            )
-        newobj = transform(project.transform, shape(newdata["geometry"]))
-        oldobj = transform(project.transform, shape(olddata["geometry"]))
+        # These are in meters instead of degress of the earth's radius.
+        newobj = self.getProjected(newdata)
+        oldobj = self.getProjected(olddata)
 
         # FIXME: we shouldn't ever get here...
         if oldobj.type == "MultiLineString":
@@ -667,9 +1420,164 @@ class Conflator(object):
         # timer.stop()
         return best # dist # best
 
+    def scoreCandidates(self,
+                        newdata: Feature,
+                        candidates: list,
+                        ) -> dict:
+        """
+        Compute the distance, slope, and angle between a feature and
+        all the candidates it may be conflated with. This uses
+        vectorized shapely and numpy calls instead of calling
+        getDistance() and getSlope() for each pair, but returns the
+        same values they do, other than rounding in the last digit
+        of the angle.
+
+        Args:
+            newdata (Feature): A feature from the external dataset
+            candidates (list): The features from the existing OSM dataset
+
+        Returns:
+            (dict): The dist, slope, and angle for each candidate. valid is False
+                    when getSlope() would fail, and error is True when getDistance() did
+        """
+        with StageTimer("distance"):
+            size = len(candidates)
+            newobj = self.getProjected(newdata)
+            oldobjs = numpy.array([self.getProjected(existing) for existing in candidates], dtype=object)
+            error = numpy.zeros(size, dtype=bool)
+
+            # A large difference in the length often means the OSM highway
+            # doesn't exist in the external dataset, unless it's inside the
+            # convex hull of the other one.
+            dist = shapely.distance(newobj, oldobjs)
+            large = numpy.abs(newobj.length - shapely.length(oldobjs)) > 1000
+            inside = shapely.dwithin(shapely.convex_hull(oldobjs), newobj, 0)
+            dist = numpy.where(large, numpy.where(inside, 0.0, -1.0), dist)
+
+            # Only highways get compared this way, anything else uses
+            # getDistance().
+            simple = shapely.get_type_id(oldobjs) == shapely.GeometryType.LINESTRING
+            if newobj.geom_type not in ("LineString", "MultiLineString"):
+                simple[:] = False
+            for index in numpy.flatnonzero(~simple):
+                try:
+                    dist[index] = self.getDistance(newdata, candidates[index])
+                except Exception:
+                    error[index] = True
+
+        with StageTimer("slope"):
+            # The slope uses the same points on each line as getSlope()
+            offset = 2
+            slope = numpy.zeros(size)
+            angle = numpy.zeros(size)
+            valid = numpy.ones(size, dtype=bool)
+            points = shapely.get_num_points(newobj)
+            start = shapely.get_point(newobj, offset)
+            if points == 0:
+                slope[:] = -0.1
+                angle[:] = -0.1
+            elif start is not None:
+                end = shapely.get_point(newobj, points - offset)
+                if (end.x - start.x) == 0.0:
+                    valid[:] = False
+                else:
+                    slope1 = (end.y - start.y) / (end.x - start.x)
+                    starts = shapely.get_point(oldobjs, offset)
+                    ends = shapely.get_point(oldobjs, shapely.get_num_points(oldobjs) - offset)
+                    x1 = shapely.get_x(starts)
+                    y1 = shapely.get_y(starts)
+                    x2 = shapely.get_x(ends)
+                    y2 = shapely.get_y(ends)
+                    # There is no start point when the line is too short
+                    usable = ~numpy.isnan(x1) & ((x2 - x1) != 0.0)
+                    with numpy.errstate(divide="ignore", invalid="ignore"):
+                        slope2 = (y2 - y1) / (x2 - x1)
+                        divisor = 1 + (slope2 * slope1)
+                        result = numpy.arctan((slope2 - slope1) / divisor) / (math.pi / 180.0)
+                    valid = ~usable | (divisor != 0.0)
+                    result = numpy.where(numpy.isnan(result), 0.0, result)
+                    angle = numpy.where(usable & valid, result, 0.0)
+                    result = slope1 - slope2
+                    result = numpy.where(numpy.isnan(result), 0.0, result)
+                    slope = numpy.where(usable & valid, result, 0.0)
+
+        return {"dist": dist.tolist(),
+                "slope": slope.tolist(),
+                "angle": angle.tolist(),
+                "valid": valid.tolist(),
+                "error": error.tolist(),
+                }
+
+    def scoreNames(self,
+                   feature: Feature,
+                   candidates: list,
+                   key: str = "name",
+                   expand: bool = False,
+                   ) -> list:
+        """
+        Get the fuzzy match ratio of one tag between a feature and all
+        of the candidates in a single call, instead of one pair at a
+        time. The ratios are rounded the same way thefuzz does it.
+
+        Args:
+            feature (Feature): The feature from the external dataset
+            candidates (list): The features to compare it to
+            key (str): The tag to compare
+            expand (bool): Whether to expand the abbreviations first
+
+        Returns:
+            (list): The ratio for each candidate, or None if it doesn't have the tag
+        """
+        ratios = [None] * len(candidates)
+        value = feature["properties"].get(key)
+        if value is None:
+            return ratios
+        normalize = expandName if expand else normalizeName
+        choices = list()
+        positions = list()
+        for index, existing in enumerate(candidates):
+            other = existing["properties"].get(key)
+            if other is None:
+                continue
+            choices.append(normalize(other))
+            positions.append(index)
+        if len(choices) == 0:
+            return ratios
+
+        scores = rapidfuzz.process.cdist([normalize(value)], choices,
+                                         scorer=rapidfuzz.fuzz.ratio,
+                                         dtype=numpy.float64)[0]
+        for index, score in zip(positions, scores):
+            ratios[index] = int(round(score))
+
+        return ratios
+
+    def scoreTags(self,
+                  feature: Feature,
+                  candidates: list,
+                  ) -> list:
+        """
+        Get the ratios of all the tags checkTags() uses for fuzzy
+        matching, for all the candidates.
+
+        Args:
+            feature (Feature): The feature from the external dataset
+            candidates (list): The features to compare it to
+
+        Returns:
+            (list): The ratios for each candidate, for checkTags()
+        """
+        with StageTimer("tags"):
+            keys = ["name", "ref", "ref:usfs"]
+            ratios = {key: self.scoreNames(feature, candidates, key) for key in keys}
+
+            return [{key: ratios[key][index] for key in keys} for index in range(len(candidates))]
+
     def checkTags(self,
                   extfeat: Feature,
                   osm: Feature,
+                  ratios: dict = None,
+                  match_threshold: int = 80,
                    ):
         """
         Check tags between 2 features.
@@ -677,125 +1585,137 @@ class Conflator(object):
         Args:
             extfeat (Feature): The feature from the external dataset
             osm (Feature): The result
+            ratios (dict): The ratios from scoreTags() for this pair, if any
+            match_threshold (int): The ratio for name and ref matching
 
         Returns:
             (int): The number of tag matches
             (dict): The updated tags
         """
-        match_threshold = 80
-        match = ["name", "ref", "ref:usfs"]
-        keep = ["UT", "CR", "WY", "CO", "US"]
-        hits = 0
-        props = dict()
-        id = 0
-        version = 0
-        props = extfeat['properties'] | osm['properties']
-        props["name_ratio"] = 0
-        props["ref_ratio"] = 0
-
-        # ODK Collect adds these two tags we don't need
-        if "title" in props:
-            del props["title"]
-        if "label" in props:
-            del props["label"]
-
-        if "id" in props:
-            # External data not from an OSM source always has
-            # negative IDs to distinguish it from current OSM data.
-            id = int(props["id"])
-        else:
-            id -= 1
-            props["id"] = id
-
-        if "version" in props:
-            # Always use the OSM version if it exists, since it gets
-            # incremented so JOSM see it's been modified.
-            props["version"] = int(version)
-            # Name may also be name:en, name:np, etc... There may also be
-            # multiple name:* values in the tags.
-        else:
-            props["version"] = 1
-
-        # These are all the other tags
-        # if key not in match:
-        #     pass
-
-        # These tags require more careful checking
-        for key in match:
-            if "highway" in osm["properties"]:
-                # Always use the value in the secondary, which is
-                # likely OSM.
-                props["highway"] = osm["properties"]["highway"]
-            if key not in props:
-                continue
+        with StageTimer("tags"):
+            match = ["name", "ref", "ref:usfs"]
+            keep = ["UT", "CR", "WY", "CO", "US"]
+            hits = 0
+            props = dict()
+            id = 0
+            version = 0
+            props = extfeat['properties'] | osm['properties']
+            props["name_ratio"] = 0
+            props["ref_ratio"] = 0
+
+            # ODK Collect adds these two tags we don't need
+            if "title" in props:
+                del props["title"]
+            if "label" in props:
+                del props["label"]
+
+            if "id" in props:
+                # External data not from an OSM source always has
+                # negative IDs to distinguish it from current OSM data.
+                id = int(props["id"])
+            else:
+                id -= 1
+                props["id"] = id
+
+            if "version" in props:
+                # Always use the OSM version if it exists, since it gets
+                # incremented so JOSM see it's been modified.
+                props["version"] = int(version)
+                # Name may also be name:en, name:np, etc... There may also be
+                # multiple name:* values in the tags.
+            else:
+                props["version"] = 1
+
+            # These are all the other tags
+            # if key not in match:
+            #     pass
+
+            # These tags require more careful checking
+            for key in match:
+                if "highway" in osm["properties"]:
+                    # Always use the value in the secondary, which is
+                    # likely OSM.
+                    props["highway"] = osm["properties"]["highway"]
+                if key not in props:
+                    continue
 
-            # In OSM, there may be an existing value for the ref
-            # that is a county or state designation in addition to
-            # the USFS reference number. That should be kept.
-            if key == "ref" and "ref" in osm["properties"]:
-                props["ref"] = osm["properties"]["ref"]
-                continue
+                # In OSM, there may be an existing value for the ref
+                # that is a county or state designation in addition to
+                # the USFS reference number. That should be kept.
+                if key == "ref" and "ref" in osm["properties"]:
+                    props["ref"] = osm["properties"]["ref"]
+                    continue
 
-            # Usually it's the name field that has the most variety in
-            # in trying to match strings. This often is differences in
-            # capitalization, singular vs plural, and typos from using
-            # your phone to enter the name. Course names also change
-            # too so if it isn't a match, use the new name from the
-            # external dataset.
-            if key in osm["properties"] and key in extfeat["properties"] and extfeat["properties"][key] is not None :
-                length = len(extfeat["properties"][key]) - len(osm["properties"][key])
-                # Sometimes there will be a word match, which returns a
-                # ratio in the low 80s. In that case they should be
-                # a similar length.
-                ratio = fuzz.ratio(extfeat["properties"][key].lower(), osm["properties"][key].lower())
-                # print(f"\tChecking ({key}:{ratio}): \'{extfeat["properties"][key].lower()}\', \'{osm["properties"][key].lower()}\'")
-                if key == "name":
-                    props["name_ratio"] = ratio
-                else:
-                    props["ref_ratio"] = ratio
-                if ratio > match_threshold and length <= 3:
-                    hits += 1
-                    props[key] = extfeat["properties"][key]
-                    if ratio != 100:
-                        # Often the only difference is using FR or FS as the
-                        # prefix. In that case, see if the ref matches.
-                        if key[:3] == "ref":
-                            # This assume all the data has been converted
-                            # by one of the utility programs, which enfore
-                            # using the ref:usfs tag.
-                            tmp = extfeat["properties"]["ref:usfs"].split(' ')
-                            exttype = tmp[0].upper()
-                            extref = tmp[1].upper()
-                            tmp = osm["properties"]["ref:usfs"].split(' ')
-                            newtype = tmp[0]
-                            newref = tmp[1].upper()
-                            # print(f"\tREFS: {newtype} - {extref} vs {newref}: {extref == newref}")
-                            if extref == newref:
-                                hits += 1 
-                                # Many minor changes of FS to FR don't require
-                                # caching the exising value as it's only the
-                                # prefix that changed. It always stays in this
-                                # range.
-                                if osm["properties"]["ref:usfs"][:3] == "FS " and ratio > 80 and ratio < 90:
-                                    # log.debug(f"Ignoring old ref {osm["properties"]["ref:usfs"]}")
-                                    continue
-                        # For a fuzzy match, cache the value from the
-                        # primary dataset and use the value in the
-                        # secondary dataset since sometims the name in OSM is
-                        # what  the highway is generally called, which at times
-                        # may be greatly different from the official name.
-                elif key == "name" and ratio > 0:
-                        props["name"] = osm["properties"][key]
-                        props["alt_name"] = extfeat["properties"]["name"]
-
-        # print(props)
-        return hits, props
+                # Usually it's the name field that has the most variety in
+                # in trying to match strings. This often is differences in
+                # capitalization, singular vs plural, and typos from using
+                # your phone to enter the name. Course names also change
+                # too so if it isn't a match, use the new name from the
+                # external dataset.
+                if key in osm["properties"] and key in extfeat["properties"] and extfeat["properties"][key] is not None :
+                    length = len(extfeat["properties"][key]) - len(osm["properties"][key])
+                    # Sometimes there will be a word match, which returns a
+                    # ratio in the low 80s. In that case they should be
+                    # a similar length.
+                    if ratios is not None and ratios.get(key) is not None:
+                        ratio = ratios[key]
+                    else:
+                        ratio = nameRatio(normalizeName(extfeat["properties"][key]), normalizeName(osm["properties"][key]))
+                    # print(f"\tChecking ({key}:{ratio}): \'{extfeat["properties"][key].lower()}\', \'{osm["properties"][key].lower()}\'")
+                    if key == "name":
+                        props["name_ratio"] = ratio
+                    else:
+                        props["ref_ratio"] = ratio
+                    if ratio > match_threshold and length <= 3:
+                        hits += 1
+                        props[key] = extfeat["properties"][key]
+                        if ratio != 100:
+                            # Often the only difference is using FR or FS as the
+                            # prefix. In that case, see if the ref matches.
+                            if key[:3] == "ref":
+                                # This assume all the data has been converted
+                                # by one of the utility programs, which enfore
+                                # using the ref:usfs tag.
+                                exttype, extref = splitRef(extfeat["properties"]["ref:usfs"])
+                                newtype, newref = splitRef(osm["properties"]["ref:usfs"])
+                                # print(f"\tREFS: {newtype} - {extref} vs {newref}: {extref == newref}")
+                                if extref == newref:
+                                    hits += 1 
+                                    # Many minor changes of FS to FR don't require
+                                    # caching the exising value as it's only the
+                                    # prefix that changed. It always stays in this
+                                    # range.
+                                    if osm["properties"]["ref:usfs"][:3] == "FS " and ratio > 80 and ratio < 90:
+                                        # log.debug(f"Ignoring old ref {osm["properties"]["ref:usfs"]}")
+                                        continue
+                            # For a fuzzy match, cache the value from the
+                            # primary dataset and use the value in the
+                            # secondary dataset since sometims the name in OSM is
+                            # what  the highway is generally called, which at times
+                            # may be greatly different from the official name.
+                    elif key == "name" and ratio > 0:
+                            props["name"] = osm["properties"][key]
+                            props["alt_name"] = extfeat["properties"]["name"]
+
+            # print(props)
+            return hits, props
 
     def conflateData(self,
                     primaryspec: str,
                     secondaryspec: str,
-                    threshold: float = 10.0,
+                    threshold: float = 7.0,
                     informal: bool = False,
+                    tilesize: float = None,
+                    refdistance: float = 0.0,
+                    sweeps: list = None,
+                    sinks: list = None,
+                    checkpoint: str = None,
+                    batchsize: int = 1000,
+                    incremental: str = None,
+                    store: bool = False,
+                    keys: list = None,
+                    cache: str = None,
+                    workers: int = None,
                     ) -> list:
         """
         Open the two source files and contlate them.
@@ -805,10 +1725,26 @@ class Conflator(object):
             secondaryspec (str): The secondary dataset filespec
             threshold (float): Threshold for distance calculations in meters
             informal (bool): Whether to dump features in OSM not in external data
+            tilesize (float): If set, conflate in tiles of this size in degrees
+            refdistance (float): If set, features with the same ref within this distance are matched first
+            sweeps (list): If set, conflate with each of these threshold tuples
+            sinks (list): If set, write the output to these sinks as it's produced
+            checkpoint (str): If set, save each batch in this directory, and skip the ones already done.
+                              This can't be used with tiles.
+            batchsize (int): The number of primary features in each batch
+            incremental (str): If set, only conflate what changed since the results saved in this directory
+            store (bool): Whether to keep the datasets in a FeatureStore to use less memory
+            keys (list): If set, only read the OSM features with one of these tags
+            cache (str): If set, cache the parsed datasets in this directory, and reuse them
+            workers (int): The number of processes to conflate with, all the cores by default
 
         Returns:
-            (list):  The conflated output
+            (list):  The conflated output, a list of them for sweeps, or the counts for sinks
         """
+        # The checkpoints are for batches of the primary dataset in
+        # order, not tiles, so one of them would be ignored.
+        if checkpoint and tilesize:
+            raise ValueError("A checkpoint can't be used with tiles")
         timer = Timer(text="conflateData() took {seconds:.0f}s")
         timer.start()
         odkdata = list()
@@ -819,16 +1755,13 @@ class Conflator(object):
         #     db = GeoSupport(odkspec[3:])
         #     result = await db.queryDB()
         # else:
-        primarydata = self.parseFile(primaryspec)
+        primarydata = self.parseFile(primaryspec, store, keys, cache)
 
         # if osmspec[:3].lower() == "pg:":
         #     db = GeoSupport(osmspec[3:])
         #     result = await db.queryDB()
         # else:
-        secondarydata = self.parseFile(secondaryspec)
-
-        entries = len(primarydata)
-        chunk = round(entries / cores)
+        secondarydata = self.parseFile(secondaryspec, store, keys, cache)
 
         alldata = list()
         newdata = list()
@@ -847,39 +1780,683 @@ class Conflator(object):
         else:
             print(f"The secondary dataset has {len(secondarydata)} entries")
 
+        if sweeps:
+            alldata = self.conflateSweep(primarydata, secondarydata, sweeps, informal, refdistance)
+            timer.stop()
+            return alldata
+
+        if incremental:
+            alldata = self.conflateIncremental(primarydata, secondarydata, incremental, threshold,
+                                               informal, refdistance, sinks)
+            timer.stop()
+            return alldata
+
+        if checkpoint:
+            manifest = {"primary": {"file": str(primaryspec), "sha256": hashFile(primaryspec)},
+                        "secondary": {"file": str(secondaryspec), "sha256": hashFile(secondaryspec)},
+                        "threshold": threshold,
+                        "informal": informal,
+                        "refdistance": refdistance,
+                        "batchsize": batchsize,
+                        "keys": keys,
+                        }
+            alldata = self.conflateBatches(primarydata, secondarydata, checkpoint, manifest, sinks)
+            timer.stop()
+            return alldata
+
+        if tilesize:
+            alldata = self.conflateTiles(primarydata, secondarydata, threshold, informal, tilesize, refdistance,
+                                         sinks, workers)
+            timer.stop()
+            return alldata
+
+        if workers is None:
+            workers = cores
+        entries = len(primarydata)
+        chunk = round(entries / workers)
+
         # Make threading optional for easier debugging
-        if chunk == 0 or len(primarydata) < cores:
+        if chunk == 0 or len(primarydata) < workers or workers <= 1:
             single = True
         else:
             single = False
+        log.info(f"Conflating with {1 if single else workers} processes")
+
+        if single and sinks:
+            # Nothing is kept in memory, it all goes to the sinks
+            counts = [0, 0]
+            for output, feature, position in conflateFeatures(primarydata, secondarydata, informal, threshold,
+                                                              refdistance=refdistance, cutils=self):
+                writeFeature(sinks, output, feature)
+                counts[output] += 1
+            alldata = counts
+        elif single:
+            alldata = conflateThread(primarydata, secondarydata, informal, threshold,
+                                     refdistance=refdistance, cutils=self)
+        else:
+            results = dict()
+            order = list(range(0, entries, chunk))
+            counts = [0, 0]
+            for block, result in self.conflateBlocks(primarydata, secondarydata, order, chunk,
+                                                     informal, threshold, refdistance, workers):
+                results[block] = result
+                if sinks:
+                    counts[0] += len(result[0])
+                    counts[1] += len(result[1])
+                    flushResults(results, order, sinks, workers)
+            if sinks:
+                alldata = counts
+            else:
+                # Keep the output in the same order as the primary dataset
+                data = list()
+                for block in sorted(results):
+                    data.extend(results[block][0])
+                    newdata.extend(results[block][1])
+                alldata = [data, newdata]
 
-        single = True          # FIXME: debug
-        if single:
-            alldata = conflateThread(primarydata, secondarydata)
+        timer.stop()
+
+        return alldata
+
+    def conflateBlocks(self,
+                       primarydata: list,
+                       secondarydata: list,
+                       blocks: list,
+                       size: int,
+                       informal: bool = False,
+                       threshold: float = 10.0,
+                       refdistance: float = 0.0,
+                       workers: int = None,
+                       ):
+        """
+        Conflate blocks of the primary dataset, in parallel if there is
+        more than one core. The secondary dataset is put in shared
+        memory once, and all the workers use it in place instead of
+        each block getting a copy.
+
+        Args:
+            primarydata (list): The primary dataset
+            secondarydata (list): The secondary dataset
+            blocks (list): The offset of each block in the primary dataset
+            size (int): The number of features in each block
+            informal (bool): Whether to dump features in OSM not in external data
+            threshold (float): Threshold for distance calculations in meters
+            refdistance (float): If set, features with the same ref within this distance are matched first
+            workers (int): The number of processes to use, all the cores by default
+
+        Returns:
+            (int): The offset of the block, as each one is done
+            (list): The conflated output of the block
+        """
+        if workers is None:
+            workers = cores
+        if workers <= 1 or len(blocks) <= 1:
+            for block in blocks:
+                yield block, conflateThread(primarydata[block:block + size], secondarydata,
+                                            informal, threshold, refdistance=refdistance, cutils=self)
+            return
+
+        # Only the features that can be conflated are shared, unless
+        # they're already in a store.
+        self.makeIndex(secondarydata)
+        if isinstance(secondarydata, FeatureStore):
+            shm, layout = shareFeatures(secondarydata)
         else:
-            futures = list()
-            with concurrent.futures.ProcessPoolExecutor(max_workers=cores) as executor:
-                for block in range(0, entries, chunk):
-                    data = list()
-                    future = executor.submit(conflateThread,
-                            primarydata[block:block + chunk - 1],
-                            secondarydata,
-                            informal
+            shm, layout = shareFeatures(self.indexed)
+        try:
+            futures = dict()
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        initializer=initWorker,
+                                                        initargs=(shm.name, layout)) as executor:
+                for block in blocks:
+                    future = executor.submit(conflateChunk,
+                            primarydata[block:block + size],
+                            informal,
+                            threshold,
+                            refdistance,
                             )
-                    futures.append(future)
-                #for thread in concurrent.futures.wait(futures, return_when='ALL_COMPLETED'):
+                    futures[future] = block
                 for future in concurrent.futures.as_completed(futures):
-                    res = future.result()
                     # log.debug(f"Waiting for thread to complete..,")
-                    data.extend(res[0])
-                    newdata.extend(res[1])
-                alldata = [data, newdata]
+                    result, stats = future.result()
+                    mergeReport(stats)
+                    yield futures[future], result
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def openCheckpoint(self,
+                       checkpoint: str,
+                       manifest: dict,
+                       ) -> set:
+        """
+        Open the checkpoint directory, and find the batches that are
+        already done. If the inputs or the parameters have changed
+        since they were saved, they all get done again.
 
-            executor.shutdown()
+        Args:
+            checkpoint (str): The checkpoint directory
+            manifest (dict): The hashes of the inputs, and the parameters
 
-        timer.stop()
+        Returns:
+            (set): The numbers of the batches that are done
+        """
+        path = Path(checkpoint)
+        path.mkdir(parents=True, exist_ok=True)
+        manifestfile = path / "manifest.json"
+        if manifestfile.exists():
+            with open(manifestfile, "r") as file:
+                previous = json.load(file)
+            if previous != manifest:
+                log.warning(f"The inputs or parameters changed, ignoring the checkpoints in {checkpoint}")
+                for batch in path.glob("batch-*.geojson"):
+                    batch.unlink()
+        with open(path / "manifest.tmp", "w") as file:
+            json.dump(manifest, file, indent=4)
+        os.replace(path / "manifest.tmp", manifestfile)
+
+        done = set()
+        for batch in path.glob("batch-*.geojson"):
+            done.add(int(batch.stem.split('-')[1]))
+        return done
+
+    def saveBatch(self,
+                  checkpoint: str,
+                  number: int,
+                  result: list,
+                  ):
+        """
+        Save the conflated output of a batch. It's written to a
+        temporary file first, so a batch that is only partially
+        written is never used.
 
-        return alldata
+        Args:
+            checkpoint (str): The checkpoint directory
+            number (int): The number of the batch
+            result (list): The conflated output of the batch
+        """
+        path = Path(checkpoint)
+        tmpfile = path / f"batch-{number:06d}.tmp"
+        with open(tmpfile, "w") as file:
+            geojson.dump({"data": result[0], "new": result[1]}, file)
+        os.replace(tmpfile, path / f"batch-{number:06d}.geojson")
+
+    def loadBatch(self,
+                  checkpoint: str,
+                  number: int,
+                  ) -> list:
+        """
+        Load the conflated output of a batch.
+
+        Args:
+            checkpoint (str): The checkpoint directory
+            number (int): The number of the batch
+
+        Returns:
+            (list): The conflated output of the batch
+        """
+        with open(Path(checkpoint) / f"batch-{number:06d}.geojson", "r") as file:
+            result = geojson.load(file)
+        return [result["data"], result["new"]]
+
+    def conflateBatches(self,
+                        primarydata: list,
+                        secondarydata: list,
+                        checkpoint: str,
+                        manifest: dict,
+                        sinks: list = None,
+                        ) -> list:
+        """
+        Conflate the primary dataset in numbered batches, and save the
+        output of each one in the checkpoint directory. If a long
+        conflation dies, running it again skips the batches that are
+        already done.
+
+        Args:
+            primarydata (list): The primary dataset
+            secondarydata (list): The secondary dataset
+            checkpoint (str): The checkpoint directory
+            manifest (dict): The hashes of the inputs, and the parameters
+            sinks (list): If set, write the output to these sinks
+
+        Returns:
+            (list):  The conflated output, or the counts for sinks
+        """
+        batchsize = manifest["batchsize"]
+        done = self.openCheckpoint(checkpoint, manifest)
+        blocks = list(range(0, len(primarydata), batchsize))
+        todo = [block for block in blocks if block // batchsize not in done]
+        log.info(f"{len(blocks) - len(todo)} of {len(blocks)} batches are already done")
+
+        for block, result in self.conflateBlocks(primarydata, secondarydata, todo, batchsize,
+                                                 manifest["informal"], manifest["threshold"],
+                                                 manifest["refdistance"]):
+            self.saveBatch(checkpoint, block // batchsize, result)
+
+        # All the output comes from the saved batches, so a run that
+        # was resumed gets the same output as one that wasn't.
+        data = list()
+        newdata = list()
+        counts = [0, 0]
+        for block in blocks:
+            result = self.loadBatch(checkpoint, block // batchsize)
+            if sinks:
+                counts[0] += len(result[0])
+                counts[1] += len(result[1])
+                for output in (0, 1):
+                    writeFeatures(sinks, output, result[output])
+            else:
+                data.extend(result[0])
+                newdata.extend(result[1])
+
+        if sinks:
+            return counts
+        return [data, newdata]
+
+    def loadState(self,
+                  statedir: str,
+                  parameters: dict,
+                  ) -> dict:
+        """
+        Load the state saved by the last incremental run. If the
+        parameters have changed since it was saved, it isn't used.
+
+        Args:
+            statedir (str): The directory for the saved state
+            parameters (dict): The parameters for conflation
+
+        Returns:
+            (dict): The results for each primary feature, and the bounding box of each secondary feature
+        """
+        path = Path(statedir)
+        path.mkdir(parents=True, exist_ok=True)
+        manifestfile = path / "manifest.json"
+        state = {"primary": dict(), "secondary": dict()}
+        if manifestfile.exists():
+            with open(manifestfile, "r") as file:
+                previous = json.load(file)
+            if previous == parameters:
+                for name in state:
+                    for chunk in path.glob(f"{name}-*.json"):
+                        with open(chunk, "r") as file:
+                            state[name].update(geojson.load(file))
+                return state
+            log.warning(f"The parameters changed, conflating everything")
+            for chunk in path.glob("*-*.json"):
+                chunk.unlink()
+        with open(path / "manifest.tmp", "w") as file:
+            json.dump(parameters, file, indent=4)
+        os.replace(path / "manifest.tmp", manifestfile)
+        return state
+
+    def saveState(self,
+                  statedir: str,
+                  name: str,
+                  previous: dict,
+                  current: dict,
+                  ):
+        """
+        Save part of the state for the next incremental run. It's split
+        into chunks by the start of the hash of each feature, and only
+        the chunks that changed are written, so a small change to the
+        data doesn't rewrite all of it.
+
+        Args:
+            statedir (str): The directory for the saved state
+            name (str): Which part of the state it is
+            previous (dict): The state from the last run
+            current (dict): The state from this run
+        """
+        path = Path(statedir)
+        chunks = dict()
+        for state, index in ((previous, 0), (current, 1)):
+            for key, value in state.items():
+                chunks.setdefault(key[:2], (dict(), dict()))[index][key] = value
+        written = 0
+        for prefix, (old, new) in chunks.items():
+            if old == new:
+                continue
+            chunkfile = path / f"{name}-{prefix}.json"
+            if len(new) == 0:
+                chunkfile.unlink()
+                continue
+            tmpfile = path / f"{name}-{prefix}.tmp"
+            with open(tmpfile, "w") as file:
+                geojson.dump(new, file)
+            os.replace(tmpfile, chunkfile)
+            written += 1
+        log.debug(f"Wrote {written} of {len(chunks)} {name} chunks to {statedir}")
+
+    def conflateIncremental(self,
+                            primarydata: list,
+                            secondarydata: list,
+                            statedir: str,
+                            threshold: float = 10.0,
+                            informal: bool = False,
+                            refdistance: float = 0.0,
+                            sinks: list = None,
+                            ) -> list:
+        """
+        Only conflate the primary features that changed since the last
+        run, or that have a secondary feature near them that was added,
+        changed, or deleted. The results of all the other ones are
+        carried forward from the last run. The hash of every feature,
+        the bounding box of every secondary feature, and the results
+        for each primary feature are saved in the state directory.
+
+        Args:
+            primarydata (list): The primary dataset
+            secondarydata (list): The secondary dataset
+            statedir (str): The directory for the saved state
+            threshold (float): Threshold for distance calculations in meters
+            informal (bool): Whether to dump features in OSM not in external data
+            refdistance (float): If set, features with the same ref within this distance are matched first
+            sinks (list): If set, write the output to these sinks
+
+        Returns:
+            (list):  The conflated output, or the counts for sinks
+        """
+        parameters = {"threshold": threshold, "informal": informal, "refdistance": refdistance}
+        previous = self.loadState(statedir, parameters)
+
+        # The features get updated when they are conflated, so they
+        # have to be hashed first.
+        primaryhashes = [hashFeature(entry) for entry in primarydata]
+        # Features that are exactly the same are numbered, so deleting
+        # one of them is still a change.
+        secondary = dict()
+        numbers = dict()
+        for entry in secondarydata:
+            if entry["geometry"] is None:
+                continue
+            key = hashFeature(entry)
+            numbers[key] = numbers.get(key, -1) + 1
+            secondary[f"{key}-{numbers[key]}"] = list(shape(entry["geometry"]).bounds)
+
+        # All the secondary features that were added, changed, or deleted
+        changed = [bbox for key, bbox in secondary.items() if key not in previous["secondary"]]
+        changed.extend([bbox for key, bbox in previous["secondary"].items() if key not in secondary])
+        index = shapely.STRtree([shapely.box(*bbox) for bbox in changed])
+
+        # Features that are exactly the same can't be told apart, so
+        # they always get conflated.
+        counts = dict()
+        for key in primaryhashes:
+            counts[key] = counts.get(key, 0) + 1
+        degrees = math.degrees(max(threshold, refdistance) / 6378137.0)
+        dirty = list()
+        for position, entry in enumerate(primarydata):
+            key = primaryhashes[position]
+            if key not in previous["primary"] or counts[key] > 1:
+                dirty.append(position)
+                continue
+            if entry["geometry"] is None or len(changed) == 0:
+                continue
+            minx, miny, maxx, maxy = shape(entry["geometry"]).bounds
+            bbox = shapely.box(minx - degrees, miny - degrees, maxx + degrees, maxy + degrees)
+            if len(index.query(bbox)) > 0:
+                dirty.append(position)
+        log.info(f"Conflating {len(dirty)} of {len(primarydata)} primary features")
+
+        results = dict()
+        for position in dirty:
+            results[position] = {"data": list(), "new": list()}
+        subset = [primarydata[position] for position in dirty]
+        for output, feature, position in conflateFeatures(subset, secondarydata, informal, threshold,
+                                                          refdistance=refdistance, cutils=self):
+            results[dirty[position]]["data" if output == 0 else "new"].append(feature)
+
+        # Write everything in the same order as the primary dataset
+        data = list()
+        newdata = list()
+        state = {"primary": dict(), "secondary": secondary}
+        for position, key in enumerate(primaryhashes):
+            if position in results:
+                result = results[position]
+            else:
+                result = previous["primary"][key]
+            if counts[key] == 1:
+                state["primary"][key] = result
+            data.extend(result["data"])
+            newdata.extend(result["new"])
+
+        # The state has to be saved before the sinks can update the tags
+        for name in ("primary", "secondary"):
+            self.saveState(statedir, name, previous[name], state[name])
+
+        if sinks:
+            for output, features in ((0, data), (1, newdata)):
+                writeFeatures(sinks, output, features)
+            return [len(data), len(newdata)]
+        return [data, newdata]
+
+    def makeTiles(self,
+                  primarydata: list,
+                  secondarydata: list,
+                  threshold: float = 10.0,
+                  tilesize: float = 0.5,
+                  ):
+        """
+        Partition the data into a grid of tiles so each one can be
+        conflated independently. Each primary feature is owned by the
+        one tile the center of its bounding box is in. Each tile also
+        gets all the secondary features within the threshold distance
+        of any of the primary features it owns, as a halo around the
+        tile. This is the same set of candidates conflating all the
+        data at once would compare each primary feature with, so the
+        results don't change. The secondary features for a tile are
+        only queried when the tile is used, so only the tiles being
+        conflated are in memory.
+
+        Args:
+            primarydata (list): The primary dataset
+            secondarydata (list): The secondary dataset
+            threshold (float): Threshold for distance calculations in meters
+            tilesize (float): The size of each tile in degrees
+
+        Returns:
+            (list): The primary and secondary features of each tile, one at a time
+        """
+        degrees = math.degrees(threshold / 6378137.0)
+        self.makeIndex(secondarydata)
+        # Conflating a tile in this process replaces the index
+        index = self.index
+        indexed = self.indexed
+        grid = dict()
+        for entry in primarydata:
+            # These never get conflated
+            if entry["geometry"] is None or entry["geometry"]["type"] == "Point":
+                continue
+            minx, miny, maxx, maxy = shape(entry["geometry"]).bounds
+            key = (math.floor(((miny + maxy) / 2) / tilesize), math.floor(((minx + maxx) / 2) / tilesize))
+            if key not in grid:
+                grid[key] = {"primary": list(), "bounds": [minx, miny, maxx, maxy]}
+            tile = grid[key]
+            tile["primary"].append(entry)
+            bounds = tile["bounds"]
+            tile["bounds"] = [min(bounds[0], minx), min(bounds[1], miny), max(bounds[2], maxx), max(bounds[3], maxy)]
+        log.debug(f"Split the data into {len(grid)} tiles")
+
+        for key in sorted(grid):
+            tile = grid.pop(key)
+            minx, miny, maxx, maxy = tile["bounds"]
+            halo = shapely.box(minx - degrees, miny - degrees, maxx + degrees, maxy + degrees)
+            hits = numpy.sort(index.query(halo))
+            yield tile["primary"], [indexed[i] for i in hits]
+
+    def conflateTiles(self,
+                      primarydata: list,
+                      secondarydata: list,
+                      threshold: float = 10.0,
+                      informal: bool = False,
+                      tilesize: float = 0.5,
+                      refdistance: float = 0.0,
+                      sinks: list = None,
+                      workers: int = None,
+                      ) -> list:
+        """
+        Conflate the data one tile at a time, in parallel if there is
+        more than one core. Memory use in each process is bounded by
+        the size of a tile instead of the size of the dataset, so an
+        entire state can be conflated at once. Only a few tiles per
+        process are submitted at a time, and each one is dropped once
+        it's merged into the output.
+
+        Args:
+            primarydata (list): The primary dataset
+            secondarydata (list): The secondary dataset
+            threshold (float): Threshold for distance calculations in meters
+            informal (bool): Whether to dump features in OSM not in external data
+            tilesize (float): The size of each tile in degrees
+            refdistance (float): If set, features with the same ref within this distance are matched first
+            sinks (list): If set, write the output to these sinks as each tile is done
+            workers (int): The number of processes to use, all the cores by default
+
+        Returns:
+            (list):  The conflated output, or the counts for sinks
+        """
+        if workers is None:
+            workers = cores
+        # The halo has to include the features matched by their ref too
+        tiles = self.makeTiles(primarydata, secondarydata, max(threshold, refdistance), tilesize)
+        results = dict()
+        order = list()
+        counts = [0, 0]
+        data = list()
+        newdata = list()
+
+        def merge(index, result):
+            results[index] = result
+            counts[0] += len(result[0])
+            counts[1] += len(result[1])
+            if sinks:
+                flushResults(results, order, sinks, workers)
+            else:
+                # Stitch the tiles back together in order
+                for ready in readyResults(results, order):
+                    data.extend(ready[0])
+                    newdata.extend(ready[1])
+
+        if workers <= 1:
+            for index, tile in enumerate(tiles):
+                order.append(index)
+                merge(index, conflateThread(tile[0], tile[1], informal, threshold,
+                                            refdistance=refdistance, cutils=self))
+        else:
+            window = workers * 2
+            futures = dict()
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                for index, tile in enumerate(tiles):
+                    order.append(index)
+                    future = executor.submit(conflateTile, tile[0], tile[1], informal, threshold,
+                                             refdistance)
+                    futures[future] = index
+                    # Don't queue up the whole dataset in the executor
+                    while len(futures) >= window:
+                        done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done.done:
+                            result, stats = future.result()
+                            mergeReport(stats)
+                            merge(futures.pop(future), result)
+                for future in concurrent.futures.as_completed(futures):
+                    result, stats = future.result()
+                    mergeReport(stats)
+                    merge(futures[future], result)
+
+        if sinks:
+            return counts
+
+        return [data, newdata]
+
+    def scorePairs(self,
+                   primarydata: list,
+                   secondarydata: list,
+                   threshold: float = 10.0,
+                   refdistance: float = 0.0,
+                   ) -> list:
+        """
+        Find the candidates for each primary feature, and score them
+        once. Only the candidates within the threshold are kept, so
+        the table can be used by conflateThread() for any smaller
+        threshold too.
+
+        Args:
+            primarydata (list): The primary dataset
+            secondarydata (list): The secondary dataset
+            threshold (float): The largest threshold for distance calculations in meters
+            refdistance (float): If set, features with the same ref within this distance are matched first
+
+        Returns:
+            (list): The candidates and their scores for each primary feature
+        """
+        self.projectFeatures(primarydata)
+        self.projectFeatures(secondarydata)
+        self.makeIndex(secondarydata)
+
+        table = list()
+        for entry in primarydata:
+            if entry["geometry"] is None or entry["geometry"]["type"] == "Point":
+                table.append(None)
+                continue
+            candidates = list()
+            if refdistance > 0:
+                candidates, scores = self.matchRefs(entry, refdistance)
+            byref = len(candidates) > 0
+            if not byref:
+                candidates = self.queryIndex(entry, threshold)
+                scores = self.scoreCandidates(entry, candidates)
+                # Drop everything conflateThread() would skip at any threshold
+                keep = [index for index in range(len(candidates))
+                        if scores["error"][index] or 0 <= scores["dist"][index] < threshold]
+                candidates = [candidates[index] for index in keep]
+                scores = {key: [value[index] for index in keep] for key, value in scores.items()}
+            table.append({"byref": byref,
+                          "candidates": candidates,
+                          "scores": scores,
+                          "ratios": self.scoreTags(entry, candidates),
+                          })
+
+        return table
+
+    def conflateSweep(self,
+                      primarydata: list,
+                      secondarydata: list,
+                      sweeps: list,
+                      informal: bool = False,
+                      refdistance: float = 0.0,
+                      ) -> list:
+        """
+        Conflate the data with multiple sets of thresholds, to tune
+        them. The candidates are only found and scored once, at the
+        largest distance threshold, and then each set of thresholds
+        is applied to the same table.
+
+        Args:
+            primarydata (list): The primary dataset
+            secondarydata (list): The secondary dataset
+            sweeps (list): Tuples of the distance, angle, slope, and match thresholds
+            informal (bool): Whether to dump features in OSM not in external data
+            refdistance (float): If set, features with the same ref within this distance are matched first
+
+        Returns:
+            (list): The conflated output for each set of thresholds
+        """
+        threshold = max([sweep[0] for sweep in sweeps])
+        table = self.scorePairs(primarydata, secondarydata, threshold, refdistance)
+
+        results = list()
+        for threshold, angle, slope, match in sweeps:
+            log.info(f"Conflating with threshold: {threshold}, angle: {angle}, slope: {slope}, match: {match}")
+            # conflateThread() updates the tags of the primary features,
+            # so each run gets its own copy.
+            primary = [Feature(geometry=entry["geometry"], properties=dict(entry["properties"]))
+                       for entry in primarydata]
+            results.append(conflateThread(primary, secondarydata, informal, threshold,
+                                          refdistance=refdistance, cutils=self,
+                                          angle_threshold=angle, slope_threshold=slope,
+                                          match_threshold=match, table=table))
+
+        return results
 
     def dump(self):
         """
@@ -891,41 +2468,174 @@ class Conflator(object):
         #     for k, v in self.original.items():
         #         print(f"{k}(v{self.versions[k]}) = {v}")
 
+    def cacheName(self,
+                  filespec: str,
+                  cache: str,
+                  keys: list = None,
+                  ) -> Path:
+        """
+        Get the name of the cached features for an input file. The
+        same file read with different keys gets a different cache.
+
+        Args:
+            filespec (str): The input file
+            cache (str): The cache directory
+            keys (list): If set, only the OSM features with one of these tags were read
+
+        Returns:
+            (Path): The path and start of the name of the cache files
+        """
+        path = Path(filespec).resolve()
+        name = hashlib.sha1(json.dumps([str(path), keys]).encode("utf-8")).hexdigest()[:16]
+        return Path(cache) / f"{path.name}-{name}"
+
+    def readCache(self,
+                  filespec: str,
+                  cache: str,
+                  keys: list = None,
+                  ) -> FeatureStore:
+        """
+        Load the cached features for an input file, if it hasn't
+        changed since they were saved. If the size and time of the
+        file are the same it's assumed to be the same. If only the
+        time changed, like when an extract is downloaded again, the
+        hash of the file is checked before the cache is used. Reading
+        the cache never changes it.
+
+        Args:
+            filespec (str): The input file
+            cache (str): The cache directory
+            keys (list): If set, only the OSM features with one of these tags were read
+
+        Returns:
+            (FeatureStore): The cached features, or None if there aren't any
+        """
+        name = self.cacheName(filespec, cache, keys)
+        manifestfile = Path(f"{name}.json")
+        if not manifestfile.exists():
+            return None
+        with open(manifestfile, "r") as file:
+            manifest = json.load(file)
+        stat = os.stat(filespec)
+        if manifest.get("version") != CACHEVERSION or manifest["size"] != stat.st_size:
+            return None
+        if manifest["mtime"] != stat.st_mtime_ns and manifest["sha256"] != hashFile(filespec):
+            return None
+        log.info(f"Using the cached features for {filespec} in {cache}")
+        return FeatureStore.load(name)
+
+    def writeCache(self,
+                   filespec: str,
+                   cache: str,
+                   data: list,
+                   keys: list = None,
+                   ):
+        """
+        Save the features from an input file, and their projected
+        coordinates, so the next run doesn't have to parse the file.
+        The manifest is written last, so a cache that was only partly
+        written is never used.
+
+        Args:
+            filespec (str): The input file
+            cache (str): The cache directory
+            data (list): The features from the file
+            keys (list): If set, only the OSM features with one of these tags were read
+        """
+        Path(cache).mkdir(parents=True, exist_ok=True)
+        name = self.cacheName(filespec, cache, keys)
+        manifestfile = Path(f"{name}.json")
+        if manifestfile.exists():
+            manifestfile.unlink()
+        if isinstance(data, FeatureStore):
+            store = data
+        else:
+            store = FeatureStore.fromFeatures(data)
+        store.project(getTransformer())
+        store.save(name)
+        stat = os.stat(filespec)
+        manifest = {"file": str(Path(filespec).resolve()),
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "sha256": hashFile(filespec),
+                    "keys": keys,
+                    "version": CACHEVERSION,
+                    }
+        with open(f"{name}.tmp", "w") as file:
+            json.dump(manifest, file, indent=4)
+        os.replace(f"{name}.tmp", manifestfile)
+        log.debug(f"Cached the features for {filespec} in {name}")
+
     def parseFile(self,
                 filespec: str,
+                store: bool = False,
+                keys: list = None,
+                cache: str = None,
                 ) ->list:
         """
         Parse the input file based on it's format.
 
         Args:
             filespec (str): The file to parse
+            store (bool): Whether to put the data in a FeatureStore to use less memory
+            keys (list): If set, only read the OSM features with one of these tags
+            cache (str): If set, reuse the features cached in this directory, or cache them
 
         Returns:
-            (list): The parsed data from the file
+            (list): The parsed data from the file, which is always a FeatureStore if it's cached
         """
-        path = Path(filespec)
-        data = list()
-        if path.suffix == '.geojson':
-            # FIXME: This should also work for any GeoJson file, not
-            # only  ones, but this has yet to be tested.
-            log.debug(f"Parsing GeoJson files {path}")
-            file = open(path, 'r')
-            features = geojson.load(file)
-            data = features['features']
-        elif path.suffix == '.osm':
-            log.debug(f"Parsing OSM XML files {path}")
-            osmfile = OsmFile()
-            data = osmfile.loadFile(path)
-        elif path.suffix == ".csv":
-            log.debug(f"Parsing csv files {path}")
-            odk = ODKParsers()
-            for entry in odk.CSVparser(path):
-                data.append(odk.createEntry(entry))
-        elif path.suffix == ".json":
-            log.debug(f"Parsing json files {path}")
-            odk  = ODKParsers()
-            for entry in odk.JSONparser(path):
-                data.append(odk.createEntry(entry))
+        if cache:
+            with StageTimer("parse"):
+                data = self.readCache(filespec, cache, keys)
+            if data is not None:
+                # The cache is already a store, and the features are
+                # only made as they're used.
+                return data
+
+        with StageTimer("parse"):
+            path = Path(filespec)
+            data = list()
+            if path.suffix == '.geojson':
+                # FIXME: This should also work for any GeoJson file, not
+                # only  ones, but this has yet to be tested.
+                log.debug(f"Parsing GeoJson files {path}")
+                file = open(path, 'r')
+                features = geojson.load(file)
+                data = features['features']
+            elif path.suffix in ('.osm', '.pbf'):
+                log.debug(f"Parsing OSM files {path}")
+                osmfile = OsmFile()
+                if store:
+                    # The features go straight into the store as they're
+                    # read, so they're never all in memory at once.
+                    if path.suffix == '.pbf':
+                        data = FeatureStore.fromFeatures(osmfile.readPBF(path, keys))
+                    else:
+                        data = FeatureStore.fromFeatures(osmfile.readFeatures(path, keys))
+                    if len(data) == 0:
+                        log.warning("No data in this instance")
+                        data = False
+                else:
+                    data = osmfile.loadFile(path, keys)
+            elif path.suffix == ".csv":
+                log.debug(f"Parsing csv files {path}")
+                odk = parsers.ODKParsers()
+                for entry in odk.CSVparser(path):
+                    data.append(odk.createEntry(entry))
+            elif path.suffix == ".json":
+                log.debug(f"Parsing json files {path}")
+                odk = parsers.ODKParsers()
+                for entry in odk.JSONparser(path):
+                    data.append(odk.createEntry(entry))
+
+        if type(data) != bool:
+            if store:
+                if not isinstance(data, FeatureStore):
+                    data = FeatureStore.fromFeatures(data)
+                log.debug(f"The FeatureStore for {path} uses {data.nbytes} bytes")
+            self.projectFeatures(data)
+            if cache:
+                self.writeCache(filespec, cache, data, keys)
         return data
 
     def conflateDB(self,
@@ -1002,17 +2712,19 @@ class Conflator(object):
     def writeGeoJson(self,
                  data: dict,
                  filespec: str,
+                 workers: int = None,
                  ):
         """
-        Write the data to a GeoJson file.
+        Write the data to a GeoJson file, one feature per line. The
+        features are converted in blocks by a process pool.
 
         Args:
             data (dict): The list of GeoJson features
             filespec (str): The output file name
+            workers (int): The number of worker processes, all the cores by default
         """
-        file = open(filespec, "w")
-        fc = FeatureCollection(data)
-        geojson.dump(fc, file, indent=4)
+        with GeoJsonSink(filespec) as sink:
+            sink.writeAll(data, workers)
 
     def osmToFeature(self,
                      osm: dict(),
@@ -1078,12 +2790,34 @@ osm-rawdata project on pypi.org or https://github.com/hotosm/osm-rawdata.
     parser.add_argument("-q", "--query", help="Custom SQL when using a database")
     parser.add_argument("-c", "--config", default="highway", help="The config file for the SQL query")
     parser.add_argument("-p", "--primary", required=True, help="The primary dataset")
-    parser.add_argument("-t", "--threshold", default=2.0, help="Threshold for distance calculations")
+    parser.add_argument("-t", "--threshold", default=7.0, help="Threshold for distance calculations")
     parser.add_argument("-i", "--informal", help="Dump features not in official sources")
     parser.add_argument("-o", "--outfile", default="conflated.geojson", help="Output file from the conflation")
     parser.add_argument("-b", "--boundary", help="Optional boundary polygon to limit the data size")
+    parser.add_argument("--tilesize", help="Conflate in tiles of this size in degrees, for very large datasets")
+    parser.add_argument("--refdistance", default=0.0, help="Match features with the same ref within this distance first")
+    parser.add_argument("--report", help="Write the time spent in each stage and the counters to this JSON file")
+    parser.add_argument("--store", action="store_true", help="Keep the datasets in a compact columnar store to use less memory")
+    parser.add_argument("--incremental", help="Only conflate what changed since the results saved in this directory")
+    parser.add_argument("--checkpoint", help="Save each batch in this directory, and skip the ones already done, not with --tilesize")
+    parser.add_argument("--workers", help="The number of processes to conflate with, all the cores by default")
+    parser.add_argument("--cache", help="Cache the parsed datasets in this directory, so the next run doesn't parse them again")
+    parser.add_argument("--keys", help="Only read the OSM features with one of these comma separated tags, like highway")
+    parser.add_argument("--batchsize", default=1000, help="The number of primary features in each batch")
+    parser.add_argument("--format", default="geojson", choices=["geojson", "geojsonseq"],
+                        help="The format of the GeoJson output files")
+    parser.add_argument("--osmformat", default="osm", choices=["osm", "pbf", "osc"],
+                        help="The format of the OSM output file, osc only has the changed tags")
+    parser.add_argument("--sweep", action="append",
+                        help="Conflate with these thresholds: distance,angle,slope,match. May be used more than once")
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
 
     args = parser.parse_args()
+
+    if args.profile:
+        startProfile(args.profile)
+
     indata = None
     source = None
 
@@ -1108,6 +2842,11 @@ osm-rawdata project on pypi.org or https://github.com/hotosm/osm-rawdata.
         log.error("You must supply a either a conig file or custom SQL!")
         quit()
 
+    if args.checkpoint and args.tilesize:
+        parser.print_help()
+        log.error("A checkpoint can't be used with tiles!")
+        quit()
+
     outfile = None
     if args.outfile:
         outfile = args.outfile
@@ -1121,21 +2860,71 @@ osm-rawdata project on pypi.org or https://github.com/hotosm/osm-rawdata.
     # if args.primary[:3].lower() == "pg:":
     #     await conflate.initInputDB(args.config, args.secondary[3:])
 
-    data = conflate.conflateData(args.primary, args.secondary, float(args.threshold), args.informal)
+    tilesize = None
+    if args.tilesize:
+        tilesize = float(args.tilesize)
+    keys = None
+    if args.keys:
+        keys = args.keys.split(',')
+    workers = None
+    if args.workers:
+        workers = int(args.workers)
+    if args.sweep:
+        sweeps = list()
+        for sweep in args.sweep:
+            threshold, angle, slope, match = sweep.split(',')
+            sweeps.append((float(threshold), float(angle), float(slope), int(match)))
+        results = conflate.conflateData(args.primary, args.secondary, informal=args.informal,
+                                        refdistance=float(args.refdistance), sweeps=sweeps, keys=keys,
+                                        cache=args.cache)
+        # Each set of thresholds gets it's own output files
+        for sweep, data in zip(sweeps, results):
+            suffix = f"-{sweep[0]}-{sweep[1]}-{sweep[2]}-{sweep[3]}"
+            jsonout = args.outfile.replace(".geojson", f"{suffix}-out.geojson")
+            conflate.writeGeoJson(data[0], jsonout)
+            log.info(f"Wrote {jsonout}")
+            jsonout = args.outfile.replace(".geojson", f"{suffix}-new.geojson")
+            conflate.writeGeoJson(data[1], jsonout)
+            log.info(f"Wrote {jsonout}")
+        if args.report:
+            writeReport(args.report)
+        quit()
 
-    # breakpoint()
+    # The output is written as it's produced instead of at the end.
     # path = Path(args.outfile)
-    osmout  = args.outfile.replace(".geojson", "-out.osm")
-    osm = OsmFile()
-    osm.writeOSM(data[0], osmout)
-    log.info(f"Wrote {osmout}")
-
-    jsonout = args.outfile.replace(".geojson", "-out.geojson")
-    conflate.writeGeoJson(data[0], jsonout)
-    log.info(f"Wrote {jsonout}")
-
-    jsonout = args.outfile.replace(".geojson", "-new.geojson")
-    conflate.writeGeoJson(data[1], jsonout)
+    if args.format == "geojsonseq":
+        suffix = ".geojsonl"
+        JsonSink = GeoJsonSeqSink
+    else:
+        suffix = ".geojson"
+        JsonSink = GeoJsonSink
+    suffixes = {"osm": "-out.osm", "pbf": "-out.osm.pbf", "osc": "-out.osc"}
+    osmout  = args.outfile.replace(".geojson", suffixes[args.osmformat])
+    jsonout = args.outfile.replace(".geojson", f"-out{suffix}")
+    newout = args.outfile.replace(".geojson", f"-new{suffix}")
+    # The OSM sink removes the OSM attributes from a copy of the tags,
+    # so the GeoJson file still has them.
+    if args.osmformat == "pbf":
+        osmsink = PbfSink(osmout)
+    elif args.osmformat == "osc":
+        if Path(args.secondary).suffix not in (".osm", ".pbf"):
+            log.error("The secondary dataset has to be an OSM file for osmChange output!")
+            quit()
+        osmsink = OsmChangeSink(osmout, args.secondary)
+    else:
+        osmsink = OsmSink(osmout)
+    sinks = [[osmsink, JsonSink(jsonout)], [JsonSink(newout)]]
+    try:
+        conflate.conflateData(args.primary, args.secondary, float(args.threshold), args.informal, tilesize,
+                              float(args.refdistance), sinks=sinks, checkpoint=args.checkpoint,
+                              batchsize=int(args.batchsize), incremental=args.incremental, store=args.store,
+                              keys=keys, cache=args.cache, workers=workers)
+    finally:
+        for sink in sinks[0] + sinks[1]:
+            sink.close()
+
+    if args.report:
+        writeReport(args.report)
 
 if __name__ == "__main__":
     """This is just a hook so this file can be run standlone during development."""
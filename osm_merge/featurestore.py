@@ -0,0 +1,726 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import pickle
+import sys
+from array import array
+from multiprocessing.shared_memory import SharedMemory
+from geojson import Feature
+import shapely
+from shapely.geometry import shape
+import numpy
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+# The geometry types that are stored as coordinates. Anything else
+# is kept as it is. A feature without a geometry is -1.
+GEOMTYPES = ["Point", "LineString", "Polygon", "MultiPoint", "MultiLineString"]
+OTHER = len(GEOMTYPES)
+
+# The arrays that get saved to disk, each in it's own file so they can
+# be memory mapped.
+ARRAYS = ("types", "coords", "parts", "offsets", "tagkeys", "tagvalues", "tagoffsets")
+
+class StoredProperties(dict):
+    """
+    The tags of a feature that was made from a FeatureStore. The store
+    is read-only, so the first time a tag is changed the store keeps
+    this dict, and uses it for the feature from then on. Changing a
+    value in place, like appending to the refs, is only kept if a tag
+    was changed too.
+    """
+    def __init__(self,
+                 store: "FeatureStore",
+                 position: int,
+                 tags: dict,
+                 ):
+        """
+        Args:
+            store (FeatureStore): The store the feature is in
+            position (int): The position of the feature in the store
+            tags (dict): The tags of the feature
+
+        Returns:
+            (StoredProperties): An instance of this object
+        """
+        super().__init__(tags)
+        self.store = store
+        self.position = position
+
+    def changed(self):
+        """Keep these tags in the store, since they've been changed."""
+        self.store.changed[self.position] = self
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed()
+
+    def __ior__(self, other):
+        super().__ior__(other)
+        self.changed()
+        return self
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.changed()
+
+    def setdefault(self, key, default=None):
+        self.changed()
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self.changed()
+        return super().pop(*args)
+
+    def popitem(self):
+        self.changed()
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self.changed()
+
+    def __reduce__(self):
+        # When sent to another process, don't send the entire store too
+        return (dict, (dict(self),))
+
+class StoredFeature(Feature):
+    """
+    A feature that was made from a FeatureStore. Changing the tags
+    changes them in the store too, but changing the geometry doesn't.
+    """
+    def __init__(self,
+                 store: "FeatureStore",
+                 position: int,
+                 geometry: dict,
+                 properties: dict,
+                 ):
+        """
+        Args:
+            store (FeatureStore): The store the feature is in
+            position (int): The position of the feature in the store
+            geometry (dict): The geometry of the feature
+            properties (dict): The tags of the feature
+
+        Returns:
+            (StoredFeature): An instance of this object
+        """
+        super().__init__(geometry=geometry)
+        # The type is the name of the class by default
+        self["type"] = "Feature"
+        # Feature replaces empty properties with a new dict
+        self["properties"] = properties
+        # GeoJson objects make attributes into keys, so these have to
+        # be set directly.
+        object.__setattr__(self, "store", store)
+        object.__setattr__(self, "position", position)
+
+    def __reduce__(self):
+        # When sent to another process, don't send the entire store too
+        return (Feature, (), None, None, iter(self.items()))
+
+class FeatureView(object):
+    """Some of the features in a FeatureStore, without copying them."""
+
+    def __init__(self,
+                 store: "FeatureStore",
+                 positions: numpy.ndarray,
+                 ):
+        """
+        Args:
+            store (FeatureStore): The store the features are in
+            positions (numpy.ndarray): The positions of the features in the store
+
+        Returns:
+            (FeatureView): An instance of this object
+        """
+        self.store = store
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.store[int(position)] for position in self.positions[index]]
+        return self.store[int(self.positions[index])]
+
+    def __iter__(self):
+        for position in self.positions:
+            yield self.store[int(position)]
+
+class FeatureStore(object):
+    """
+    A compact columnar store for a dataset. All the coordinates are in
+    one array, with the offsets of each part and each feature in two
+    more. The tag keys and values are interned, so each feature only
+    has an array of key and value IDs. Features are only made when they
+    are accessed, so the dataset can be used like a list of them.
+    """
+
+    def __init__(self):
+        """
+        Make an empty store. Features get added with append(), and
+        no more can be added once it's accessed. Only the tags can be
+        changed after that.
+
+        Returns:
+            (FeatureStore): An instance of this object
+        """
+        self.count = 0
+        # These are compact arrays while adding features, so the
+        # dataset never has to be in memory as python objects.
+        self.types = array("b")
+        self.coords = array("d")
+        self.parts = array("q", [0])
+        self.offsets = array("q", [0])
+        self.other = dict()
+        self.keys = list()
+        self.values = list()
+        self.tagkeys = array("i")
+        self.tagvalues = array("i")
+        self.tagoffsets = array("q", [0])
+        # The tags that have been changed since the features were added
+        self.changed = dict()
+        # These are only needed while adding features
+        self.keyids = dict()
+        self.valueids = dict()
+        self.finished = False
+        self.projected = None
+        self.projectedother = dict()
+
+    @classmethod
+    def fromFeatures(cls,
+                     features: list,
+                     ) -> "FeatureStore":
+        """
+        Make a store from a list of features. They can come from a
+        generator, so they don't all have to be made at once.
+
+        Args:
+            features (list): The features to store
+
+        Returns:
+            (FeatureStore): The store with all the features
+        """
+        store = cls()
+        for feature in features:
+            store.append(feature)
+        store.finish()
+        return store
+
+    def intern(self,
+               value,
+               ) -> int:
+        """
+        Get the ID of a tag value, adding it if it's new. Values that
+        can't be hashed, like lists, are never shared. Lists of integers,
+        like the node references of a way, are kept as an array.
+
+        Args:
+            value: The tag value
+
+        Returns:
+            (int): The ID of the value
+        """
+        try:
+            key = (type(value), value)
+            valueid = self.valueids.get(key)
+        except TypeError:
+            key = None
+            valueid = None
+        if valueid is None:
+            valueid = len(self.values)
+            if type(value) == str:
+                value = sys.intern(value)
+            elif type(value) == list and len(value) > 0 and all(type(item) == int for item in value):
+                try:
+                    value = numpy.array(value, dtype=numpy.int64)
+                except OverflowError:
+                    pass
+            self.values.append(value)
+            if key is not None:
+                self.valueids[key] = valueid
+        return valueid
+
+    def append(self,
+               feature: Feature,
+               ):
+        """
+        Add a feature to the store.
+
+        Args:
+            feature (Feature): The feature to add
+        """
+        if self.finished:
+            raise ValueError("Features can't be added to a FeatureStore once it's been used")
+        geometry = feature["geometry"]
+        if geometry is None:
+            self.types.append(-1)
+        elif geometry["type"] in GEOMTYPES:
+            gtype = GEOMTYPES.index(geometry["type"])
+            coordinates = geometry["coordinates"]
+            if gtype == 0:
+                parts = [[coordinates]]
+            elif gtype in (1, 3):
+                parts = [coordinates]
+            else:
+                parts = coordinates
+            if any(len(coord) != 2 for part in parts for coord in part):
+                # Only 2D coordinates go in the arrays
+                self.types.append(OTHER)
+                self.other[self.count] = geometry
+            else:
+                self.types.append(gtype)
+                for part in parts:
+                    for coord in part:
+                        self.coords.extend(coord)
+                    self.parts.append(len(self.coords) // 2)
+        else:
+            self.types.append(OTHER)
+            self.other[self.count] = geometry
+        self.offsets.append(len(self.parts) - 1)
+
+        for key, value in feature["properties"].items():
+            keyid = self.keyids.get(key)
+            if keyid is None:
+                keyid = len(self.keys)
+                self.keys.append(sys.intern(key))
+                self.keyids[key] = keyid
+            self.tagkeys.append(keyid)
+            self.tagvalues.append(self.intern(value))
+        self.tagoffsets.append(len(self.tagkeys))
+        self.count += 1
+
+    def finish(self):
+        """
+        Convert everything to arrays. This happens automatically the
+        first time the store is accessed.
+        """
+        if self.finished:
+            return
+        self.types = numpy.array(self.types, dtype=numpy.int8)
+        self.coords = numpy.array(self.coords, dtype=numpy.float64).reshape(-1, 2)
+        self.parts = numpy.array(self.parts, dtype=numpy.int64)
+        self.offsets = numpy.array(self.offsets, dtype=numpy.int64)
+        self.tagkeys = numpy.array(self.tagkeys, dtype=numpy.int32)
+        self.tagvalues = numpy.array(self.tagvalues, dtype=numpy.int32)
+        self.tagoffsets = numpy.array(self.tagoffsets, dtype=numpy.int64)
+        self.keyids = None
+        self.valueids = None
+        self.finished = True
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Get the size of the arrays.
+
+        Returns:
+            (int): The number of bytes used by the arrays
+        """
+        self.finish()
+        return sum([getattr(self, name).nbytes for name in ARRAYS])
+
+    def save(self,
+             filespec: str,
+             ):
+        """
+        Save the store, so it can be loaded again without parsing the
+        original file. The projected coordinates are saved too if
+        the store has been projected.
+
+        Args:
+            filespec (str): The path and start of the name of the files
+        """
+        self.finish()
+        for name in ARRAYS:
+            numpy.save(f"{filespec}.{name}.npy", getattr(self, name))
+        if self.projected is not None:
+            numpy.save(f"{filespec}.projected.npy", self.projected)
+        elif os.path.exists(f"{filespec}.projected.npy"):
+            os.remove(f"{filespec}.projected.npy")
+        # The tag keys and values, and the geometries that aren't in
+        # the arrays, are python objects.
+        with open(f"{filespec}.tables.pickle", "wb") as file:
+            pickle.dump({"count": self.count,
+                         "keys": self.keys,
+                         "values": self.values,
+                         "other": self.other,
+                         "projectedother": self.projectedother,
+                         "changed": {position: dict(tags) for position, tags in self.changed.items()},
+                         }, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls,
+             filespec: str,
+             mmap_mode: str = "r",
+             ) -> "FeatureStore":
+        """
+        Load a saved store. The arrays are memory mapped read-only by
+        default, so only the parts that get used are read.
+
+        Args:
+            filespec (str): The path and start of the name of the files
+            mmap_mode (str): How to memory map the arrays, or None to read them
+
+        Returns:
+            (FeatureStore): The store
+        """
+        store = cls()
+        with open(f"{filespec}.tables.pickle", "rb") as file:
+            tables = pickle.load(file)
+        store.count = tables["count"]
+        store.keys = tables["keys"]
+        store.values = tables["values"]
+        store.other = tables["other"]
+        for position, tags in tables.get("changed", dict()).items():
+            store.changed[position] = StoredProperties(store, position, tags)
+        # A memmap is much slower to index than an array that uses
+        # the same memory.
+        for name in ARRAYS:
+            setattr(store, name, numpy.load(f"{filespec}.{name}.npy", mmap_mode=mmap_mode).view(numpy.ndarray))
+        if os.path.exists(f"{filespec}.projected.npy"):
+            store.projected = numpy.load(f"{filespec}.projected.npy", mmap_mode=mmap_mode).view(numpy.ndarray)
+            store.projectedother = tables["projectedother"]
+        store.keyids = None
+        store.valueids = None
+        store.finished = True
+        return store
+
+    def share(self) -> tuple:
+        """
+        Copy the arrays, and the projected coordinates, into a block of
+        shared memory, so other processes can use the store without
+        each one getting a copy. Only the tables of tag keys and values
+        are sent to each process.
+
+        Returns:
+            (SharedMemory): The shared memory block, which the caller has to unlink
+            (dict): Where each array is, and the tables, for attach()
+        """
+        self.finish()
+        names = list(ARRAYS)
+        if self.projected is not None:
+            names.append("projected")
+        arrays = dict()
+        size = 0
+        for name in names:
+            data = numpy.ascontiguousarray(getattr(self, name))
+            arrays[name] = (size, data.dtype.str, data.shape)
+            # Keep every array aligned
+            size += (data.nbytes + 7) // 8 * 8
+        shm = SharedMemory(create=True, size=max(size, 8))
+        for name in names:
+            offset, dtype, shape = arrays[name]
+            numpy.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = getattr(self, name)
+        layout = {"arrays": arrays,
+                  "tables": pickle.dumps({"count": self.count,
+                                          "keys": self.keys,
+                                          "values": self.values,
+                                          "other": self.other,
+                                          "projectedother": self.projectedother,
+                                          "changed": {position: dict(tags) for position, tags in self.changed.items()},
+                                          }, protocol=pickle.HIGHEST_PROTOCOL),
+                  }
+        return shm, layout
+
+    @classmethod
+    def attach(cls,
+               name: str,
+               layout: dict,
+               ) -> tuple:
+        """
+        Use a store shared by another process. The arrays use the
+        shared memory in place, and features are only made when
+        they're accessed.
+
+        Args:
+            name (str): The name of the shared memory block
+            layout (dict): Where each array is, from share()
+
+        Returns:
+            (SharedMemory): The shared memory block, which has to stay open
+            (FeatureStore): The store
+        """
+        if sys.version_info >= (3, 13):
+            # Only the process that made it should unlink it
+            shm = SharedMemory(name=name, track=False)
+        else:
+            shm = SharedMemory(name=name)
+        store = cls()
+        tables = pickle.loads(layout["tables"])
+        store.count = tables["count"]
+        store.keys = tables["keys"]
+        store.values = tables["values"]
+        store.other = tables["other"]
+        for position, tags in tables["changed"].items():
+            store.changed[position] = StoredProperties(store, position, tags)
+        for field, (offset, dtype, dims) in layout["arrays"].items():
+            setattr(store, field, numpy.ndarray(dims, dtype=dtype, buffer=shm.buf, offset=offset))
+        if store.projected is not None:
+            store.projectedother = tables["projectedother"]
+        store.keyids = None
+        store.valueids = None
+        store.finished = True
+        return shm, store
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("FeatureStore index out of range")
+        return StoredFeature(self, index, self.getGeometry(index), self.getProperties(index))
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield self[position]
+
+    def getCoordinates(self,
+                       position: int,
+                       ) -> list:
+        """
+        Get the coordinates of each part of a feature.
+
+        Args:
+            position (int): The position of the feature in the store
+
+        Returns:
+            (list): An array of coordinates for each part
+        """
+        self.finish()
+        start = self.offsets[position]
+        end = self.offsets[position + 1]
+        return [self.coords[self.parts[part]:self.parts[part + 1]] for part in range(start, end)]
+
+    def getGeometry(self,
+                    position: int,
+                    ) -> dict:
+        """
+        Get the geometry of a feature as GeoJson.
+
+        Args:
+            position (int): The position of the feature in the store
+
+        Returns:
+            (dict): The geometry, or None if it doesn't have one
+        """
+        self.finish()
+        gtype = int(self.types[position])
+        if gtype < 0:
+            return None
+        if gtype == OTHER:
+            return self.other[position]
+        parts = [part.tolist() for part in self.getCoordinates(position)]
+        if gtype == 0:
+            coordinates = parts[0][0]
+        elif gtype in (1, 3):
+            coordinates = parts[0]
+        else:
+            coordinates = parts
+        return {"coordinates": coordinates, "type": GEOMTYPES[gtype]}
+
+    def getProperties(self,
+                      position: int,
+                      ) -> dict:
+        """
+        Get all the tags of a feature.
+
+        Args:
+            position (int): The position of the feature in the store
+
+        Returns:
+            (dict): The tags, which can be changed
+        """
+        self.finish()
+        changed = self.changed.get(position)
+        if changed is not None:
+            return changed
+        start = self.tagoffsets[position]
+        end = self.tagoffsets[position + 1]
+        return StoredProperties(self, position, {self.keys[key]: self.getValue(value)
+                                                 for key, value in zip(self.tagkeys[start:end],
+                                                                       self.tagvalues[start:end])})
+
+    def getValue(self,
+                 valueid: int,
+                 ):
+        """
+        Get a tag value. Changing it doesn't change the store.
+
+        Args:
+            valueid (int): The ID of the value
+
+        Returns:
+            (any): The value
+        """
+        value = self.values[valueid]
+        if type(value) == numpy.ndarray:
+            return value.tolist()
+        return value
+
+    def getTag(self,
+               position: int,
+               key: str,
+               ):
+        """
+        Get the value of one tag of a feature.
+
+        Args:
+            position (int): The position of the feature in the store
+            key (str): The tag to get
+
+        Returns:
+            (any): The value of the tag, or None if it doesn't have it
+        """
+        self.finish()
+        changed = self.changed.get(position)
+        if changed is not None:
+            return changed.get(key)
+        if key not in self.keys:
+            return None
+        keyid = self.keys.index(key)
+        start = self.tagoffsets[position]
+        end = self.tagoffsets[position + 1]
+        found = numpy.nonzero(self.tagkeys[start:end] == keyid)[0]
+        if len(found) == 0:
+            return None
+        return self.getValue(self.tagvalues[start + found[0]])
+
+    def getShape(self,
+                 position: int,
+                 coords: numpy.ndarray = None,
+                 ):
+        """
+        Get the geometry of a feature as a shapely geometry, without
+        making the GeoJson first.
+
+        Args:
+            position (int): The position of the feature in the store
+            coords (numpy.ndarray): Use these coordinates instead, like the projected ones
+
+        Returns:
+            (BaseGeometry): The geometry
+        """
+        self.finish()
+        gtype = int(self.types[position])
+        if gtype < 0:
+            return None
+        if gtype == OTHER:
+            return shape(self.other[position])
+        if coords is None:
+            coords = self.coords
+        start = self.offsets[position]
+        end = self.offsets[position + 1]
+        parts = [coords[self.parts[part]:self.parts[part + 1]] for part in range(start, end)]
+        if gtype == 0:
+            return shapely.Point(parts[0][0])
+        elif gtype == 1:
+            return shapely.LineString(parts[0])
+        elif gtype == 2:
+            return shapely.Polygon(parts[0], parts[1:])
+        elif gtype == 3:
+            return shapely.MultiPoint(parts[0])
+        return shapely.MultiLineString(parts)
+
+    def getBounds(self) -> numpy.ndarray:
+        """
+        Get the bounding box of every feature, without making any
+        geometries. Features without coordinates get NaN.
+
+        Returns:
+            (numpy.ndarray): The minx, miny, maxx, maxy of each feature
+        """
+        self.finish()
+        bounds = numpy.full((self.count, 4), numpy.nan)
+        starts = self.parts[self.offsets[:-1]]
+        ends = self.parts[self.offsets[1:]]
+        found = ends > starts
+        if len(self.coords) > 0 and found.any():
+            # reduceat() needs the starts of all the non-empty features
+            indexes = starts[found]
+            bounds[found, 0] = numpy.minimum.reduceat(self.coords[:, 0], indexes)
+            bounds[found, 1] = numpy.minimum.reduceat(self.coords[:, 1], indexes)
+            bounds[found, 2] = numpy.maximum.reduceat(self.coords[:, 0], indexes)
+            bounds[found, 3] = numpy.maximum.reduceat(self.coords[:, 1], indexes)
+        for position, geometry in self.other.items():
+            bounds[position] = shape(geometry).bounds
+        return bounds
+
+    def project(self,
+                transformer,
+                ):
+        """
+        Project all the coordinates at once. The projected geometry of
+        each feature is made by getProjected() when it's needed.
+
+        Args:
+            transformer (pyproj.Transformer): The transformer to use
+        """
+        self.finish()
+        if self.projected is not None:
+            return
+        x, y = transformer.transform(self.coords[:, 0], self.coords[:, 1])
+        self.projected = numpy.column_stack([x, y])
+        # Geometries that aren't in the arrays get projected by shapely
+        self.projectedother = dict()
+        for position, geometry in self.other.items():
+            self.projectedother[position] = shapely.transform(shape(geometry),
+                lambda coords: numpy.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+
+    def getProjected(self,
+                     position: int,
+                     ):
+        """
+        Get the projected geometry of a feature.
+
+        Args:
+            position (int): The position of the feature in the store
+
+        Returns:
+            (BaseGeometry): The projected geometry
+        """
+        if self.projected is None:
+            return None
+        if int(self.types[position]) == OTHER:
+            return self.projectedother[position]
+        return self.getShape(position, self.projected)
+
+    def view(self,
+             positions,
+             ) -> FeatureView:
+        """
+        Get some of the features without copying them.
+
+        Args:
+            positions (list): The positions of the features
+
+        Returns:
+            (FeatureView): The features
+        """
+        return FeatureView(self, numpy.asarray(positions, dtype=numpy.int64))
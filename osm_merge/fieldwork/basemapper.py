@@ -31,7 +31,7 @@ from typing import Optional, Tuple, Union
 
 import geojson
 import mercantile
-from cpuinfo import get_cpu_info
+from osm_merge.lazyload import cpuCount
 from pySmartDL import SmartDL
 from shapely.geometry import shape
 from shapely.ops import unary_union
@@ -40,6 +40,7 @@ from urllib.parse import urlparse
 
 from osm_merge.fieldwork.sqlite import DataFile, MapTile
 from osm_merge.yamlfile import YamlFile
+from osm_merge.profiler import startProfile
 
 import osm_merge as om
 rootdir = om.__path__[0]
@@ -254,8 +255,7 @@ def dlthread(dest: str, mirrors: list[dict], tiles: list[tuple]) -> None:
     Path(dest).mkdir(parents=True, exist_ok=True)
 
     log.info(f"Downloading {len(tiles)} tiles in thread {threading.get_ident()} to {dest}")
-    info = get_cpu_info()
-    cores = int(info["count"])
+    cores = cpuCount()
     # http = urllib3.PoolManager(maxsize=cores)
     http = urllib3.PoolManager()
     host = urlparse(mirrors[0]["url"])
@@ -385,8 +385,7 @@ class BaseMapper(object):
         Returns:
             int: The total number of map tiles downloaded.
         """
-        info = get_cpu_info()
-        cores = info["count"]/2
+        cores = cpuCount()/2
 
         self.tiles = list(mercantile.tiles(self.bbox[0], self.bbox[1], self.bbox[2], self.bbox[3], zoom))
         total = len(self.tiles)
@@ -663,8 +662,13 @@ def main():
         choices=["esri", "bing", "topo", "usgs", "google", "oam"],
         help="Imagery source",
     )
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
     args = parser.parse_args()
 
+    if args.profile:
+        startProfile(args.profile)
+
     if not args.boundary:
         log.error("You need to specify a boundary! (file or bbox)")
         parser.print_help()
@@ -25,6 +25,7 @@ import magic
 
 from osm_merge.fieldwork.parsers import ODKParsers
 from osm_merge.osmfile import OsmFile
+from osm_merge.profiler import startProfile
 
 # Instantiate logger
 log = logging.getLogger(__name__)
@@ -41,8 +42,13 @@ def main():
     parser.add_argument("-i", "--infile", required=True, help="The input file")
     parser.add_argument("-o","--outfile", default='out.osm',
                         help='The output file for JOSM')
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
     args = parser.parse_args()
 
+    if args.profile:
+        startProfile(args.profile)
+
     # if verbose, dump to the terminal
     if args.verbose is not None:
         logging.basicConfig(
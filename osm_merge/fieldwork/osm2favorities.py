@@ -26,6 +26,7 @@ import gpxpy.gpx
 import shapely
 from lxml import etree
 from shapely.geometry import shape
+from osm_merge.profiler import startProfile
 
 # Instantiate logger
 log_level = os.getenv("LOG_LEVEL", default="INFO")
@@ -61,8 +62,13 @@ def main():
     parser = argparse.ArgumentParser(description="convert GeoJson to a GPX favorites file for Osmand")
     parser.add_argument("-v", "--verbose", action="store_true", help="verbose output")
     parser.add_argument("-i", "--infile", required=True, help="The data extract")
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
     args = parser.parse_args()
 
+    if args.profile:
+        startProfile(args.profile)
+
     # if verbose, dump to the terminal.
     if args.verbose is not None:
         logging.basicConfig(
@@ -16,6 +16,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
     
 import argparse
+import json
 import logging
 import sys
 import os
@@ -34,6 +35,158 @@ import asyncio
 # Instantiate logger
 log = logging.getLogger(__name__)
 
+# The table each type of geometry is imported into
+tables = {"Point": "nodes",
+          "MultiPoint": "nodes",
+          "LineString": "ways_line",
+          "MultiLineString": "ways_line",
+          "Polygon": "ways_poly",
+          "MultiPolygon": "ways_poly",
+          }
+
+def readFeatures(filespec: str,
+                 blocksize: int = 1024 * 1024,
+                 ):
+    """
+    Read the features from a GeoJson file one at a time, so the whole
+    file is never in memory. This works for a FeatureCollection, and
+    for newline delimited GeoJson. Only the features array is read
+    incrementally, any other members are small.
+
+    Args:
+        filespec (str): The GeoJson file
+        blocksize (int): The number of characters to read at a time
+
+    Returns:
+        (dict): Each feature in the file
+    """
+    decoder = json.JSONDecoder()
+    # The record separator is used by GeoJson text sequences
+    whitespace = " \t\r\n\x1e"
+    with open(filespec, "r", encoding="utf-8") as file:
+        buffer = str()
+        pos = 0
+        eof = False
+
+        def fill(size: int = blocksize) -> bool:
+            # Read more of the file, and drop what's already been used
+            nonlocal buffer, pos, eof
+            block = file.read(size)
+            eof = len(block) == 0
+            buffer = buffer[pos:] + block
+            pos = 0
+            return not eof
+
+        def peek(separators: str = "") -> str:
+            # Skip the whitespace and separators to the next character
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in whitespace + separators:
+                    pos += 1
+                if pos < len(buffer):
+                    return buffer[pos]
+                if not fill():
+                    return None
+
+        def decode():
+            # Decode the next value, reading more until it's complete.
+            # A number at the end of the buffer may only be part of it.
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill(max(blocksize, len(buffer)))
+
+        def expect(char: str):
+            nonlocal pos
+            if peek() != char:
+                raise ValueError(f"{filespec} isn't valid GeoJson, expected '{char}'")
+            pos += 1
+
+        # Each object at the top level is a FeatureCollection, or a
+        # Feature in newline delimited GeoJson.
+        while peek() is not None:
+            expect("{")
+            members = dict()
+            while peek(",") != "}":
+                key = decode()
+                expect(":")
+                if key == "features" and peek() == "[":
+                    pos += 1
+                    while peek(",") != "]":
+                        yield decode()
+                    pos += 1
+                else:
+                    members[key] = decode()
+            pos += 1
+            if members.get("type") == "Feature":
+                yield members
+
+def makeRecords(features: list,
+                batchsize: int = 100000,
+                ):
+    """
+    Convert the features to the records for COPY, in batches. The
+    geometry is EWKB, and the tags are JSON, so quotes in the values
+    don't matter. Features without a geometry that goes in one of
+    the tables are skipped.
+
+    Args:
+        features (list): The features to convert
+        batchsize (int): The number of features in each batch
+
+    Returns:
+        (dict): The records for each table, with the geometry and tags
+    """
+    geoms = list()
+    names = list()
+    tags = list()
+    for entry in features:
+        if entry["geometry"] is None or entry["geometry"]["type"] not in tables:
+            log.debug(f"Can't import {entry['properties']}")
+            continue
+        geoms.append(shape(entry["geometry"]))
+        names.append(tables[entry["geometry"]["type"]])
+        tags.append(json.dumps(entry["properties"], default=str))
+        if len(geoms) >= batchsize:
+            yield groupRecords(geoms, names, tags)
+            geoms = list()
+            names = list()
+            tags = list()
+    if len(geoms) > 0:
+        yield groupRecords(geoms, names, tags)
+
+def groupRecords(geoms: list,
+                 names: list,
+                 tags: list,
+                 ) -> dict:
+    """
+    Convert a batch of geometries to EWKB all at once, and group the
+    records by table.
+
+    Args:
+        geoms (list): The geometries
+        names (list): The table for each geometry
+        tags (list): The JSON tags for each geometry
+
+    Returns:
+        (dict): The records for each table
+    """
+    ewkb = shapely.to_wkb(shapely.set_srid(geoms, 4326), include_srid=True)
+    records = dict()
+    for table, geom, tag in zip(names, ewkb, tags):
+        if table not in records:
+            records[table] = list()
+        records[table].append((geom, tag))
+    return records
+
 
 class GeoSupport(object):
     def __init__(self,
@@ -57,52 +210,51 @@ class GeoSupport(object):
 
     async def importDataset(self,
                      filespec: str,
+                     batchsize: int = 100000,
                      ) -> bool:
         """
         Import a GeoJson file into a postgres database for conflation.
+        The features are read from the file and loaded with COPY in
+        batches, each in it's own transaction, so only one batch is
+        in memory at a time. The indexes are made after all the data
+        is loaded.
 
         Args:
             filespec (str): The GeoJson file to import
+            batchsize (int): The number of features in each batch
 
         Returns:
             (bool): If the import was successful
         """
-        file = open(filespec, "r")
-        data = geojson.load(file)
-
         # Create the tables
-        sql = "CREATE EXTENSION postgis;"
-        result = await self.db.execute(sql)
-        sql = f"DROP TABLE IF EXISTS public.nodes CASCADE; CREATE TABLE public.nodes (osm_id bigint, geom geometry, tags jsonb);"
-        result = await self.db.execute(sql)
-        sql = f"DROP TABLE IF EXISTS public.ways_line CASCADE; CREATE TABLE public.ways_line (osm_id bigint, geom geometry, tags jsonb);"
-        result = await self.db.execute(sql)
-        sql = f"DROP TABLE IF EXISTS public.poly CASCADE; CREATE TABLE public.ways_poly (osm_id bigint, geom geometry, tags jsonb);"
+        sql = "CREATE EXTENSION IF NOT EXISTS postgis;"
         result = await self.db.execute(sql)
+        for table in sorted(set(tables.values())):
+            sql = f"DROP TABLE IF EXISTS public.{table} CASCADE; CREATE TABLE public.{table} (osm_id bigint, geom geometry, tags jsonb);"
+            result = await self.db.execute(sql)
 
         # if self.db.is_closed():
         #     return False
 
-        table = self.dburi.split('/')[1]
-        for entry in data["features"]:
-            keys = "geom, "
-            geometry = shape(entry["geometry"])
-            ewkt = geometry.wkt
-            if geometry.geom_type == "LineString":
-                table = "ways_line"
-            if geometry.geom_type == "Polygon":
-                table = "ways_poly"
-            if geometry.geom_type == "Point":
-                table = "nodes"
-            tags = f"\'{{"
-            for key, value in entry["properties"].items():
-                tags += f"\"{key}\": \"{value}\", "
-            tags = tags[:-2]
-            tags += "}\'::jsonb)"
-            sql = f"INSERT INTO {table} (geom, tags) VALUES(ST_GeomFromEWKT(\'SRID=4326;{ewkt}\'), {tags}"
-            result = await self.db.pg.execute(sql)
-
-        return False
+        # COPY uses the binary format, which for a geometry is EWKB,
+        # so it's sent as it is.
+        await self.db.pg.set_type_codec("geometry", encoder=bytes, decoder=bytes, format="binary")
+        count = 0
+        for records in makeRecords(readFeatures(filespec), batchsize):
+            async with self.db.pg.transaction():
+                for table, rows in records.items():
+                    await self.db.pg.copy_records_to_table(table, records=rows, columns=["geom", "tags"])
+                    count += len(rows)
+            log.debug(f"Imported {count} features")
+
+        for table in sorted(set(tables.values())):
+            sql = f"CREATE INDEX IF NOT EXISTS {table}_geom_idx ON public.{table} USING GIST (geom);"
+            result = await self.db.execute(sql)
+            sql = f"ANALYZE public.{table};"
+            result = await self.db.execute(sql)
+        log.info(f"Imported {count} features from {filespec}")
+
+        return True
 
     async def initialize(self,
                         dburi: str = None,
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import importlib.util
+
+def lazyImport(name: str,
+               ):
+    """
+    Import a module the first time one of it's attributes is used,
+    instead of when the program starts. The programs get run many
+    times by the batch scripts, and most runs only use a few of the
+    large modules.
+
+    Args:
+        name (str): The name of the module
+
+    Returns:
+        (module): The module, which isn't loaded yet
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+def cpuCount() -> int:
+    """
+    Get the number of cores this process can use. This is much faster
+    than probing the CPU, and honors the CPU affinity of containers
+    and batch jobs.
+
+    Returns:
+        (int): The number of cores
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
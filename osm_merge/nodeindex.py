@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import os
+from array import array
+import numpy
+from osm_merge.lazyload import lazyImport
+
+osmium = lazyImport("osmium")
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+# OSM stores coordinates as integers in units of 1e-7 degrees, which
+# fits in 32 bits.
+SCALE = 10000000
+
+class NodeIndex(object):
+    """
+    The locations of nodes, sorted by ID so the nodes in a way can be
+    found quickly. Each node uses 16 bytes instead of the hundreds a
+    python object would. The index can be saved to disk, and then it's
+    memory mapped read-only, so it's only built once for an extract,
+    and every process and every run that uses it shares the same
+    pages.
+    """
+    def __init__(self,
+                 ids: numpy.ndarray,
+                 lonlat: numpy.ndarray,
+                 ):
+        """
+        Args:
+            ids (numpy.ndarray): The sorted node IDs
+            lonlat (numpy.ndarray): The longitude and latitude of each node in 1e-7 degrees
+
+        Returns:
+            (NodeIndex): An instance of this object
+        """
+        self.ids = ids
+        self.lonlat = lonlat
+
+    def __len__(self) -> int:
+        """
+        Returns:
+            (int): The number of nodes in the index
+        """
+        return len(self.ids)
+
+    def __contains__(self,
+                     osmid: int,
+                     ) -> bool:
+        """
+        Args:
+            osmid (int): The node ID
+
+        Returns:
+            (bool): Whether the node is in the index
+        """
+        position = numpy.searchsorted(self.ids, osmid)
+        return position < len(self.ids) and self.ids[position] == osmid
+
+    @classmethod
+    def build(cls,
+              ids: array,
+              coords: array,
+              filespec: str = None,
+              ) -> "NodeIndex":
+        """
+        Make an index from the node IDs and coordinates, in any order.
+
+        Args:
+            ids (array): The node IDs
+            coords (array): The longitude and latitude of each node in 1e-7 degrees, one after the other
+            filespec (str): If set, save the index to this file and memory map it
+
+        Returns:
+            (NodeIndex): The index of the nodes
+        """
+        nodeids = numpy.asarray(ids, dtype=numpy.int64)
+        lonlat = numpy.asarray(coords, dtype=numpy.int32).reshape(-1, 2)
+        if len(nodeids) > 1 and not numpy.all(nodeids[1:] > nodeids[:-1]):
+            order = numpy.argsort(nodeids, kind="stable")
+            nodeids = nodeids[order]
+            lonlat = lonlat[order]
+        else:
+            # Copy them, since the arrays can still grow
+            nodeids = nodeids.copy()
+            lonlat = lonlat.copy()
+
+        index = cls(nodeids, lonlat)
+        if filespec is not None:
+            index.save(filespec)
+            return cls.load(filespec)
+        return index
+
+    @classmethod
+    def fromFile(cls,
+                 osmfile: str,
+                 filespec: str = None,
+                 refs: numpy.ndarray = None,
+                 key: str = None,
+                 ) -> "NodeIndex":
+        """
+        Make an index of the nodes in an OSM XML or PBF file. If the
+        index was already saved from the same file, with the same
+        nodes, it's used instead of reading the OSM file again.
+
+        Args:
+            osmfile (str): The OSM XML or PBF file
+            filespec (str): If set, the file to save the index in
+            refs (numpy.ndarray): If set, only index the nodes with these IDs
+            key (str): If set, the name of the filter the refs came from, like highway
+
+        Returns:
+            (NodeIndex): The index of the nodes
+        """
+        if filespec is not None and cls.isCurrent(filespec, osmfile, key, refs):
+            log.debug(f"Using the node index in {filespec}")
+            return cls.load(filespec)
+
+        ids = array("q")
+        coords = array("i")
+        processor = osmium.FileProcessor(str(osmfile), osmium.osm.NODE)
+        if refs is not None:
+            processor = processor.with_filter(osmium.filter.IdFilter(refs).enable_for(osmium.osm.NODE))
+        for node in processor:
+            ids.append(node.id)
+            coords.append(node.location.x)
+            coords.append(node.location.y)
+        log.debug(f"Indexed {len(ids)} nodes from {osmfile}")
+        index = cls.build(ids, coords, filespec)
+        if filespec is not None:
+            manifest = cls.makeManifest(osmfile, key, refs)
+            with open(f"{filespec}.tmp", "w") as file:
+                json.dump(manifest, file, indent=4)
+            os.replace(f"{filespec}.tmp", f"{filespec}.json")
+        return index
+
+    @staticmethod
+    def makeManifest(osmfile: str,
+                     key: str = None,
+                     refs: numpy.ndarray = None,
+                     ) -> dict:
+        """
+        Describe where an index came from, so it's only reused for
+        the same file and the same nodes.
+
+        Args:
+            osmfile (str): The OSM XML or PBF file
+            key (str): If set, the name of the filter the refs came from
+            refs (numpy.ndarray): If set, the IDs of the nodes in the index
+
+        Returns:
+            (dict): The path, size, and time of the file, and the filter
+        """
+        stat = os.stat(osmfile)
+        digest = None
+        if refs is not None:
+            digest = hashlib.sha1(numpy.ascontiguousarray(refs, dtype=numpy.int64).tobytes()).hexdigest()
+        return {"file": os.path.abspath(osmfile),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "key": key,
+                "refs": digest,
+                }
+
+    @classmethod
+    def isCurrent(cls,
+                  filespec: str,
+                  osmfile: str,
+                  key: str = None,
+                  refs: numpy.ndarray = None,
+                  ) -> bool:
+        """
+        Check if a saved index was made from this OSM file, and it
+        hasn't changed since. If the refs are set, the index has to
+        have exactly those nodes. If not, it has to have been made
+        with the same filter, or have all the nodes when there isn't
+        one.
+
+        Args:
+            filespec (str): The file the index was saved in
+            osmfile (str): The OSM XML or PBF file
+            key (str): If set, the name of the filter the refs came from
+            refs (numpy.ndarray): If set, the IDs of the nodes the index should have
+
+        Returns:
+            (bool): Whether the saved index can be used
+        """
+        for suffix in (".ids.npy", ".lonlat.npy", ".json"):
+            if not os.path.exists(f"{filespec}{suffix}"):
+                return False
+        with open(f"{filespec}.json", "r") as file:
+            saved = json.load(file)
+        manifest = cls.makeManifest(osmfile, key, refs)
+        for field in ("file", "size", "mtime", "key"):
+            if saved.get(field) != manifest[field]:
+                return False
+        if refs is not None or key is None:
+            return saved.get("refs") == manifest["refs"]
+        return True
+
+    def save(self,
+             filespec: str,
+             ):
+        """
+        Save the index, as two numpy files that can be memory mapped.
+
+        Args:
+            filespec (str): The path and start of the name of the files
+        """
+        numpy.save(f"{filespec}.ids.npy", self.ids)
+        numpy.save(f"{filespec}.lonlat.npy", self.lonlat)
+
+    @classmethod
+    def load(cls,
+             filespec: str,
+             ) -> "NodeIndex":
+        """
+        Memory map a saved index read-only.
+
+        Args:
+            filespec (str): The path and start of the name of the files
+
+        Returns:
+            (NodeIndex): The index of the nodes
+        """
+        ids = numpy.load(f"{filespec}.ids.npy", mmap_mode="r")
+        lonlat = numpy.load(f"{filespec}.lonlat.npy", mmap_mode="r")
+        return cls(ids, lonlat)
+
+    def lookup(self,
+               refs: list,
+               ) -> list:
+        """
+        Get the coordinates of the nodes in a way. Nodes that aren't
+        in the index are skipped.
+
+        Args:
+            refs (list): The node IDs in the way
+
+        Returns:
+            (list): The longitude and latitude of the nodes
+        """
+        if len(refs) == 0 or len(self.ids) == 0:
+            return list()
+        refs = numpy.asarray(refs, dtype=numpy.int64)
+        positions = numpy.searchsorted(self.ids, refs)
+        positions[positions >= len(self.ids)] = 0
+        found = self.ids[positions] == refs
+        lonlat = self.lonlat[positions[found]] / SCALE
+        return [tuple(coords) for coords in lonlat.tolist()]
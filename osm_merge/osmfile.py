@@ -16,21 +16,141 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import collections
+import concurrent.futures
 import logging
 import os
 import sys
 from datetime import datetime
+from functools import lru_cache
 from sys import argv
 import html
 from geojson import Point, Feature, FeatureCollection, dump, Polygon, load, LineString
 import geojson
-import xmltodict
+from array import array
+from xml.etree import ElementTree
 from progress.bar import Bar, PixelBar
+from progress.spinner import Spinner
+import shapely
 from shapely.geometry import Polygon, shape
+from osm_merge.lazyload import lazyImport, cpuCount
+from osm_merge.nodeindex import NodeIndex, SCALE
+
+osmium = lazyImport("osmium")
 
 # Instantiate logger
 log = logging.getLogger(__name__)
 
+# Output is written in large blocks instead of a feature at a time
+buffersize = 1024 * 1024
+
+# These properties are OSM attributes, not tags
+attributes = ("id", "osm_id", "osm_way_id", "version", "timestamp", "uid", "user",
+              "changeset", "refs", "lat", "lon", "action")
+
+# These properties are added by conflation to help validate the
+# results, and are never uploaded.
+internal = ("debug", "slope", "angle", "name_ratio", "ref_ratio")
+
+@lru_cache(maxsize=65536)
+def escape(text: str,
+           ) -> str:
+    """
+    Escape a string for OSM XML. Most of the keys and values are
+    the same over and over, so they're cached.
+
+    Args:
+        text (str): The string to escape
+
+    Returns:
+        (str): The escaped string
+    """
+    return html.escape(text)
+
+def formatAttrs(attrs: dict,
+                ) -> str:
+    """
+    Format the attributes of an OSM XML element.
+
+    Args:
+        attrs (dict): The attributes
+
+    Returns:
+        (str): The attributes for the XML element
+    """
+    return "".join([f"{key}='{escape(str(value))}' " for key, value in attrs.items()])
+
+# The number of features each worker process converts at a time
+chunksize = 10000
+
+def encodeBlocks(encoder: callable,
+                 data: list,
+                 offset: int = 0,
+                 workers: int = None,
+                 **kwargs,
+                 ):
+    """
+    Convert the features to bytes in blocks, using a process pool if
+    there is more than one core. The blocks are returned in the same
+    order as the features, so they can be written to the file as they
+    are. Only a few blocks are waiting at a time, so the memory used
+    doesn't depend on how many features there are.
+
+    Args:
+        encoder (callable): The function that converts a block, given the features and the position of the first one
+        data (list): The features to convert
+        offset (int): The position of the first feature in the output file
+        workers (int): The number of worker processes, all the cores by default
+
+    Returns:
+        (bytes): Each converted block
+    """
+    if workers is None:
+        workers = cpuCount()
+    blocks = range(0, len(data), chunksize)
+    if workers <= 1 or len(blocks) <= 1:
+        for start in blocks:
+            yield encoder(data[start:start + chunksize], offset + start, **kwargs)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for start in blocks:
+            pending.append(executor.submit(encoder, data[start:start + chunksize], offset + start, **kwargs))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+def encodeOSM(features: list,
+              start: int,
+              firstid: int = -1,
+              timestamp: str = None,
+              ) -> bytes:
+    """
+    Convert a block of features to OSM XML. A feature that isn't in
+    OSM gets a negative ID from it's position in the output, so the
+    IDs are unique no matter which process converts which block.
+
+    Args:
+        features (list): The features to convert
+        start (int): The position of the first feature in the output
+        firstid (int): The ID of the first feature in the output
+        timestamp (str): The timestamp for every element
+
+    Returns:
+        (bytes): The OSM XML for the features
+    """
+    osm = OsmFile()
+    if timestamp is not None:
+        osm.timestamp = timestamp
+    out = list()
+    for position, entry in enumerate(features, start):
+        xml = osm.featureToOSM(entry, firstid - position)
+        if xml:
+            out.append(xml)
+    return "".join(out).encode("utf-8")
+
 
 class OsmFile(object):
     """OSM File output."""
@@ -59,6 +179,8 @@ class OsmFile(object):
         self.version = 3
         self.visible = "true"
         self.osmid = -1
+        # Every element written in this run gets the same timestamp
+        self.timestamp = datetime.now().strftime("%Y-%m-%dT%TZ")
         # Open the OSM output file
         self.file = None
         if filespec is not None:
@@ -76,6 +198,12 @@ class OsmFile(object):
         # decrement the ID
         # path = xlsforms_path.replace("xlsforms", "")
         self.data = list()
+        # The indexes of the loaded data, built when first used
+        self.ids = None
+        self.keys = None
+        self.tree = None
+        self.positions = list()
+        self.indexed = 0
 
     def __del__(self):
         """Close the OSM XML file automatically."""
@@ -110,198 +238,538 @@ class OsmFile(object):
     def loadFile(
         self,
         osmfile: str,
+        keys: list = None,
     ) -> list:
         """
-        Read a OSM XML file and convert it to GeoJson for consistency.
+        Read a OSM XML or PBF file and convert it to GeoJson for consistency.
+
+        Args:
+            osmfile (str): The OSM XML or PBF file to load
+            keys (list): If set, only load the features with one of these tags
+
+        Returns:
+            (list): The entries in the OSM file
+        """
+        count = len(self.data)
+        if str(osmfile).endswith(".pbf"):
+            self.data.extend(self.readPBF(osmfile, keys))
+        else:
+            self.data.extend(self.readFeatures(osmfile, keys))
+        if len(self.data) == count:
+            logging.warning("No data in this instance")
+            return False
+
+        return self.data
+
+    def readFeatures(
+        self,
+        osmfile: str,
+        keys: list = None,
+    ):
+        """
+        Read a OSM XML file one element at a time, and yield the tagged
+        nodes and the ways as GeoJson features. Each element is freed
+        after it's converted, and only the coordinates of the nodes are
+        kept, in compact arrays, so the memory used depends on the
+        number of nodes instead of the size of the file. The nodes have
+        to be before the ways, like every OSM XML file has them.
 
         Args:
-            osmfile (str): The OSM XML file to load
+            osmfile (str): The OSM XML file to read
+            keys (list): If set, only read the features with one of these tags
 
         Returns:
-            (list): The entries in the OSM XML file
-        """
-        alldata = list()
-        size = os.path.getsize(osmfile)
-        with open(osmfile, "r") as file:
-            xml = file.read(size)
-            doc = xmltodict.parse(xml)
-            if "osm" not in doc:
-                logging.warning("No data in this instance")
-                return False
-            data = doc["osm"]
-            if "node" not in data:
-                logging.warning("No nodes in this instance")
-                return False
-
-        nodes = dict()
-        for node in data["node"]:
+            (Feature): Each tagged node and way in the file
+        """
+        # The IDs and coordinates of every node, which are needed
+        # to make the geometry of the ways.
+        ids = array("q")
+        coords = array("i")
+        # The nodes sorted for searching, made when the first way
+        # is read.
+        index = None
+
+        context = ElementTree.iterparse(osmfile, events=("start", "end"))
+        event, root = next(context)
+        if root.tag != "osm":
+            logging.warning(f"{osmfile} isn't an OSM XML file")
+            return
+
+        for event, elem in context:
+            if event != "end" or elem.tag not in ("node", "way", "relation"):
+                continue
+            if elem.tag == "relation":
+                root.clear()
+                continue
+
             properties = {
-                "id": int(node["@id"]),
+                "id": int(elem.get("id")),
             }
-            if "@version" not in node:
-                properties["version"] = 1
+            if elem.tag == "node":
+                properties["version"] = elem.get("version", 1)
+                if "timestamp" in elem.attrib:
+                    properties["timestamp"] = elem.get("timestamp")
+                lon = float(elem.get("lon"))
+                lat = float(elem.get("lat"))
+                ids.append(properties["id"])
+                coords.append(round(lon * SCALE))
+                coords.append(round(lat * SCALE))
+                index = None
+            else:
+                refs = [int(nd.get("ref")) for nd in elem.iter("nd")]
+                if len(refs) > 0:
+                    properties["refs"] = refs
+                properties["version"] = elem.get("version", 1)
+
+            tags = elem.findall("tag")
+            for tag in tags:
+                # Drop all the TIGER tags based on
+                # https://wiki.openstreetmap.org/wiki/TIGER_fixup
+                if tag.get("k") in properties:
+                    if properties[tag.get("k")][:7] == "tiger:":
+                        continue
+                properties[tag.get("k")] = tag.get("v").strip()
+
+            if keys is not None and not any(tag.get("k") in keys for tag in tags):
+                # Only the coordinates of a node are needed, for the ways
+                pass
+            elif elem.tag == "node":
+                # Nodes without tags are only part of a way
+                if len(tags) > 0:
+                    yield Feature(geometry=Point((lon, lat)), properties=properties)
             else:
-                properties["version"] = node["@version"]
-
-            if "@timestamp" in node:
-                properties["timestamp"] = node["@timestamp"]
-
-            if "tag" in node:
-                for tag in node["tag"]:
-                    if type(tag) == dict:
-                        # Drop all the TIGER tags based on
-                        # https://wiki.openstreetmap.org/wiki/TIGER_fixup
-                        if tag["@k"] in properties:
-                            if properties[tag["@k"]][:7] == "tiger:":
-                                continue
-                        properties[tag["@k"]] = tag["@v"].strip()
-                        # continue
-                    else:
-                        properties[node["tag"]["@k"]] = node["tag"]["@v"].strip()
-                    # continue
-            geom = Point((float(node["@lon"]), float(node["@lat"])))
-            # cache the nodes so we can dereference the refs into
-            # coordinates, but we don't need them in GeoJson format.
-            nodes[properties["id"]] = geom
-            if len(properties) > 2:
-                self.data.append(Feature(geometry=geom, properties=properties))
-
-        for way in data["way"]:
-            attrs = dict()
+                if index is None:
+                    index = NodeIndex.build(ids, coords)
+                yield Feature(geometry=LineString(index.lookup(refs)), properties=properties)
+
+            # Free the elements that have been converted
+            root.clear()
+
+    def readPBF(
+        self,
+        osmfile: str,
+        keys: list = None,
+    ):
+        """
+        Read a OSM PBF file, and yield the tagged nodes and the ways as
+        GeoJson features, the same as readFeatures() does for OSM XML.
+        Osmium keeps the node locations and adds them to the ways, and
+        the tag filter is done by osmium too, so the untagged nodes and
+        the unwanted features never get converted to python objects.
+
+        Args:
+            osmfile (str): The OSM PBF file to read
+            keys (list): If set, only read the features with one of these tags
+
+        Returns:
+            (Feature): Each tagged node and way in the file
+        """
+        if keys is None:
+            # Nodes without tags are only part of a way
+            tagfilter = osmium.filter.EmptyTagFilter().enable_for(osmium.osm.NODE)
+        else:
+            tagfilter = osmium.filter.KeyFilter(*keys).enable_for(osmium.osm.NODE | osmium.osm.WAY)
+        # The locations get stored before the filter drops the nodes
+        processor = osmium.FileProcessor(str(osmfile), osmium.osm.NODE | osmium.osm.WAY)
+        for obj in processor.with_locations().with_filter(tagfilter):
             properties = {
-                "id": int(way["@id"]),
+                "id": obj.id,
             }
-            refs = list()
-            if "nd" in way:
-                if len(way["nd"]) > 0:
-                    for ref in way["nd"]:
-                        refs.append(int(ref["@ref"]))
-                properties["refs"] = refs
-
-            if "@version" not in node:
-                properties["version"] = 1
+            if obj.is_node():
+                properties["version"] = str(obj.version)
+                # Osmium uses the epoch when there is no timestamp
+                if obj.timestamp.timestamp() > 0:
+                    properties["timestamp"] = obj.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
             else:
-                properties["version"] = node["@version"]
-
-            if "@timestamp" in node:
-                attrs["timestamp"] = node["@timestamp"]
-
-            if "tag" in way:
-                for tag in way["tag"]:
-                    if type(tag) == dict:
-                        properties[tag["@k"]] = tag["@v"].strip()
-                        # continue
-                    else:
-                        properties[way["tag"]["@k"]] = way["tag"]["@v"].strip()
-                    # continue
-            # geom =
-            tmp = list()
-            for ref in refs:
-                if ref in nodes:
-                    # Only add nodes that have been cached
-                    tmp.append(nodes[ref]['coordinates'])
-            geom = LineString(tmp)
-            if geom is None:
-                breakpoint()
-            # log.debug(f"WAY: {properties}")
-            self.data.append(Feature(geometry=geom, properties=properties))
+                refs = [node.ref for node in obj.nodes]
+                if len(refs) > 0:
+                    properties["refs"] = refs
+                properties["version"] = str(obj.version)
+            for tag in obj.tags:
+                properties[tag.k] = tag.v.strip()
 
-        return self.data
+            if obj.is_node():
+                yield Feature(geometry=Point((obj.lon, obj.lat)), properties=properties)
+            else:
+                # Nodes that aren't in the file are skipped
+                coords = [(node.lon, node.lat) for node in obj.nodes if node.location.valid()]
+                yield Feature(geometry=LineString(coords), properties=properties)
 
     def writeOSM(self,
                  data: list,
                  filespec: str,
+                 workers: int = None,
                  ):
         """
-        Write the data to an OSM XML file.
+        Write the data to an OSM XML file. Each feature is written as
+        soon as it's converted, so the data can be a generator, like
+        the output of conflation while it's still running. A list with
+        a lot of features is converted in blocks by a process pool,
+        and the output is the same.
 
         Args:
-            data (list): The list of GeoJson features
+            data (list): The GeoJson features, a FeatureCollection, or a generator of features
+            filespec (str): The output file
+            workers (int): The number of worker processes, all the cores by default
         """
-        negid = -100
-        out = str()
-        nodes = str()
-        ways = str()
-        self.file = open(filespec, "w")
+        self.file = open(filespec, "w", encoding="utf-8", buffering=buffersize)
+        file = self.file
         self.header()
         if type(data) == FeatureCollection:
             indata = data["features"]
         else:
             indata = data
-        spin = Bar('Processing output file...', max=len(indata))
-        for entry in indata:
-            spin.next()
-            version = 1
-            gtype = entry["geometry"]["type"]
-            tags = entry["properties"]
-            if type(tags) == list:
-                breakpoint()
-                continue
-            if "ref" in entry["properties"]:
-                # FIXME: from GeoJson file
-                pass
-            # elif "id" not in tags:
-            #else:
-                # There is no id or version for non OSM features
-            #     self.osmid -= 1
-            if "version" in entry["properties"]:
-                version = int(entry["properties"]["version"])
-                version += 1
-            if "osm_id" in tags:
-                id = tags["osm_id"]
-            elif "id" in tags:
-                id = tags["id"]
-            else:
-                id = self.osmid
-            attrs = {"version": version}
-            # These are OSM attributes, not tags
-            if "id" in tags:
-                del tags["id"]
-            if "version" in tags:
-                del tags["version"]
-            item = {"attrs": attrs, "tags": tags}
-            # breakpoint()
-            if "timestamp" in item["tags"]:
-                item["attrs"]["timestamp"] = item["tags"]["timestamp"]
-                del item["tags"]["timestamp"]
-            # print(entry)
-            # out = str()
-            # GeoJson input files have a geometry.
-            if entry["geometry"] is not None:
-                item["attrs"]["lon"] = entry["geometry"]["coordinates"][0]
-                item["attrs"]["lat"] = entry["geometry"]["coordinates"][1]
-                ways += self.createNode(item, True) + '\n'
-                # else:
-                #     refnodes, refs = self.geom_to_nodes(entry)
-                #     nodes += refnodes
-                #     ways += self.createWay(item, True) + '\n'
+        firstid = self.osmid
+        file.write("\n")
+        if hasattr(indata, "__len__") and len(indata) > chunksize and workers != 1:
+            spin = Bar('Processing output file...', max=len(indata))
+            file.flush()
+            for block in encodeBlocks(encodeOSM, indata, workers=workers,
+                                      firstid=firstid, timestamp=self.timestamp):
+                file.buffer.write(block)
+                spin.next(min(chunksize, len(indata) - spin.index))
+            position = len(indata)
+        else:
+            # A generator doesn't know how many features it has
+            if hasattr(indata, "__len__"):
+                spin = Bar('Processing output file...', max=len(indata))
             else:
-                # OSM ways don't have a geometry, just references to node IDs.
-                # The OSM XML file won't have any nodes, so at first won't
-                # display in JOSM until you do a File->"Update modified",
-                if "refs" not in tags:
-                    # log.debug(f"No Refs, so new MVUM road not in OSM {tags}")
-                    # tags["fixme"] = "New road from MVUM, don't add!"
-                    # FIXME: for now we don't do anything with new roads from
-                    # an external dataset, because that would be an import.
-                    # newmvum.append(entry)
+                spin = Spinner('Processing output file...')
+            position = 0
+            for position, entry in enumerate(indata, 1):
+                spin.next()
+                out = self.featureToOSM(entry, firstid - position + 1)
+                if not out:
                     continue
-                if len(tags['refs']) > 0 or type(entry) == 'Feature':
-                    if type(tags["refs"]) != list:
-                        item["refs"] = eval(tags["refs"])
-                    else:
-                        item["refs"] = tags["refs"]
-                    del tags["refs"]
-                    del tags["lat"]
-                    del tags["lon"]
-                    ways += self.createWay(item, True)
-            if len(nodes) == 0 and len(ways) == 0:
-                logging.error(f"")
-                quit()
-            # OSM prefers all the nodes are first in the file
-        self.file.write(nodes + "\n")
-        self.file.write(ways + "\n")
+                file.write(out)
+        self.osmid = firstid - position
+        file.write("\n")
+        spin.finish()
         self.footer()
+        file.close()
+
+    def featureToOSM(self,
+                     entry: Feature,
+                     osmid: int = None,
+                     ):
+        """
+        Convert a feature to OSM XML. The OSM attributes are removed
+        from a copy of the tags, the same as for the other formats, so
+        the feature isn't changed.
+
+        Args:
+            entry (Feature): The feature to convert
+            osmid (int): If set, the negative ID to use if the feature isn't in OSM
+
+        Returns:
+            (str): The OSM XML for the feature, or None if it's skipped
+        """
+        if osmid is not None:
+            self.osmid = osmid
+        version = 1
+        tags = entry["properties"]
+        if type(tags) == list:
+            log.error(f"The properties are a list, not tags: {tags}")
+            return None
+        if "ref" in entry["properties"]:
+            # FIXME: from GeoJson file
+            pass
+        # elif "id" not in tags:
+        #else:
+            # There is no id or version for non OSM features
+        #     self.osmid -= 1
+        if "version" in entry["properties"]:
+            version = int(entry["properties"]["version"])
+            version += 1
+        if "osm_id" in tags:
+            id = tags["osm_id"]
+        elif "id" in tags:
+            id = tags["id"]
+        else:
+            id = self.osmid
+        attrs = {"version": version}
+        # These are OSM attributes, not tags
+        item = {"attrs": attrs, "tags": {key: value for key, value in tags.items() if key not in attributes}}
+        # breakpoint()
+        if "timestamp" in tags:
+            item["attrs"]["timestamp"] = tags["timestamp"]
+        # print(entry)
+        out = str()
+        # GeoJson input files have a geometry.
+        if entry["geometry"] is not None:
+            item["attrs"]["lon"] = entry["geometry"]["coordinates"][0]
+            item["attrs"]["lat"] = entry["geometry"]["coordinates"][1]
+            out += self.createNode(item, True) + '\n'
+            # else:
+            #     refnodes, refs = self.geom_to_nodes(entry)
+            #     nodes += refnodes
+            #     ways += self.createWay(item, True) + '\n'
+        else:
+            # OSM ways don't have a geometry, just references to node IDs.
+            # The OSM XML file won't have any nodes, so at first won't
+            # display in JOSM until you do a File->"Update modified",
+            if "refs" not in tags:
+                # log.debug(f"No Refs, so new MVUM road not in OSM {tags}")
+                # tags["fixme"] = "New road from MVUM, don't add!"
+                # FIXME: for now we don't do anything with new roads from
+                # an external dataset, because that would be an import.
+                # newmvum.append(entry)
+                return None
+            if len(tags['refs']) > 0 or type(entry) == 'Feature':
+                if type(tags["refs"]) != list:
+                    item["refs"] = eval(tags["refs"])
+                else:
+                    item["refs"] = tags["refs"]
+                out += self.createWay(item, True)
+
+        return out
+
+    def featureTags(self,
+                    entry: Feature,
+                    upload: bool = False,
+                    ) -> dict:
+        """
+        Get the OSM tags of a feature, without the OSM attributes.
+
+        Args:
+            entry (Feature): The feature
+            upload (bool): Whether to also drop the tags added by conflation
+
+        Returns:
+            (dict): The tags
+        """
+        tags = dict()
+        for key, value in entry["properties"].items():
+            if key in attributes or value is None:
+                continue
+            if upload and key in internal:
+                continue
+            tags[key] = str(value).strip()
+        return tags
+
+    def featureID(self,
+                  entry: Feature,
+                  ) -> int:
+        """
+        Get the OSM ID of a feature. A feature that isn't from OSM gets
+        the next negative ID.
+
+        Args:
+            entry (Feature): The feature
+
+        Returns:
+            (int): The OSM ID
+        """
+        props = entry["properties"]
+        for key in ("osm_id", "osm_way_id", "id"):
+            if key in props:
+                return int(props[key])
+        osmid = self.osmid
+        self.osmid -= 1
+        return osmid
+
+    def startPBF(self,
+                 filespec: str,
+                 ):
+        """
+        Start writing an OSM PBF file.
+
+        Args:
+            filespec (str): The output file
+        """
+        self.pbf = osmium.SimpleWriter(str(filespec), overwrite=True)
+        # The nodes in the ways, which are written as they're found
+        self.pbfnodes = set()
+        # The ways are written after all the nodes
+        self.pbfways = list()
+
+    def addPBF(self,
+               entry: Feature,
+               ) -> bool:
+        """
+        Add a feature to the OSM PBF file. A way gets the nodes from
+        it's geometry, if it has a node for each ref.
+
+        Args:
+            entry (Feature): The feature to add
+
+        Returns:
+            (bool): Whether the feature was added
+        """
+        props = entry["properties"]
+        geom = entry["geometry"]
+        tags = self.featureTags(entry)
+        version = int(props.get("version", 1))
+        if geom is not None and geom["type"] == "Point":
+            node = osmium.osm.mutable.Node(id=self.featureID(entry), version=version,
+                                           location=tuple(geom["coordinates"][:2]), tags=tags)
+            self.pbf.add_node(node)
+            return True
+        if "refs" not in props:
+            # FIXME: for now we don't do anything with new roads from
+            # an external dataset, because that would be an import.
+            return False
+        refs = props["refs"]
+        if type(refs) != list:
+            refs = eval(refs)
+        if geom is not None and geom["type"] == "LineString" and len(geom["coordinates"]) == len(refs):
+            for ref, coords in zip(refs, geom["coordinates"]):
+                if ref in self.pbfnodes:
+                    continue
+                self.pbfnodes.add(ref)
+                self.pbf.add_node(osmium.osm.mutable.Node(id=ref, version=1, location=tuple(coords[:2])))
+        way = osmium.osm.mutable.Way(id=self.featureID(entry), version=version, nodes=refs, tags=tags)
+        self.pbfways.append(way)
+        return True
+
+    def finishPBF(self):
+        """Write the ways, and close the OSM PBF file."""
+        for way in self.pbfways:
+            self.pbf.add_way(way)
+        self.pbf.close()
+        self.pbf = None
+        self.pbfnodes = None
+        self.pbfways = None
+
+    def writePBF(self,
+                 data: list,
+                 filespec: str,
+                 ) -> int:
+        """
+        Write the data to an OSM PBF file, which is much smaller and
+        faster to load than OSM XML. The nodes in each way come from
+        it's geometry, so the file can be used by itself. The nodes are
+        first, then the ways.
+
+        Args:
+            data (list): The GeoJson features, a FeatureCollection, or a generator of features
+            filespec (str): The output file
+
+        Returns:
+            (int): The number of features written
+        """
+        if type(data) == FeatureCollection:
+            data = data["features"]
+        count = 0
+        self.startPBF(filespec)
+        for entry in data:
+            if self.addPBF(entry):
+                count += 1
+        self.finishPBF()
+        return count
+
+    def startChange(self,
+                    filespec: str,
+                    original: str,
+                    ):
+        """
+        Start writing an osmChange file.
+
+        Args:
+            filespec (str): The output file
+            original (str): The OSM XML or PBF file the data was conflated with
+        """
+        self.change = filespec
+        self.original = original
+        # The tags from conflation for each OSM node and way
+        self.changes = {"n": dict(), "w": dict()}
+
+    def addChange(self,
+                  entry: Feature,
+                  ) -> bool:
+        """
+        Add the tags of a feature to the osmChange file. Only features
+        that are already in OSM are modified.
+
+        Args:
+            entry (Feature): The feature to add
+
+        Returns:
+            (bool): Whether the feature is in OSM
+        """
+        osmid = self.featureID(entry)
+        if osmid <= 0:
+            return False
+        if entry["geometry"] is not None and entry["geometry"]["type"] == "Point":
+            changes = self.changes["n"]
+        else:
+            changes = self.changes["w"]
+        changes.setdefault(osmid, dict()).update(self.featureTags(entry, True))
+        return True
+
+    def finishChange(self) -> int:
+        """
+        Write the osmChange file. The current nodes and ways are read
+        from the original file, and only the ones with tags that
+        changed are written. The nodes in the ways didn't change, so
+        they're left out.
+
+        Returns:
+            (int): The number of modified nodes and ways
+        """
+        nodes = self.changes["n"]
+        ways = self.changes["w"]
+        # Only the nodes and ways that were conflated are read
+        node_filter = osmium.filter.IdFilter(list(nodes.keys())).enable_for(osmium.osm.NODE)
+        way_filter = osmium.filter.IdFilter(list(ways.keys())).enable_for(osmium.osm.WAY)
+        processor = osmium.FileProcessor(str(self.original), osmium.osm.NODE | osmium.osm.WAY)
+        count = 0
+        with open(self.change, "w", buffering=buffersize) as file:
+            file.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+            file.write('<osmChange version="0.6" generator="osm-merge 0.3">\n')
+            file.write("  <modify>\n")
+            for obj in processor.with_filter(node_filter).with_filter(way_filter):
+                current = {tag.k: tag.v for tag in obj.tags}
+                attrs = {"id": obj.id, "version": obj.version}
+                if obj.is_node():
+                    element = "node"
+                    tags = current | nodes[obj.id]
+                    attrs["lat"] = f"{obj.location.lat:.7f}"
+                    attrs["lon"] = f"{obj.location.lon:.7f}"
+                else:
+                    element = "way"
+                    tags = current | ways[obj.id]
+                if tags == current:
+                    continue
+                osm = [f"    <{element} {formatAttrs(attrs)}>"]
+                if obj.is_way():
+                    for node in obj.nodes:
+                        osm.append(f'\n      <nd ref="{node.ref}"/>')
+                for key, value in tags.items():
+                    osm.append(f"\n      <tag k='{escape(key)}' v='{escape(value)}'/>")
+                osm.append(f"\n    </{element}>\n")
+                file.write("".join(osm))
+                count += 1
+            file.write("  </modify>\n")
+            file.write("</osmChange>\n")
+        self.changes = None
+        return count
+
+    def writeOsmChange(self,
+                       data: list,
+                       filespec: str,
+                       original: str,
+                       ) -> int:
+        """
+        Write an osmChange file that only has the nodes and ways the
+        conflation changed the tags of, instead of every feature. The
+        other tags in OSM are kept. This can be uploaded, but like any
+        conflation results it has to be validated first.
+
+        Args:
+            data (list): The GeoJson features, a FeatureCollection, or a generator of features
+            filespec (str): The output file
+            original (str): The OSM XML or PBF file the data was conflated with
+
+        Returns:
+            (int): The number of modified nodes and ways
+        """
+        if type(data) == FeatureCollection:
+            data = data["features"]
+        self.startChange(filespec, original)
+        for entry in data:
+            self.addChange(entry)
+        return self.finishChange()
 
     def createWay(
         self,
@@ -318,10 +786,8 @@ class OsmFile(object):
             (str): The OSM XML entry
         """
         attrs = dict()
-        osm = ""
 
         # Add default attributes
-        # breakpoint()
         if modified:
             attrs["action"] = "modify"
         if "osm_way_id" in way["attrs"]:
@@ -337,7 +803,7 @@ class OsmFile(object):
             attrs["version"] = 1
         else:
             attrs["version"] = way["attrs"]["version"]
-        attrs["timestamp"] = datetime.now().strftime("%Y-%m-%dT%TZ")
+        attrs["timestamp"] = self.timestamp
         # If the resulting file is publicly accessible without authentication, The GDPR applies
         # and the identifying fields should not be included
         if "uid" in way["attrs"]:
@@ -376,15 +842,11 @@ class OsmFile(object):
         #     loop += 1
 
         # Processs atrributes
-        line = ""
-        for ref, value in attrs.items():
-            line += "%s=%r " % (ref, str(value))
-        osm += "  <way " + line + ">"
+        osm = ["  <way ", formatAttrs(attrs), ">"]
 
-        breakpoint()
         if "refs" in way:
             for ref in way["refs"]:
-                osm += '\n    <nd ref="%s"/>' % ref
+                osm.append(f'\n    <nd ref="{ref}"/>')
         if "tags" in way:
             for key, value in way["tags"].items():
                 if value is None:
@@ -392,15 +854,13 @@ class OsmFile(object):
                 if key == "track":
                     continue
                 if key not in attrs:
-                    newkey = html.escape(key)
-                    newval = html.escape(str(value))
-                    osm += f"\n    <tag k='{newkey}' v='{newval}'/>"
+                    osm.append(f"\n    <tag k='{escape(key)}' v='{escape(str(value))}'/>")
             if modified:
-                osm += '\n    <tag k="note" v="Do not upload this without validation!"/>'
-            osm += "\n"
-        osm += "  </way>\n"
+                osm.append('\n    <tag k="note" v="Do not upload this without validation!"/>')
+            osm.append("\n")
+        osm.append("  </way>\n")
 
-        return osm
+        return "".join(osm)
 
     def createNode(
         self,
@@ -432,7 +892,7 @@ class OsmFile(object):
             attrs["version"] = int(node["attrs"]["version"]) + 1
         attrs["lat"] = node["attrs"]["lat"]
         attrs["lon"] = node["attrs"]["lon"]
-        attrs["timestamp"] = datetime.now().strftime("%Y-%m-%dT%TZ")
+        attrs["timestamp"] = self.timestamp
         # If the resulting file is publicly accessible without authentication, THE GDPR applies
         # and the identifying fields should not be included
         if "uid" in node["attrs"]:
@@ -441,26 +901,20 @@ class OsmFile(object):
             attrs["user"] = node["attrs"]["user"]
 
         # Processs atrributes
-        line = ""
-        osm = ""
-        for ref, value in attrs.items():
-            line += "%s=%r " % (ref, str(value))
-        osm += "  <node " + line
+        osm = ["  <node ", formatAttrs(attrs)]
 
         if "tags" in node:
-            osm += ">"
+            osm.append(">")
             for key, value in node["tags"].items():
                 if not value:
                     continue
                 if key not in attrs:
-                    newkey = html.escape(key)
-                    newval = html.escape(str(value))
-                    osm += f"\n    <tag k='{newkey}' v='{newval}'/>"
-            osm += "\n  </node>\n"
+                    osm.append(f"\n    <tag k='{escape(key)}' v='{escape(str(value))}'/>")
+            osm.append("\n  </node>\n")
         else:
-            osm += "/>"
+            osm.append("/>")
 
-        return osm
+        return "".join(osm)
 
     def createTag(
         self,
@@ -501,29 +955,116 @@ class OsmFile(object):
             for key, value in entry["properties"].items():
                 print(f"\t{key} = {value}")
 
+    def makeIndex(self):
+        """
+        Index the loaded features by their OSM ID, and count the tags
+        they use. Nodes and ways have their own IDs in OSM, so the
+        type is part of the key. This is done the first time it's
+        needed, and again if more data has been loaded.
+        """
+        if self.ids is not None and self.indexed == len(self.data):
+            return
+        self.ids = dict()
+        self.keys = collections.Counter()
+        self.tree = None
+        for entry in self.data:
+            properties = entry["properties"]
+            if "id" in properties:
+                if entry["geometry"] is not None and entry["geometry"]["type"] == "Point":
+                    self.ids[("node", int(properties["id"]))] = entry
+                else:
+                    self.ids[("way", int(properties["id"]))] = entry
+            self.keys.update(key for key in properties if key not in attributes)
+        self.indexed = len(self.data)
+
+    def makeTree(self):
+        """
+        Load the geometries of the features into an STRtree for the
+        spatial queries. Features without a geometry are left out.
+        """
+        self.makeIndex()
+        if self.tree is not None:
+            return
+        geoms = list()
+        self.positions = list()
+        for position, entry in enumerate(self.data):
+            if entry["geometry"] is None:
+                continue
+            geoms.append(shape(entry["geometry"]))
+            self.positions.append(position)
+        self.tree = shapely.STRtree(geoms)
+        log.debug(f"Indexed {len(geoms)} of {len(self.data)} features")
+
     def getFeature(
         self,
         id: int,
+        osmtype: str = None,
     ):
         """Get the data for a feature from the loaded OSM data file.
 
         Args:
-            id (int): The ID to retrieve the feasture of
+            id (int): The OSM ID of the feature
+            osmtype (str): The type, node or way. If not set, ways are tried first
 
         Returns:
             (dict): The feature for this ID or None
         """
-        return self.data[id]
-
-    def getFields(self):
-        """Extract all the tags used in this file."""
-        fields = list()
-        for _id, item in self.data.items():
-            keys = list(item["tags"].keys())
-            for key in keys:
-                if key not in fields:
-                    fields.append(key)
-        # print(fields)
+        self.makeIndex()
+        if osmtype is not None:
+            return self.ids.get((osmtype, int(id)))
+        feature = self.ids.get(("way", int(id)))
+        if feature is None:
+            feature = self.ids.get(("node", int(id)))
+        return feature
+
+    def queryBounds(
+        self,
+        bbox: tuple,
+    ) -> list:
+        """Get the loaded features that intersect a bounding box.
+
+        Args:
+            bbox (tuple): The minimum longitude, minimum latitude, maximum longitude, and maximum latitude
+
+        Returns:
+            (list): The features, in the same order as the data file
+        """
+        self.makeTree()
+        hits = sorted(self.tree.query(shapely.box(*bbox), predicate="intersects"))
+        return [self.data[self.positions[i]] for i in hits]
+
+    def getNearest(
+        self,
+        lon: float,
+        lat: float,
+        maxdistance: float = None,
+    ):
+        """Get the loaded feature closest to a location. The distance
+        is in degrees, so this is only for finding a feature, not
+        measuring how far away it is.
+
+        Args:
+            lon (float): The longitude
+            lat (float): The latitude
+            maxdistance (float): If set, the maximum distance in degrees
+
+        Returns:
+            (dict): The closest feature, or None if there isn't one
+        """
+        self.makeTree()
+        hits = self.tree.query_nearest(shapely.Point(lon, lat), max_distance=maxdistance, all_matches=False)
+        if len(hits) == 0:
+            return None
+        return self.data[self.positions[hits[0]]]
+
+    def getFields(self) -> dict:
+        """Extract all the tags used in this file.
+
+        Returns:
+            (dict): How many features have each tag
+        """
+        self.makeIndex()
+        return dict(self.keys)
 
     def geom_to_nodes(self,
                     feature: Feature,
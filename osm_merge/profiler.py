@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import sys
+import os
+import atexit
+import cProfile
+import pstats
+import multiprocessing
+import multiprocessing.util
+from pathlib import Path
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+# The worker processes that aren't forked find the output files from
+# this. It's only set for them, so other programs this one runs don't
+# get profiled.
+envvar = "OSM_MERGE_PROFILE"
+
+# How multiprocessing starts a process that isn't forked
+spawnv_passfds = multiprocessing.util.spawnv_passfds
+
+# Callers that took less than this fraction of the total time are
+# lumped together in the collapsed stacks.
+minshare = 0.0001
+
+class Profiler(object):
+    """Profile this process with cProfile, and write the stats when it exits."""
+
+    def __init__(self,
+                 prefix: str,
+                 ):
+        """
+        Create the profiler. The stats are written to the prefix
+        followed by the process ID.
+
+        Args:
+            prefix (str): The path and start of the name of the output files
+
+        Returns:
+            (Profiler): An instance of this object
+        """
+        self.prefix = prefix
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        """Start profiling."""
+        self.profile.enable()
+
+    def stop(self) -> str:
+        """
+        Stop profiling, and write the stats for this process.
+
+        Returns:
+            (str): The stats file
+        """
+        self.profile.disable()
+        filespec = f"{self.prefix}-{os.getpid()}.pstats"
+        self.profile.dump_stats(filespec)
+        return filespec
+
+# The profiler for this process, if it's being profiled
+profiler = None
+
+def startProfile(directory: str = "profile",
+                 ):
+    """
+    Profile this program, including any worker processes it starts.
+    Each process writes it's own stats file, and when this program
+    exits they're merged into one stats file, and a collapsed stack
+    file that flame graph tools can read.
+
+    Args:
+        directory (str): The directory for the output files
+    """
+    global profiler
+
+    os.makedirs(directory, exist_ok=True)
+    name = Path(sys.argv[0]).stem
+    prefix = os.path.join(directory, f"{name}-{os.getpid()}")
+    profiler = Profiler(prefix)
+    profileWorkers(profiler)
+    atexit.register(finishProfile)
+    profiler.start()
+    log.info(f"Profiling to {prefix}.pstats")
+
+def profileWorkers(parent: Profiler,
+                   ):
+    """
+    Profile the worker processes this one starts. A forked worker gets
+    the prefix from the parent's profiler, and one that's started
+    fresh gets it in it's environment.
+
+    Args:
+        parent (Profiler): The profiler for this process
+    """
+    multiprocessing.util.register_after_fork(parent, startWorker)
+    multiprocessing.util.spawnv_passfds = spawnWorker
+
+def spawnWorker(path: str,
+                args: list,
+                passfds: tuple,
+                ) -> int:
+    """
+    Start a process for multiprocessing that isn't forked, with the
+    prefix of the output files in it's environment.
+
+    Args:
+        path (str): The python executable
+        args (list): The command line
+        passfds (tuple): The file descriptors the process keeps
+
+    Returns:
+        (int): The process ID
+    """
+    if profiler is None:
+        return spawnv_passfds(path, args, passfds)
+    os.environ[envvar] = profiler.prefix
+    try:
+        return spawnv_passfds(path, args, passfds)
+    finally:
+        del os.environ[envvar]
+
+def startWorker(parent: Profiler,
+                ):
+    """
+    Start profiling a worker process. The stats are written when the
+    worker exits.
+
+    Args:
+        parent (Profiler): The profiler the hook was registered for
+    """
+    global profiler
+
+    # A forked worker has a copy of the parent's profiler, which
+    # has the parent's stats in it.
+    parent.profile.disable()
+    profiler = Profiler(parent.prefix)
+    # The workers it starts that aren't forked get profiled too
+    multiprocessing.util.spawnv_passfds = spawnWorker
+    multiprocessing.util.Finalize(profiler, profiler.stop, exitpriority=100)
+    profiler.start()
+
+def finishProfile():
+    """Stop profiling, and merge the stats from every process."""
+    global profiler
+
+    if profiler is None:
+        return
+    profiler.stop()
+    prefix = profiler.prefix
+    profiler = None
+    multiprocessing.util.spawnv_passfds = spawnv_passfds
+
+    files = sorted(str(filespec) for filespec in Path(prefix).parent.glob(f"{Path(prefix).name}-*.pstats"))
+    stats = pstats.Stats(*files)
+    stats.dump_stats(f"{prefix}.pstats")
+    with open(f"{prefix}.folded", "w") as file:
+        for stack, seconds in collapseStats(stats).items():
+            file.write(f"{stack} {int(seconds * 1000000)}\n")
+    log.info(f"Wrote {prefix}.pstats and {prefix}.folded from {len(files)} processes")
+
+def frameName(func: tuple,
+              ) -> str:
+    """
+    Make the name of a function in a collapsed stack.
+
+    Args:
+        func (tuple): The file, line, and name of the function from pstats
+
+    Returns:
+        (str): The name of the function
+    """
+    filename, line, name = func
+    if filename == "~":
+        return name.replace(";", ",")
+    return f"{Path(filename).name}:{line}({name})".replace(";", ",")
+
+def collapseStats(stats: pstats.Stats,
+                  ) -> dict:
+    """
+    Convert the stats to collapsed stacks for a flame graph. cProfile
+    only records who called each function, not the whole stack, so
+    the time spent in a function is split between it's callers by how
+    much time each of them spent in it, all the way up the stack.
+
+    Args:
+        stats (pstats.Stats): The profile stats
+
+    Returns:
+        (dict): The seconds spent in each stack, keyed by the stack
+    """
+    mintime = stats.total_tt * minshare
+    stacks = dict()
+    for func, (_, _, tt, _, _) in stats.stats.items():
+        if tt <= 0.0:
+            continue
+        # The stack from this function up, and the time spent in it
+        todo = [([func], tt)]
+        while len(todo) > 0:
+            path, seconds = todo.pop()
+            # Recursive calls are already in the stack
+            weights = {caller: edge[3] for caller, edge in stats.stats[path[-1]][4].items() if caller not in path}
+            total = sum(weights.values())
+            if total <= 0.0:
+                stack = ";".join(frameName(entry) for entry in reversed(path))
+                stacks[stack] = stacks.get(stack, 0.0) + seconds
+                continue
+            left = seconds
+            for caller, weight in weights.items():
+                part = seconds * weight / total
+                if part >= mintime:
+                    todo.append((path + [caller], part))
+                    left -= part
+            # The callers with too little time to show up are all
+            # lumped in with the busiest one.
+            if left > seconds * 1e-9:
+                todo.append((path + [max(weights, key=weights.get)], left))
+
+    return stacks
+
+# A worker process that wasn't forked imports this before it starts.
+# A spawned one doesn't run the fork hooks, so it starts profiling now,
+# and a fork server profiles the workers it forks. The variable isn't
+# passed on to anything else they run.
+if os.getenv(envvar) is not None:
+    profiler = Profiler(os.environ.pop(envvar))
+    if "--multiprocessing-fork" in sys.orig_argv:
+        startWorker(profiler)
+    else:
+        profileWorkers(profiler)
@@ -27,7 +27,7 @@ import geojson
 from shapely.geometry import shape, LineString, Polygon, mapping
 import shapely
 from codetiming import Timer
-from cpuinfo import get_cpu_info
+from osm_merge.lazyload import cpuCount
 from time import sleep
 from pathlib import Path
 from tqdm import tqdm
@@ -44,10 +44,9 @@ import subprocess
 log = logging.getLogger(__name__)
 
 # The number of threads is based on the CPU cores
-info = get_cpu_info()
 # Try doubling the number of cores, since the CPU load is
 # still reasonable.
-cores = info['count']
+cores = cpuCount()
 
 class ReadGeojson(object):
     def __init__(self,
@@ -0,0 +1,386 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import geojson
+from geojson import Feature
+from osm_merge.osmfile import OsmFile, encodeBlocks, encodeOSM
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+# Output is written in large blocks instead of a feature at a time
+buffersize = 1024 * 1024
+
+def encodeGeoJson(features: list,
+                  start: int,
+                  ) -> bytes:
+    """
+    Convert a block of features to part of a FeatureCollection, the
+    same as GeoJsonSink writes them.
+
+    Args:
+        features (list): The features to convert
+        start (int): The position of the first feature in the FeatureCollection
+
+    Returns:
+        (bytes): The GeoJson for the features
+    """
+    out = list()
+    for position, feature in enumerate(features, start):
+        if position > 0:
+            out.append(",")
+        out.append("\n")
+        out.append(geojson.dumps(feature))
+    return "".join(out).encode("utf-8")
+
+def encodeGeoJsonSeq(features: list,
+                     start: int,
+                     ) -> bytes:
+    """
+    Convert a block of features to lines of GeoJson.
+
+    Args:
+        features (list): The features to convert
+        start (int): The position of the first feature in the file
+
+    Returns:
+        (bytes): The GeoJson for the features
+    """
+    return "".join([geojson.dumps(feature) + "\n" for feature in features]).encode("utf-8")
+
+class FeatureSink(object):
+    """Base class for writing features to a file as they are produced."""
+
+    def __init__(self,
+                 filespec: str,
+                 ):
+        """
+        Open the output file.
+
+        Args:
+            filespec (str): The output file
+
+        Returns:
+            (FeatureSink): An instance of this object
+        """
+        self.filespec = filespec
+        self.file = open(filespec, "w", encoding="utf-8", buffering=buffersize)
+        self.count = 0
+        self.header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def header(self):
+        """Write the header of the file, if it has one."""
+        pass
+
+    def footer(self):
+        """Write the footer of the file, if it has one."""
+        pass
+
+    def write(self,
+              feature: Feature,
+              ):
+        """
+        Write a feature to the file.
+
+        Args:
+            feature (Feature): The feature to write
+        """
+        raise NotImplementedError
+
+    def writeAll(self,
+                 features: list,
+                 workers: int = None,
+                 ):
+        """
+        Write a list of features to the file.
+
+        Args:
+            features (list): The features to write
+            workers (int): The number of worker processes, if the sink can use them
+        """
+        for feature in features:
+            self.write(feature)
+
+    def writeBlocks(self,
+                    encoder: callable,
+                    features: list,
+                    workers: int = None,
+                    start: int = None,
+                    **kwargs,
+                    ):
+        """
+        Write a list of features that are converted in blocks by a
+        process pool.
+
+        Args:
+            encoder (callable): The function that converts a block of features
+            features (list): The features to write
+            workers (int): The number of worker processes, all the cores by default
+            start (int): The position of the first feature for the encoder, the number written by default
+        """
+        if start is None:
+            start = self.count
+        self.file.flush()
+        for block in encodeBlocks(encoder, features, start, workers, **kwargs):
+            self.file.buffer.write(block)
+        self.count += len(features)
+
+    def close(self):
+        """Finish and close the file. Closing it again does nothing."""
+        if self.file is None:
+            return
+        self.footer()
+        self.file.close()
+        self.file = None
+        log.info(f"Wrote {self.count} features to {self.filespec}")
+
+class GeoJsonSink(FeatureSink):
+    """Write a GeoJson FeatureCollection, one feature per line."""
+
+    def header(self):
+        """Write the start of the FeatureCollection."""
+        self.file.write('{"type": "FeatureCollection", "features": [')
+
+    def footer(self):
+        """Write the end of the FeatureCollection."""
+        self.file.write("\n]}\n")
+
+    def write(self,
+              feature: Feature,
+              ):
+        """
+        Write a feature to the FeatureCollection.
+
+        Args:
+            feature (Feature): The feature to write
+        """
+        if self.count > 0:
+            self.file.write(",")
+        self.file.write("\n")
+        self.file.write(geojson.dumps(feature))
+        self.count += 1
+
+    def writeAll(self,
+                 features: list,
+                 workers: int = None,
+                 ):
+        """
+        Write a list of features to the FeatureCollection, converting
+        them in parallel.
+
+        Args:
+            features (list): The features to write
+            workers (int): The number of worker processes, all the cores by default
+        """
+        self.writeBlocks(encodeGeoJson, features, workers)
+
+class GeoJsonSeqSink(FeatureSink):
+    """Write newline delimited GeoJson, one feature per line."""
+
+    def write(self,
+              feature: Feature,
+              ):
+        """
+        Write a feature as a line of GeoJson.
+
+        Args:
+            feature (Feature): The feature to write
+        """
+        self.file.write(geojson.dumps(feature))
+        self.file.write("\n")
+        self.count += 1
+
+    def writeAll(self,
+                 features: list,
+                 workers: int = None,
+                 ):
+        """
+        Write a list of features as lines of GeoJson, converting them
+        in parallel.
+
+        Args:
+            features (list): The features to write
+            workers (int): The number of worker processes, all the cores by default
+        """
+        self.writeBlocks(encodeGeoJsonSeq, features, workers)
+
+class OsmSink(FeatureSink):
+    """
+    Write an OSM XML file. Each feature uses up the next negative ID,
+    even if it isn't written, so features converted in other processes
+    get the same IDs as when they're written one at a time.
+    """
+
+    def header(self):
+        """Write the header of the OSM XML file."""
+        self.osm = OsmFile()
+        self.osm.file = self.file
+        self.osm.header()
+        # OsmFile.writeOSM() puts any nodes first, then the ways
+        self.file.write("\n")
+
+    def footer(self):
+        """Write the footer of the OSM XML file."""
+        self.file.write("\n")
+        self.osm.footer()
+
+    def write(self,
+              feature: Feature,
+              ):
+        """
+        Write a feature to the OSM XML file.
+
+        Args:
+            feature (Feature): The feature to write
+        """
+        osmid = self.osm.osmid
+        out = self.osm.featureToOSM(feature, osmid)
+        self.osm.osmid = osmid - 1
+        if out is None:
+            return
+        self.file.write(out)
+        self.count += 1
+
+    def writeAll(self,
+                 features: list,
+                 workers: int = None,
+                 ):
+        """
+        Write a list of features to the OSM XML file, converting them
+        in parallel.
+
+        Args:
+            features (list): The features to write
+            workers (int): The number of worker processes, all the cores by default
+        """
+        self.writeBlocks(encodeOSM, features, workers, start=0,
+                         firstid=self.osm.osmid, timestamp=self.osm.timestamp)
+        self.osm.osmid -= len(features)
+
+class PbfSink(FeatureSink):
+    """Write an OSM PBF file. The ways are written after all the nodes."""
+
+    def __init__(self,
+                 filespec: str,
+                 ):
+        """
+        Open the output file.
+
+        Args:
+            filespec (str): The output file
+
+        Returns:
+            (PbfSink): An instance of this object
+        """
+        self.filespec = filespec
+        self.count = 0
+        self.osm = OsmFile()
+        self.osm.startPBF(filespec)
+
+    def write(self,
+              feature: Feature,
+              ):
+        """
+        Write a feature to the OSM PBF file.
+
+        Args:
+            feature (Feature): The feature to write
+        """
+        if self.osm.addPBF(feature):
+            self.count += 1
+
+    def close(self):
+        """Finish and close the file. Closing it again does nothing."""
+        if self.osm is None:
+            return
+        self.osm.finishPBF()
+        self.osm = None
+        log.info(f"Wrote {self.count} features to {self.filespec}")
+
+class OsmChangeSink(FeatureSink):
+    """
+    Write an osmChange file with only the nodes and ways that had their
+    tags changed. It's written when it's closed, since the current
+    tags have to be read from the original OSM file.
+    """
+
+    def __init__(self,
+                 filespec: str,
+                 original: str,
+                 ):
+        """
+        Args:
+            filespec (str): The output file
+            original (str): The OSM XML or PBF file the data was conflated with
+
+        Returns:
+            (OsmChangeSink): An instance of this object
+        """
+        self.filespec = filespec
+        self.count = 0
+        self.osm = OsmFile()
+        self.osm.startChange(filespec, original)
+
+    def write(self,
+              feature: Feature,
+              ):
+        """
+        Add the tags of a feature to the osmChange file.
+
+        Args:
+            feature (Feature): The feature to write
+        """
+        self.osm.addChange(feature)
+
+    def close(self):
+        """Write and close the file. Closing it again does nothing."""
+        if self.osm is None:
+            return
+        self.count = self.osm.finishChange()
+        self.osm = None
+        log.info(f"Wrote {self.count} modified nodes and ways to {self.filespec}")
+
+def openSink(filespec: str,
+             original: str = None,
+             ) -> FeatureSink:
+    """
+    Open the right sink for the output file based on it's suffix.
+
+    Args:
+        filespec (str): The output file
+        original (str): The OSM file the data was conflated with, which an osmChange file needs
+
+    Returns:
+        (FeatureSink): The sink to write the features to
+    """
+    if filespec.endswith(".osm"):
+        return OsmSink(filespec)
+    elif filespec.endswith(".pbf"):
+        return PbfSink(filespec)
+    elif filespec.endswith(".osc"):
+        return OsmChangeSink(filespec, original)
+    elif filespec.endswith(".geojsonl") or filespec.endswith(".geojsons"):
+        return GeoJsonSeqSink(filespec)
+    else:
+        return GeoJsonSink(filespec)
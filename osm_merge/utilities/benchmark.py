@@ -0,0 +1,381 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import logging
+import sys
+import os
+import math
+import json
+import random
+import resource
+import tempfile
+import concurrent.futures
+import multiprocessing
+from time import perf_counter
+import geojson
+from geojson import Feature, FeatureCollection, LineString
+import numpy
+from osm_merge.profiler import startProfile
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+# The words the highway names are made from
+prefixes = ["Bear", "Elk", "Deer", "Aspen", "Pine", "Cedar", "Willow", "Beaver",
+            "Lost", "Silver", "Bald", "Eagle", "Coyote", "Juniper", "Sheep", "Red"]
+suffixes = ["Creek", "Canyon", "Ridge", "Lake", "Mesa", "Park", "Spring", "Gulch"]
+types = ["Road", "Trail", "Jeep Road", "Cutoff"]
+
+# The origin of the synthetic highways
+origin = (-108.0, 38.0)
+# Meters per degree of latitude
+meters = 111320.0
+
+def addTypo(name: str,
+            rand: random.Random,
+            ) -> str:
+    """
+    Add a typo to a name, by swapping or dropping a character.
+
+    Args:
+        name (str): The name
+        rand (random.Random): The random number generator
+
+    Returns:
+        (str): The name with a typo
+    """
+    if len(name) < 3:
+        return name
+    index = rand.randrange(1, len(name) - 1)
+    if rand.random() < 0.5:
+        return name[:index] + name[index + 1] + name[index] + name[index + 2:]
+    return name[:index] + name[index + 1:]
+
+def makeNetwork(count: int,
+                seed: int = 1,
+                noise: float = 2.0,
+                offset: float = 3.0,
+                typos: float = 0.1,
+                refs: float = 0.3,
+                missing: float = 0.1,
+                ) -> tuple:
+    """
+    Make a synthetic highway network, and a copy of it like an external
+    dataset would have. The external copy has noise and an offset
+    added to the geometry, typos in the names, and variations of the
+    refs. Some of the external highways aren't in OSM. The density of
+    the highways is the same for any size.
+
+    Args:
+        count (int): The number of highway segments in OSM
+        seed (int): The seed for the random numbers, so it's repeatable
+        noise (float): The standard deviation of the noise in meters
+        offset (float): The offset of each external highway in meters
+        typos (float): The fraction of external names with a typo
+        refs (float): The fraction of external refs that use another format
+        missing (float): The fraction of external highways not in OSM
+
+    Returns:
+        (list): The external features
+        (list): The OSM features
+        (list): The OSM ID each external feature should match, or None
+    """
+    rand = random.Random(seed)
+    generator = numpy.random.default_rng(seed)
+    extra = int(count * missing)
+    total = count + extra
+    vertices = 6
+    step = 60.0
+
+    # Each highway is a random walk from a random start
+    side = math.sqrt(total) * 500.0
+    scale = numpy.array([meters * math.cos(math.radians(origin[1])), meters])
+    starts = generator.uniform(0.0, side, (total, 1, 2))
+    headings = generator.uniform(0.0, 2 * math.pi, (total, 1)) + \
+        numpy.cumsum(generator.normal(0.0, 0.2, (total, vertices)), axis=1)
+    steps = numpy.stack([numpy.cos(headings), numpy.sin(headings)], axis=2) * step
+    steps[:, 0, :] = 0.0
+    coords = starts + numpy.cumsum(steps, axis=1)
+
+    # The external copies have noise and an offset
+    directions = generator.uniform(0.0, 2 * math.pi, total)
+    shift = numpy.stack([numpy.cos(directions), numpy.sin(directions)], axis=1)[:, None, :] * offset
+    external = coords + shift + generator.normal(0.0, noise, coords.shape)
+
+    osmcoords = (coords / scale + origin).tolist()
+    extcoords = (external / scale + origin).tolist()
+    primary = list()
+    secondary = list()
+    truth = list()
+    for index in range(total):
+        name = f"{rand.choice(prefixes)} {rand.choice(suffixes)} {rand.choice(types)}"
+        ref = f"FR {rand.randrange(1, 999)}.{rand.randrange(1, 9)}"
+        tags = {"highway": "track", "ref:usfs": ref}
+        if rand.random() < 0.8:
+            tags["name"] = name
+        if index < count:
+            osmid = 1000 + index
+            secondary.append(Feature(geometry=LineString(osmcoords[index]),
+                                     properties=dict(tags, id=osmid, version=1)))
+            truth.append(osmid)
+        else:
+            truth.append(None)
+        if "name" in tags and rand.random() < typos:
+            tags["name"] = addTypo(tags["name"], rand)
+        if rand.random() < refs:
+            if rand.random() < 0.5:
+                tags["ref:usfs"] = ref.replace("FR ", "FS ")
+            else:
+                tags["ref:usfs"] = ref.lower()
+        # This is how the output is matched to the ground truth
+        tags["bench:id"] = index
+        primary.append(Feature(geometry=LineString(extcoords[index]), properties=tags))
+
+    # The order of the datasets shouldn't match
+    order = list(range(total))
+    rand.shuffle(order)
+    primary = [primary[index] for index in order]
+    truth = [truth[index] for index in order]
+    for position, entry in enumerate(primary):
+        entry["properties"]["bench:id"] = position
+    rand.shuffle(secondary)
+
+    return primary, secondary, truth
+
+def scoreResults(data: list,
+                 truth: list,
+                 ) -> dict:
+    """
+    Compare the conflated output to the ground truth. A feature the
+    conflator decides is already in OSM isn't in the output at all,
+    so those are counted as unchanged.
+
+    Args:
+        data (list): The conflated features that were found in OSM
+        truth (list): The OSM ID each external feature should match, or None
+
+    Returns:
+        (dict): The counts of each result, and the precision and recall
+    """
+    matched = dict()
+    for feature in data:
+        position = feature["properties"].get("bench:id")
+        if position is None:
+            continue
+        if position not in matched:
+            matched[position] = set()
+        matched[position].add(feature["properties"].get("id"))
+
+    result = {"correct": 0, "wrong": 0, "unchanged": 0, "false": 0, "new": 0}
+    for position, osmid in enumerate(truth):
+        found = matched.get(position, set())
+        if osmid is None:
+            if len(found) > 0:
+                result["false"] += 1
+            else:
+                result["new"] += 1
+        elif osmid in found:
+            result["correct"] += 1
+        elif len(found) > 0:
+            result["wrong"] += 1
+        else:
+            result["unchanged"] += 1
+    output = result["correct"] + result["wrong"] + result["false"]
+    expected = len(truth) - result["false"] - result["new"]
+    result["precision"] = result["correct"] / output if output > 0 else 0.0
+    result["recall"] = (result["correct"] + result["unchanged"]) / expected if expected > 0 else 0.0
+    return result
+
+def benchPairs(cutils,
+               primary: list,
+               secondary: list,
+               truth: list,
+               pairs: int = 10000,
+               ) -> dict:
+    """
+    Time the low level functions on the matching pairs of highways.
+
+    Args:
+        cutils (Conflator): The conflator to use
+        primary (list): The external features
+        secondary (list): The OSM features
+        truth (list): The OSM ID each external feature should match, or None
+        pairs (int): The maximum number of pairs to time
+
+    Returns:
+        (dict): The number of pairs each function does per second
+    """
+    osm = {feature["properties"]["id"]: feature for feature in secondary}
+    matches = [(entry, osm[osmid]) for entry, osmid in zip(primary, truth) if osmid is not None][:pairs]
+    cutils.projectFeatures([entry for entry, existing in matches])
+    cutils.projectFeatures([existing for entry, existing in matches])
+
+    result = dict()
+    for name, function in (("getDistance", cutils.getDistance),
+                           ("getSlope", cutils.getSlope),
+                           ("checkTags", cutils.checkTags),
+                           ):
+        start = perf_counter()
+        for entry, existing in matches:
+            function(entry, existing)
+        seconds = perf_counter() - start
+        result[name] = len(matches) / seconds if seconds > 0 else 0.0
+
+    start = perf_counter()
+    for entry, existing in matches:
+        cutils.scoreCandidates(entry, [existing])
+    seconds = perf_counter() - start
+    result["scoreCandidates"] = len(matches) / seconds if seconds > 0 else 0.0
+
+    return result
+
+def benchSize(count: int,
+              options: dict,
+              ) -> dict:
+    """
+    Run the benchmark for one size. This runs in it's own process, so
+    the peak memory is only for this size.
+
+    Args:
+        count (int): The number of highway segments in OSM
+        options (dict): The options for the benchmark
+
+    Returns:
+        (dict): The results
+    """
+    # This is imported here so the memory it uses is in each process
+    from osm_merge.conflator import Conflator, getReport
+
+    start = perf_counter()
+    primary, secondary, truth = makeNetwork(count, options["seed"], options["noise"], options["offset"],
+                                            options["typos"], options["refs"], options["missing"])
+    generate = perf_counter() - start
+
+    result = {"size": count, "primary": len(primary), "secondary": len(secondary), "generate": generate}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        primaryspec = os.path.join(tmpdir, "primary.geojson")
+        secondaryspec = os.path.join(tmpdir, "secondary.geojson")
+        with open(primaryspec, "w") as file:
+            geojson.dump(FeatureCollection(primary), file)
+        with open(secondaryspec, "w") as file:
+            geojson.dump(FeatureCollection(secondary), file)
+
+        if options["pairs"] > 0:
+            result["pairs"] = benchPairs(Conflator(), primary, secondary, truth, options["pairs"])
+        del primary
+        del secondary
+
+        getReport(True)
+        cutils = Conflator()
+        start = perf_counter()
+        data = cutils.conflateData(primaryspec, secondaryspec, options["threshold"],
+                                   store=options["store"], workers=options.get("workers"))
+        seconds = perf_counter() - start
+
+    result["seconds"] = seconds
+    result["features/second"] = len(truth) / seconds if seconds > 0 else 0.0
+    # This is in kilobytes on Linux. Conflation may use worker
+    # processes, which aren't included in this one's.
+    result["peak rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    result["peak worker rss"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    result["matches"] = scoreResults(data[0], truth)
+    result["report"] = getReport()
+    return result
+
+def main():
+    """This main function lets this class be run standalone by a bash script"""
+    parser = argparse.ArgumentParser(
+        prog="osm-merge-benchmark",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="This program benchmarks conflation with synthetic highways",
+        epilog="""
+This program makes a synthetic highway network for each size, and an
+external dataset from it with noise, typos, and different refs. Then
+it conflates them, and records the throughput, the peak memory, and
+how many of the highways were matched correctly. Everything is
+generated, so it runs offline.
+
+    For Example:
+        osm-merge-benchmark -v -s 1000,10000,100000 -o before.json
+        osm-merge-benchmark -s 1000000 --store -o after.json
+        """,
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="verbose output")
+    parser.add_argument("-s", "--sizes", default="1000,10000,100000", help="The number of OSM highways in each run")
+    parser.add_argument("-o", "--outfile", default="benchmark.json", help="The output file for the results")
+    parser.add_argument("-t", "--threshold", default=7.0, help="Threshold for distance calculations")
+    parser.add_argument("--seed", default=1, help="The seed for the random numbers")
+    parser.add_argument("--noise", default=2.0, help="The noise added to the external highways in meters")
+    parser.add_argument("--offset", default=3.0, help="The offset of the external highways in meters")
+    parser.add_argument("--typos", default=0.1, help="The fraction of external names with a typo")
+    parser.add_argument("--refs", default=0.3, help="The fraction of external refs in another format")
+    parser.add_argument("--missing", default=0.1, help="The fraction of external highways not in OSM")
+    parser.add_argument("--pairs", default=10000, help="The number of pairs to time the low level functions with")
+    parser.add_argument("--store", action="store_true", help="Use a FeatureStore for the datasets")
+    parser.add_argument("--workers", help="The number of processes to conflate with, all the cores by default")
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
+    args = parser.parse_args()
+
+    if args.profile:
+        startProfile(args.profile)
+
+    # if verbose, dump to the terminal.
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+        ch = logging.StreamHandler(sys.stdout)
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter(
+            "%(threadName)10s - %(name)s - %(levelname)s - %(message)s"
+        )
+        ch.setFormatter(formatter)
+        log.addHandler(ch)
+
+    options = {"seed": int(args.seed),
+               "noise": float(args.noise),
+               "offset": float(args.offset),
+               "typos": float(args.typos),
+               "refs": float(args.refs),
+               "missing": float(args.missing),
+               "threshold": float(args.threshold),
+               "pairs": int(args.pairs),
+               "store": args.store,
+               "workers": int(args.workers) if args.workers else None,
+               }
+    results = {"options": options, "runs": list()}
+    # Each size runs in a new process, so the peak memory of one
+    # doesn't include the ones before it.
+    context = multiprocessing.get_context("spawn")
+    for size in args.sizes.split(','):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(benchSize, int(size), options).result()
+        results["runs"].append(result)
+        print(f"{result['size']:>8} highways: {result['seconds']:.2f}s, "
+              f"{result['features/second']:.0f} features/s, "
+              f"peak RSS {result['peak rss'] / (1024 * 1024):.0f}MB, "
+              f"workers {result['peak worker rss'] / (1024 * 1024):.0f}MB, "
+              f"precision {result['matches']['precision']:.3f}, "
+              f"recall {result['matches']['recall']:.3f}")
+
+    with open(args.outfile, "w") as file:
+        json.dump(results, file, indent=4)
+    log.info(f"Wrote {args.outfile}")
+
+if __name__ == "__main__":
+    """This is just a hook so this file can be run standlone during development."""
+    main()
@@ -27,11 +27,14 @@ import sys
 import os
 import re
 from datetime import datetime
-import fiona
+from osm_merge.lazyload import lazyImport
 
 import osm_merge as om
 rootdir = om.__path__[0]
 
+# This is only loaded when it's used, so the program starts faster
+fiona = lazyImport("fiona")
+
 # Instantiate logger
 log = logging.getLogger(__name__)
 
@@ -29,6 +29,7 @@ from shapely.geometry import shape
 from shapely import prepare, from_geojson, from_wkt, contains, intersects, intersection, difference
 from progress.spinner import Spinner
 import geojson
+from osm_merge.profiler import startProfile
 # from osmium.filter import GeoInterfaceFilter
 
 # https://prd-tnm.s3.amazonaws.com/index.html?prefix=StagedProducts/TopoMapVector/
@@ -52,8 +53,13 @@ many of the bugs with names that are actually a reference number.
     )
     parser.add_argument("-v", "--verbose", action="store_true", help="verbose output")
     parser.add_argument("-i", "--infile", required=True, help="Top-level input directory")
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
     args = parser.parse_args()
 
+    if args.profile:
+        startProfile(args.profile)
+
     # if verbose, dump to the terminal.
     if args.verbose:
         log.setLevel(logging.DEBUG)
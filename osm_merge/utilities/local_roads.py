@@ -33,15 +33,10 @@ import geojson
 from shapely.geometry import shape, LineString, Polygon, mapping
 import shapely
 from shapely.ops import transform
-import pyproj
-import asyncio
 from codetiming import Timer
 import concurrent.futures
-from cpuinfo import get_cpu_info
-from thefuzz import fuzz, process
+from osm_merge.lazyload import cpuCount
 from pathlib import Path
-from tqdm import tqdm
-import tqdm.asyncio
 from progress.bar import Bar, PixelBar
 from osm_merge.yamlfile import YamlFile
 
@@ -52,8 +47,7 @@ rootdir = om.__path__[0]
 log = logging.getLogger(__name__)
 
 # The number of threads is based on the CPU cores
-info = get_cpu_info()
-cores = info['count']
+cores = cpuCount()
 
 # shut off warnings from pyproj
 import warnings
@@ -29,36 +29,33 @@ import re
 from sys import argv
 from osm_merge.osmfile import OsmFile
 from osm_merge.yamlfile import YamlFile
+from osm_merge.profiler import startProfile
 from geojson import Point, Feature, FeatureCollection, dump, Polygon, load
 # import geojson
 from shapely.geometry import shape, LineString, Polygon, mapping
 import shapely
 from shapely.ops import transform
-import pyproj
-import asyncio
 from codetiming import Timer
 import concurrent.futures
-from cpuinfo import get_cpu_info
+from osm_merge.lazyload import cpuCount, lazyImport
 from time import sleep
-from thefuzz import fuzz, process
 from pathlib import Path
-from tqdm import tqdm
-import tqdm.asyncio
 from progress.bar import Bar, PixelBar
 import yaml
-import fiona
 import concurrent.futures
 from datetime import datetime
 
 import osm_merge as om
 rootdir = om.__path__[0]
 
+# These are only loaded when they're used, so the program starts faster
+fiona = lazyImport("fiona")
+
 # Instantiate logger
 log = logging.getLogger(__name__)
 
 # The number of threads is based on the CPU cores
-info = get_cpu_info()
-cores = info['count']
+cores = cpuCount()
 
 # shut off warnings from pyproj
 import warnings
@@ -404,9 +401,14 @@ good to avoid any highway with a smoothness of "very bad" or worse.
     parser.add_argument("-i", "--infile", required=True, help="Output file from the conflation")
     parser.add_argument("-c", "--convert", default=True, action="store_true", help="Convert MVUM feature to OSM feature")
     parser.add_argument("-o", "--outfile", default="out.geojson", help="Output file")
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
 
     args = parser.parse_args()
 
+    if args.profile:
+        startProfile(args.profile)
+
     # if verbose, dump to the terminal.
     log_level = os.getenv("LOG_LEVEL", default="INFO")
     if args.verbose is not None:
@@ -21,21 +21,17 @@ import sys
 import os
 from sys import argv
 from osm_merge.osmfile import OsmFile
+from osm_merge.profiler import startProfile
 from geojson import Point, Feature, FeatureCollection, dump, Polygon, load
 import geojson
 from shapely.geometry import shape, LineString, Polygon, mapping
 import shapely
 from shapely.ops import transform
-import pyproj
-import asyncio
 from codetiming import Timer
 import concurrent.futures
-from cpuinfo import get_cpu_info
+from osm_merge.lazyload import cpuCount
 from time import sleep
-from thefuzz import fuzz, process
 from pathlib import Path
-from tqdm import tqdm
-import tqdm.asyncio
 
 
 # ogrmerge.py -single -o trails.shp VECTOR_*/Shape/Trans_TrailSegment.shp
@@ -45,8 +41,7 @@ import tqdm.asyncio
 log = logging.getLogger(__name__)
 
 # The number of threads is based on the CPU cores
-info = get_cpu_info()
-cores = info['count']
+cores = cpuCount()
 
 # shut off warnings from pyproj
 import warnings
@@ -121,9 +116,14 @@ def main():
     parser.add_argument("-c", "--convert", default=True, action="store_true", help="Convert USGS feature to OSM feature")
     parser.add_argument("-s", "--state", default="CO", help="The state the dataset is in")
     parser.add_argument("-o", "--outfile", default="out.geojson", help="Output file")
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
 
     args = parser.parse_args()
 
+    if args.profile:
+        startProfile(args.profile)
+
     # if verbose, dump to the terminal.
     if args.verbose:
         log.setLevel(logging.DEBUG)
@@ -28,13 +28,19 @@ import os
 from sys import argv
 from codetiming import Timer
 from pathlib import Path
-import osmium
-from osmium.geom import GeoJSONFactory
 import re
-from shapely.geometry import shape
-from shapely import prepare, from_geojson, from_wkt, contains, intersects, intersection, difference
+from array import array
+import numpy
+from shapely.geometry import shape, LineString
+from shapely import prepare, from_geojson, from_wkt, contains, intersects, difference
 from progress.spinner import Spinner
 import geojson
+from osm_merge.profiler import startProfile
+from osm_merge.lazyload import lazyImport
+from osm_merge.nodeindex import NodeIndex
+
+# This is only loaded when it's used, so the program starts faster
+osmium = lazyImport("osmium")
 
 # Instantiate logger
 log = logging.getLogger(__name__)
@@ -254,43 +260,36 @@ def clip(boundary: str,
 
     if os.path.exists(outfile):
         os.remove(outfile)
-    nodes = set()
-    # Pre-filter the ways by tags. The less object we need to look at, the better.
-    way_filter = osmium.filter.KeyFilter('highway')
-    # only scan the ways of the file
-    spin = Spinner('Processing nodes...')
-    fp = osmium.FileProcessor(infile, osmium.osm.WAY).with_filter(osmium.filter.KeyFilter('highway'))
-    for obj in fp:
-       spin.next()
-       if "highway" in obj.tags:
-           nodes.update(n.ref for n in obj.nodes)
+    # The locations of the nodes in the highways are saved next to the
+    # output file, so clipping the same extract again doesn't have to
+    # find them.
+    cache = os.path.join(os.path.dirname(outfile), f"{Path(infile).name}.highways")
+    refs = None
+    if not NodeIndex.isCurrent(cache, infile, "highway"):
+        refs = array("q")
+        # only scan the ways of the file
+        spin = Spinner('Processing nodes...')
+        fp = osmium.FileProcessor(infile, osmium.osm.WAY).with_filter(osmium.filter.KeyFilter('highway'))
+        for obj in fp:
+           spin.next()
+           if "highway" in obj.tags:
+               refs.extend(n.ref for n in obj.nodes)
+        refs = numpy.unique(numpy.frombuffer(refs, dtype=numpy.int64))
+    nodes = NodeIndex.fromFile(infile, cache, refs, "highway")
 
     writer = osmium.SimpleWriter(outfile)
 
-    # We need nodes and ways in the second pass.
-    fab = GeoJSONFactory()
+    # The locations come from the index, so only the ways are read.
     spin = Spinner('Processing ways...')
-    way_filter = osmium.filter.KeyFilter('highway').enable_for(osmium.osm.WAY)
-    for obj in osmium.FileProcessor(infile, osmium.osm.WAY | osmium.osm.NODE).with_filter(way_filter).with_locations():
+    for obj in osmium.FileProcessor(infile, osmium.osm.WAY).with_filter(osmium.filter.KeyFilter('highway')):
         spin.next()
-        if obj.is_node() and obj.id in nodes:
-            # We don't want POIs for barrier or crossing, just LineStrings
-            if len(obj.tags) > 0:
-                continue
-            wkt = fab.create_point(obj)
-            geom = shape(geojson.loads(wkt))
-            # Add a node if it exists within the boundary
-            if contains(task, geom) or intersects(task, geom):
-                # writer.add(obj)
-                # log.debug(f"Adding {obj.id}")
-                continue
-                # Strip the object of tags along the way
-            # writer.add_node(obj.replace(tags={}))
-        elif obj.is_way() and "highway" in obj.tags:
-            wkt = fab.create_linestring(obj.nodes)
-            geom = shape(geojson.loads(wkt))
-            if contains(task, geom) or intersection(task, geom):
-                writer.add_way(obj)
+        coords = nodes.lookup([n.ref for n in obj.nodes])
+        if len(coords) < 2:
+            continue
+        geom = LineString(coords)
+        if contains(task, geom) or intersects(task, geom):
+            writer.add_way(obj)
+    writer.close()
     timer.stop()
     return True
 
@@ -313,8 +312,14 @@ many of the bugs with names that are actually a reference number.
     parser.add_argument("-o", "--outfile", default="out.osm", help="Output file")
     # parser.add_argument("-c", "--clip", help="Clip file by polygon")
     # parser.add_argument("-s", "--small", help="Small dataset")
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
 
     args = parser.parse_args()
+
+    if args.profile:
+        startProfile(args.profile)
+
     # if verbose, dump to the terminal.
     log_level = os.getenv("LOG_LEVEL", default="INFO")
     if args.verbose is not None:
@@ -25,27 +25,20 @@ Tasking Manager.
 # from tqdm import tqdm
 # import tqdm.asyncio
 from codetiming import Timer
-from cpuinfo import get_cpu_info
+from osm_merge.lazyload import cpuCount, lazyImport
 from functools import partial
 from geojson import Feature, FeatureCollection, GeoJSON
 #from io import BytesIO
 from math import ceil
-from osgeo import ogr
-from osgeo import osr
 from pathlib import Path
-import osmium
-from osmium.geom import GeoJSONFactory
-import fiona
 from progress.spinner import Spinner
 from shapely import contains, intersects, intersection
-from psycopg2.extensions import connection
-from shapely.geometry import Polygon, shape, LineString, MultiPolygon, box, shape, mapping, MultiLineString
+from shapely.geometry import Point, Polygon, shape, LineString, MultiPolygon, box, shape, mapping, MultiLineString
 from shapely.geometry.geo import mapping
 from shapely.ops import split, transform, unary_union
 # from shapely.prepared import prep
 # from textwrap import dedent
 import argparse
-import asyncio
 import geojson
 import logging
 import math
@@ -53,17 +46,23 @@ import numpy as np
 import os
 import shapely
 import sys
-import pyproj
 from progress.bar import Bar, PixelBar
+from osm_merge.profiler import startProfile
+from osm_merge.nodeindex import NodeIndex
+from array import array
+
+# These are only loaded when they're used, so the program starts faster
+osmium = lazyImport("osmium")
+fiona = lazyImport("fiona")
+pyproj = lazyImport("pyproj")
 
 # Instantiate logger
 log = logging.getLogger(__name__)
 
 # The number of threads is based on the CPU cores
-info = get_cpu_info()
 # Try doubling the number of cores, since the CPU load is
 # still reasonable.
-cores = info['count']
+cores = cpuCount()
 
 # shut off warnings from pyproj
 import warnings
@@ -434,10 +433,6 @@ class TM_Splitter(object):
                         polys.append(Polygon(poly[0]))
         logging.debug(f"There are {len(polys)} polygons in the boundary AOI")
 
-        nodes = set()
-        # Pre-filter the ways by tags. The less objects we need to look at, the better.
-        way_filter = osmium.filter.KeyFilter('highway')
-        # only scan the ways of the file
         spin = Spinner('Processing nodes...')
         dir = os.path.dirname(outfile)
         if len(dir) == 0:
@@ -458,44 +453,52 @@ class TM_Splitter(object):
             outfiles[index] = {"task": index, "outfile": writer, "geometry": poly}
             index += 1
 
-        fp = osmium.FileProcessor(infile, osmium.osm.WAY).with_filter(osmium.filter.KeyFilter('highway'))
-        for obj in fp:
+        # The locations of the nodes in the highways are saved in the
+        # output directory, so splitting the same extract again doesn't
+        # have to find them.
+        cache = f"{dir}/{Path(infile).name}.highways"
+        refs = None
+        if not NodeIndex.isCurrent(cache, infile, "highway"):
+            refs = array("q")
+            # Pre-filter the ways by tags. The less objects we need to look at, the better.
+            fp = osmium.FileProcessor(infile, osmium.osm.WAY).with_filter(osmium.filter.KeyFilter('highway'))
+            for obj in fp:
+                spin.next()
+                if "highway" in obj.tags:
+                    refs.extend(n.ref for n in obj.nodes)
+            refs = np.unique(np.frombuffer(refs, dtype=np.int64))
+        nodes = NodeIndex.fromFile(infile, cache, refs, "highway")
+
+        # The nodes have to be written before the ways. Only the ones
+        # in the highways get past the filter.
+        node_filter = osmium.filter.IdFilter(nodes.ids).enable_for(osmium.osm.NODE)
+        for obj in osmium.FileProcessor(infile, osmium.osm.NODE).with_filter(node_filter):
             spin.next()
-            if "highway" in obj.tags:
-                nodes.update(n.ref for n in obj.nodes)
+            # We don't want POIs for barrier or crossing, just LineStrings
+            if len(obj.tags) > 0:
+                continue
+            geom = Point(obj.lon, obj.lat)
+            # Add a node if it exists within the boundary
+            for task, metadata in outfiles.items():
+                if contains(metadata["geometry"], geom) or intersects(metadata["geometry"], geom):
+                    metadata["outfile"].add(obj)
 
-        # We need nodes and ways in the second pass.
-        fab = GeoJSONFactory()
+        # The locations come from the index, so only the ways are read.
         spin = Spinner(f"Processing ways...")
         # FIXME: make this multi-threaded.
-        way_filter = osmium.filter.KeyFilter('highway').enable_for(osmium.osm.WAY)
-        for obj in osmium.FileProcessor(infile, osmium.osm.WAY | osmium.osm.NODE).with_filter(way_filter).with_locations():
+        way_filter = osmium.filter.KeyFilter('highway')
+        for obj in osmium.FileProcessor(infile, osmium.osm.WAY).with_filter(way_filter):
             spin.next()
-            if obj.is_node() and obj.id in nodes:
-                # We don't want POIs for barrier or crossing, just LineStrings
-                if len(obj.tags) > 0:
-                    continue
-                wkt = fab.create_point(obj)
-                geom = shape(geojson.loads(wkt))
-                # Add a node if it exists within the boundary
-                for task, metadata in outfiles.items():
-                    if contains(metadata["geometry"], geom) or intersects(metadata["geometry"], geom):
-                        # breakpoint()
-                        metadata["outfile"].add(obj)
-                        # log.debug(f"Adding {obj.id}")
-                        continue
-                # Strip the object of tags along the way
-                # writer.add_node(obj.replace(tags={}))
-            # elif obj.is_way() and "highway" in obj.tags:
-            elif obj.is_way():
-                wkt = fab.create_linestring(obj.nodes)
-                geom = shape(geojson.loads(wkt))
-                for task, metadata in outfiles.items():
-                    if contains(metadata["geometry"], geom) or intersects(metadata["geometry"], geom):
-                        # breakpoint()
-                        # log.debug(f"Adding way {obj.id}")
-                        metadata["outfile"].add_way(obj)
-            # writer.close()
+            coords = nodes.lookup([n.ref for n in obj.nodes])
+            if len(coords) < 2:
+                continue
+            geom = LineString(coords)
+            for task, metadata in outfiles.items():
+                if contains(metadata["geometry"], geom) or intersects(metadata["geometry"], geom):
+                    # log.debug(f"Adding way {obj.id}")
+                    metadata["outfile"].add_way(obj)
+        for metadata in outfiles.values():
+            metadata["outfile"].close()
         timer.stop()
         return True
 
@@ -540,8 +543,14 @@ To generate the data extracts for each task from the MultiPolygon, do this:
     parser.add_argument("-m", "--meters", default=50000, type=int,
                         help="Grid size in kilometers")
     parser.add_argument("-e", "--extract", help="Extract data for Tasks")
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
 
     args = parser.parse_args()
+
+    if args.profile:
+        startProfile(args.profile)
+
     indata = None
     source = None
 
@@ -24,6 +24,7 @@ from sys import argv
 from osm_merge.osmfile import OsmFile
 from progress.bar import Bar, PixelBar
 from osm_merge.yamlfile import YamlFile
+from osm_merge.profiler import startProfile
 import geojson
 from geojson import Feature, FeatureCollection
 import fiona
@@ -274,9 +275,14 @@ def main():
     parser.add_argument("-c", "--convert", default=True, action="store_true", help="Convert USGS feature to OSM feature")
     parser.add_argument("-s", "--state", default="CO", help="The state the dataset is in")
     parser.add_argument("-o", "--outfile", default="out.geojson", help="Output file")
+    parser.add_argument("--profile", nargs="?", const="profile",
+                        help="Profile this program, and write the results to this directory")
 
     args = parser.parse_args()
 
+    if args.profile:
+        startProfile(args.profile)
+
     # if verbose, dump to the terminal.
     log_level = os.getenv("LOG_LEVEL", default="INFO")
     if args.verbose is not None:
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+from osm_merge.utilities.benchmark import makeNetwork, scoreResults, benchSize
+
+def test_network():
+    """
+    The synthetic network should be repeatable, and have a ground truth.
+    """
+    logging.info("-- Running test_network() --")
+    primary, secondary, truth = makeNetwork(100, seed=3)
+    assert len(secondary) == 100
+    assert len(primary) == len(truth) == 110
+    assert len([osmid for osmid in truth if osmid is None]) == 10
+    osmids = {feature["properties"]["id"] for feature in secondary}
+    assert {osmid for osmid in truth if osmid is not None} == osmids
+
+    again = makeNetwork(100, seed=3)
+    assert again[0] == primary and again[2] == truth
+
+def test_score():
+    """
+    Only the right OSM ID should count as correct.
+    """
+    logging.info("-- Running test_score() --")
+    truth = [1, 2, 3, None, None]
+    data = [{"properties": {"bench:id": 0, "id": 1}},
+            {"properties": {"bench:id": 1, "id": 3}},
+            {"properties": {"bench:id": 3, "id": 1}},
+            ]
+    result = scoreResults(data, truth)
+    assert result["correct"] == 1
+    assert result["wrong"] == 1
+    assert result["unchanged"] == 1
+    assert result["false"] == 1
+    assert result["new"] == 1
+
+def test_bench():
+    """
+    A small run should match almost everything.
+    """
+    logging.info("-- Running test_bench() --")
+    options = {"seed": 1, "noise": 2.0, "offset": 3.0, "typos": 0.1, "refs": 0.3,
+               "missing": 0.1, "threshold": 7.0, "pairs": 50, "store": False}
+    result = benchSize(200, options)
+    assert result["primary"] == 220
+    assert result["matches"]["precision"] > 0.9
+    assert result["matches"]["recall"] > 0.9
+    assert result["peak rss"] > 0
+    assert set(result["pairs"]) == {"getDistance", "getSlope", "checkTags", "scoreCandidates"}
+
+    # The memory of the worker processes is counted separately
+    options.update({"pairs": 0, "workers": 2})
+    result = benchSize(200, options)
+    assert result["peak worker rss"] > 0
@@ -0,0 +1,389 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+import json
+import logging
+import time
+import geojson
+import pytest
+from geojson import Feature, LineString, Point
+from thefuzz import fuzz
+from osm_merge.conflator import Conflator, conflateThread, hashFeature, shareFeatures, getReport, mergeReport, attachFeatures, normalizeRefs, expandName, splitRef, StageTimer
+
+def make_highway(lon, lat, props, offset = 0.0):
+    """
+    Make a short highway segment for testing.
+
+    Args:
+        lon (float): The starting longitude
+        lat (float): The starting latitude
+        props (dict): The tags for the highway
+        offset (float): How far to shift the highway in degrees
+
+    Returns:
+        (Feature): The highway
+    """
+    coords = [(lon + offset + (i * 0.001), lat + offset + (i * 0.0005)) for i in range(5)]
+    return Feature(geometry=LineString(coords), properties=props)
+
+def test_index():
+    """
+    Only features near the primary one should be candidates.
+    """
+    logging.info("-- Running test_index() --")
+    cutils = Conflator()
+    near = make_highway(-108.0, 38.0, {"id": 1, "highway": "track"}, 0.00001)
+    far = make_highway(-107.0, 39.0, {"id": 2, "highway": "track"})
+    poi = Feature(geometry=Point((-108.0, 38.0)), properties={"id": 3})
+    cutils.makeIndex([far, poi, near])
+    entry = make_highway(-108.0, 38.0, {"highway": "track"})
+    result = cutils.queryIndex(entry, 7.0)
+
+    assert result == [near]
+
+def test_projection():
+    """
+    Features should only be projected once, and the distance is
+    in meters.
+    """
+    logging.info("-- Running test_projection() --")
+    cutils = Conflator()
+    osm = make_highway(-108.0, 38.0, {"id": 1, "highway": "track"}, 0.0001)
+    entry = make_highway(-108.0, 38.0, {"highway": "track"})
+    cutils.projectFeatures([osm, entry])
+    geom = cutils.getProjected(osm)
+    cutils.projectFeatures([osm])
+
+    assert cutils.getProjected(osm) is geom
+    assert 5.0 < cutils.getDistance(entry, osm) < 20.0
+
+def test_scoring():
+    """
+    The batch scoring should get the same results as getDistance()
+    and getSlope().
+    """
+    logging.info("-- Running test_scoring() --")
+    cutils = Conflator()
+    entry = make_highway(-108.0, 38.0, {"highway": "track"})
+    candidates = [make_highway(-108.0, 38.0, {"id": i, "highway": "track"}, i * 0.00005) for i in range(5)]
+    candidates.append(Feature(geometry=LineString([(-108.0, 38.0), (-108.0, 38.001)]), properties={"id": 6}))
+    scores = cutils.scoreCandidates(entry, candidates)
+    for index, existing in enumerate(candidates):
+        slope, angle = cutils.getSlope(entry, existing)
+        assert scores["dist"][index] == cutils.getDistance(entry, existing)
+        assert scores["slope"][index] == slope
+        assert abs(scores["angle"][index] - angle) < 1e-9
+
+def test_shared():
+    """
+    Features shared with the worker processes should be the same
+    as the original ones, and use the shared memory in place.
+    """
+    logging.info("-- Running test_shared() --")
+    features = [make_highway(-108.0, 38.0, {"id": i, "name": f"FR {i}"}, i * 0.001) for i in range(3)]
+    shm, layout = shareFeatures(features)
+    try:
+        attached, result = attachFeatures(shm.name, layout)
+        assert [entry["properties"] for entry in result] == [entry["properties"] for entry in features]
+        assert [list(map(list, entry["geometry"]["coordinates"])) for entry in result] == \
+            [list(map(list, entry["geometry"]["coordinates"])) for entry in features]
+        assert result.coords.base is not None and not result.coords.flags.owndata
+        assert result.getProjected(1).equals(Conflator().getProjected(features[1]))
+        del result
+        attached.close()
+    finally:
+        shm.close()
+        shm.unlink()
+
+def test_workers(tmp_path):
+    """
+    Conflating in worker processes should get the same output as
+    conflating in this one.
+    """
+    logging.info("-- Running test_workers() --")
+    # The names are new, so every feature is in the output
+    primary = [make_highway(-108.0 + (i * 0.01), 38.0, {"ref:usfs": f"FR {i}", "name": f"Road {i}"})
+               for i in range(6)]
+    secondary = [make_highway(-108.0 + (i * 0.01), 38.0, {"id": i, "ref:usfs": f"FR {i}"}, 0.00002)
+                 for i in range(6)]
+    primaryspec = str(tmp_path / "primary.geojson")
+    secondaryspec = str(tmp_path / "secondary.geojson")
+    geojson.dump(geojson.FeatureCollection(primary), open(primaryspec, "w"))
+    geojson.dump(geojson.FeatureCollection(secondary), open(secondaryspec, "w"))
+
+    expected = Conflator().conflateData(primaryspec, secondaryspec, workers=1)
+    assert len(expected[0]) > 0
+    for store in (False, True):
+        result = Conflator().conflateData(primaryspec, secondaryspec, workers=2, store=store)
+        assert json.loads(geojson.dumps(result)) == json.loads(geojson.dumps(expected))
+
+def test_tiles():
+    """
+    Each primary feature should be in exactly one tile, and the
+    halo should include the nearby features in the other tiles.
+    """
+    logging.info("-- Running test_tiles() --")
+    cutils = Conflator()
+    primary = [make_highway(-108.0 + (i * 0.3), 38.0, {"id": -i}) for i in range(4)]
+    # This is only near the first primary feature
+    edge = Feature(geometry=LineString([(-107.99999, 38.0), (-108.0001, 38.0001)]), properties={"id": 10})
+    secondary = [make_highway(-108.0 + (i * 0.3), 38.0, {"id": i}, 0.00001) for i in range(4)] + [edge]
+    tiles = list(cutils.makeTiles(primary, secondary, 7.0, 0.5))
+    owned = [entry for tile in tiles for entry in tile[0]]
+
+    assert len(owned) == len(primary)
+    assert len(tiles) == 2
+    assert edge in tiles[0][1]
+    assert edge not in tiles[1][1]
+
+    # Tiles are merged back together in order, however many run at once
+    primary = [make_highway(-108.0 + (i * 0.3), 38.0, {"ref:usfs": f"FR {i}", "name": f"Road {i}"})
+               for i in range(8)]
+    secondary = [make_highway(-108.0 + (i * 0.3), 38.0, {"id": i, "ref:usfs": f"FR {i}"}, 0.00002)
+                 for i in range(8)]
+    expected = conflateThread(primary, secondary)
+    assert len(expected[0]) == 8
+    for workers in (1, 2):
+        result = Conflator().conflateTiles(primary, secondary, 7.0, tilesize=0.5, workers=workers)
+        assert json.loads(geojson.dumps(result)) == json.loads(geojson.dumps(expected))
+
+def test_refs():
+    """
+    Features with the same ref nearby should be matched without
+    any fuzzy matching.
+    """
+    logging.info("-- Running test_refs() --")
+    assert normalizeRefs("fs  123.4") == ("FR 123.4",)
+    assert normalizeRefs("CR 39V;FR 559.1A") == ("CR 39V", "FR 559.1A")
+
+    cutils = Conflator()
+    osm = make_highway(-108.0, 38.0, {"id": 1, "highway": "track", "ref:usfs": "FS 123.4"}, 0.0003)
+    other = make_highway(-108.0, 38.0, {"id": 2, "highway": "track", "ref:usfs": "FS 123.5"})
+    far = make_highway(-107.0, 38.0, {"id": 3, "highway": "track", "ref:usfs": "FR 123.4"})
+    cutils.makeIndex([osm, other, far])
+    entry = make_highway(-108.0, 38.0, {"highway": "track", "ref:usfs": "FR 123.4"})
+    candidates, scores = cutils.matchRefs(entry, 100.0)
+
+    assert candidates == [osm]
+    assert 0 < scores["dist"][0] < 100.0
+    assert splitRef("FR 123.4") == ("FR", "123.4")
+    assert splitRef("12") == ("", "12")
+
+    # Further away than the threshold, but it has the same ref, so
+    # it's checked the same way as a feature within the threshold.
+    def pair():
+        osm = make_highway(-108.0, 38.0, {"id": 1, "ref:usfs": "FR 123.4"}, 0.0003)
+        entry = make_highway(-108.0, 38.0, {"ref:usfs": "FR 123.4", "name": "Bear Creek Road"})
+        return [entry], [osm]
+    result = conflateThread(*pair(), threshold=2.0, refdistance=100.0)
+    assert [feature["properties"]["id"] for feature in result[0]] == [1]
+    assert result == conflateThread(*pair(), threshold=20.0)
+
+    # An identical feature matched by ref doesn't need any changes,
+    # just like when it's matched by the geometry.
+    for refdistance in (0.0, 100.0):
+        existing = make_highway(-108.0, 38.0, {"id": 4, "highway": "track", "ref:usfs": "FR 123.4"})
+        entry = make_highway(-108.0, 38.0, {"highway": "track", "ref:usfs": "FR 123.4"})
+        assert conflateThread([entry], [existing], threshold=7.0, refdistance=refdistance) == [[], []]
+
+def test_names():
+    """
+    The batch name matching should get the same ratios as thefuzz
+    does one pair at a time.
+    """
+    logging.info("-- Running test_names() --")
+    cutils = Conflator()
+    entry = make_highway(-108.0, 38.0, {"name": "Bear Creek Road"})
+    names = ["bear creek road", "Bear Crk Rd", "Beaver Creek Road", None]
+    candidates = [make_highway(-108.0, 38.0, {"id": i, "name": name}) for i, name in enumerate(names)]
+    ratios = cutils.scoreNames(entry, candidates)
+
+    assert ratios[:3] == [fuzz.ratio("bear creek road", name.lower()) for name in names[:3]]
+    assert ratios[3] is None
+    assert cutils.scoreNames(entry, candidates, expand=True)[1] == 100
+    assert expandName("N Fk Crk Rd") == "north fk creek road"
+
+def test_sweep():
+    """
+    Each set of thresholds in a sweep should get the same results as
+    conflating with just those thresholds.
+    """
+    logging.info("-- Running test_sweep() --")
+    def primary():
+        return [make_highway(-108.0 + (i * 0.01), 38.0, {"name": f"Road {i}", "highway": "track"}) for i in range(4)]
+    secondary = [make_highway(-108.0 + (i * 0.01), 38.0, {"id": i, "name": f"Road {i}", "highway": "track"}, i * 0.00002)
+                 for i in range(4)]
+    sweeps = [(1.0, 17.0, 4.0, 80), (10.0, 17.0, 4.0, 80), (10.0, 1.0, 1.0, 100)]
+    cutils = Conflator()
+    results = cutils.conflateSweep(primary(), secondary, sweeps)
+
+    assert len(results) == len(sweeps)
+    for sweep, result in zip(sweeps, results):
+        expected = conflateThread(primary(), secondary, threshold=sweep[0], angle_threshold=sweep[1],
+                                  slope_threshold=sweep[2], match_threshold=sweep[3])
+        assert result == expected
+
+def test_checkpoint(tmp_path):
+    """
+    Conflating in batches with a checkpoint should get the same output,
+    and only redo the batches that aren't saved.
+    """
+    logging.info("-- Running test_checkpoint() --")
+    primary = [make_highway(-108.0 + (i * 0.01), 38.0, {"name": f"Road {i}", "highway": "track"}) for i in range(5)]
+    secondary = [make_highway(-108.0 + (i * 0.01), 38.0, {"id": i, "name": f"Road {i}", "highway": "track"}, 0.00001)
+                 for i in range(5)]
+    primaryspec = str(tmp_path / "primary.geojson")
+    secondaryspec = str(tmp_path / "secondary.geojson")
+    geojson.dump(geojson.FeatureCollection(primary), open(primaryspec, "w"))
+    geojson.dump(geojson.FeatureCollection(secondary), open(secondaryspec, "w"))
+    checkpoint = tmp_path / "checkpoint"
+
+    expected = Conflator().conflateData(primaryspec, secondaryspec, 10.0)
+    result = Conflator().conflateData(primaryspec, secondaryspec, 10.0, checkpoint=str(checkpoint), batchsize=2)
+    assert json.loads(geojson.dumps(result)) == json.loads(geojson.dumps(expected))
+    assert sorted(path.name for path in checkpoint.glob("batch-*")) == \
+        ["batch-000000.geojson", "batch-000001.geojson", "batch-000002.geojson"]
+
+    # Only the missing batch gets conflated again
+    (checkpoint / "batch-000001.geojson").unlink()
+    saved = (checkpoint / "batch-000000.geojson").stat().st_mtime_ns
+    result = Conflator().conflateData(primaryspec, secondaryspec, 10.0, checkpoint=str(checkpoint), batchsize=2)
+    assert json.loads(geojson.dumps(result)) == json.loads(geojson.dumps(expected))
+    assert (checkpoint / "batch-000000.geojson").stat().st_mtime_ns == saved
+
+    # Checkpoints are only for batches, not tiles
+    with pytest.raises(ValueError):
+        Conflator().conflateData(primaryspec, secondaryspec, 10.0, tilesize=0.5, checkpoint=str(checkpoint))
+
+    # Different parameters don't use the old batches
+    cutils = Conflator()
+    manifest = json.load(open(checkpoint / "manifest.json"))
+    manifest["threshold"] = 2.0
+    assert cutils.openCheckpoint(str(checkpoint), manifest) == set()
+
+def test_incremental(tmp_path, caplog):
+    """
+    Only the primary features near a change should get conflated
+    again, and the output should be the same as conflating everything.
+    """
+    logging.info("-- Running test_incremental() --")
+    primary = [make_highway(-108.0 + (i * 0.1), 38.0, {"name": f"Road {i}", "highway": "track"}) for i in range(4)]
+    secondary = [make_highway(-108.0 + (i * 0.1), 38.0, {"id": i, "name": f"Road {i}", "highway": "track"}, 0.00001)
+                 for i in range(4)]
+    primaryspec = str(tmp_path / "primary.geojson")
+    secondaryspec = str(tmp_path / "secondary.geojson")
+    geojson.dump(geojson.FeatureCollection(primary), open(primaryspec, "w"))
+    geojson.dump(geojson.FeatureCollection(secondary), open(secondaryspec, "w"))
+    statedir = str(tmp_path / "state")
+    Conflator().conflateData(primaryspec, secondaryspec, 10.0, incremental=statedir)
+
+    assert hashFeature(secondary[0]) != hashFeature(secondary[1])
+    secondary[2]["properties"]["name"] = "Road 22"
+    geojson.dump(geojson.FeatureCollection(secondary), open(secondaryspec, "w"))
+    cutils = Conflator()
+    with caplog.at_level(logging.DEBUG, logger="osm_merge.conflator"):
+        result = cutils.conflateData(primaryspec, secondaryspec, 10.0, incremental=statedir)
+    assert "Conflating 1 of 4 primary features" in caplog.text
+    expected = Conflator().conflateData(primaryspec, secondaryspec, 10.0)
+
+    assert json.loads(geojson.dumps(result)) == json.loads(geojson.dumps(expected))
+    state = cutils.loadState(statedir, {"threshold": 10.0, "informal": False, "refdistance": 0.0})
+    assert len(state["primary"]) == len(primary)
+    assert len(state["secondary"]) == len(secondary)
+    # Only the chunks of the state with the changed features were written
+    assert "Wrote 1 of 5 secondary chunks" in caplog.text
+
+    # Deleting one of two identical features is still a change
+    secondary.append(copy.deepcopy(secondary[0]))
+    geojson.dump(geojson.FeatureCollection(secondary), open(secondaryspec, "w"))
+    Conflator().conflateData(primaryspec, secondaryspec, 10.0, incremental=statedir)
+    geojson.dump(geojson.FeatureCollection(secondary[:-1]), open(secondaryspec, "w"))
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger="osm_merge.conflator"):
+        Conflator().conflateData(primaryspec, secondaryspec, 10.0, incremental=statedir)
+    assert "Conflating 1 of 4 primary features" in caplog.text
+
+def test_report():
+    """
+    The time of each stage and the counters should be in the report,
+    and the ones from other processes should get added to them.
+    """
+    logging.info("-- Running test_report() --")
+    getReport(True)
+    primary = [make_highway(-108.0, 38.0, {"name": "Road 1", "highway": "track"})]
+    secondary = [make_highway(-108.0, 38.0, {"id": 1, "name": "Road 1", "highway": "track"}, 0.00001),
+                 make_highway(-108.0, 38.0, {"id": 2, "name": "Road 2", "highway": "track"}, 0.01)]
+    conflateThread(primary, secondary, threshold=10.0)
+    report = getReport(True)
+
+    for name in ("projection", "search", "distance", "slope", "tags", "output"):
+        assert report["timers"][name]["calls"] > 0
+    assert report["counters"]["primary features"] == 1
+    assert report["counters"]["candidates examined"] == 1
+    assert getReport()["timers"] == dict()
+
+    mergeReport(report)
+    mergeReport(report)
+    assert getReport()["counters"]["primary features"] == 2
+    assert getReport(True)["timers"]["search"]["calls"] == 2 * report["timers"]["search"]["calls"]
+
+    # The candidate is counted with the hits it ended up with
+    primary = [make_highway(-108.0, 38.0, {"ref:usfs": "FR 1", "name": "Road 1"})]
+    secondary = [make_highway(-108.0, 38.0, {"id": 1, "ref:usfs": "FR 1", "name": "Road 1"}, 0.00002)]
+    conflateThread(primary, secondary, threshold=10.0)
+    assert getReport(True)["counters"]["accepted with 3 hits"] == 1
+
+    # A stage inside another one only adds to the inner one
+    with StageTimer("outer"):
+        time.sleep(0.01)
+        with StageTimer("inner"):
+            time.sleep(0.05)
+    timers = getReport(True)["timers"]
+    assert timers["inner"]["seconds"] >= 0.05
+    assert 0.01 <= timers["outer"]["seconds"] < 0.05
+
+def test_cache(tmp_path):
+    """
+    The cached features should be used until the file changes.
+    """
+    logging.info("-- Running test_cache() --")
+    import os
+    import shutil
+    from pathlib import Path
+    from osm_merge.featurestore import FeatureStore
+    infile = str(tmp_path / "osm.osm")
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data/osm.osm"), infile)
+    cache = str(tmp_path / "cache")
+    data = Conflator().parseFile(infile, cache=cache)
+
+    for store in (True, False):
+        cached = Conflator().parseFile(infile, store, cache=cache)
+        assert type(cached) == FeatureStore
+        assert [entry["properties"] for entry in cached] == [entry["properties"] for entry in data]
+    # A different keys filter isn't in the cache
+    assert Conflator().readCache(infile, cache, ["highway"]) is None
+
+    # Touching the file doesn't change it, and reading the cache
+    # doesn't change the manifest
+    os.utime(infile, (0, 0))
+    manifests = {path: path.read_bytes() for path in Path(cache).glob("*.json")}
+    assert Conflator().readCache(infile, cache) is not None
+    assert {path: path.read_bytes() for path in Path(cache).glob("*.json")} == manifests
+    with open(infile, "a") as file:
+        file.write("\n")
+    assert Conflator().readCache(infile, cache) is None
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import pickle
+from geojson import Feature, LineString, Point, Polygon, MultiLineString
+from shapely.geometry import shape
+from osm_merge.featurestore import FeatureStore
+from osm_merge.conflator import Conflator, conflateThread
+
+features = [Feature(geometry=LineString([(-108.0, 38.0), (-108.1, 38.1), (-108.2, 38.0)]),
+                    properties={"id": 1, "highway": "track", "refs": [10, 11, 12]}),
+            Feature(geometry=Point((-108.5, 38.5)), properties={"id": 2, "amenity": "toilets"}),
+            Feature(geometry=None, properties={"id": 3, "highway": "track"}),
+            Feature(geometry=Polygon([[(-108.0, 38.0), (-108.1, 38.0), (-108.1, 38.1), (-108.0, 38.0)]]),
+                    properties={"id": 4, "building": "yes"}),
+            Feature(geometry=MultiLineString([[(-107.0, 38.0), (-107.1, 38.1)], [(-107.2, 38.2), (-107.3, 38.3)]]),
+                    properties={"id": 5, "highway": "track", "name": None}),
+            ]
+
+def test_store():
+    """
+    The features in the store should be the same as the original ones.
+    """
+    logging.info("-- Running test_store() --")
+    store = FeatureStore.fromFeatures(features)
+
+    assert len(store) == len(features)
+    for entry, feature in zip(store, features):
+        assert entry["properties"] == feature["properties"]
+        if feature["geometry"] is None:
+            assert entry["geometry"] is None
+        else:
+            assert shape(entry["geometry"]).equals(shape(feature["geometry"]))
+    assert store.getTag(0, "highway") == "track"
+    assert store.getTag(1, "highway") is None
+    assert store.getBounds()[0].tolist() == [-108.2, 38.0, -108.0, 38.1]
+
+    # Changing the tags of a feature changes them in the store
+    entry = store[0]
+    entry["properties"]["id"] = -1
+    entry["properties"]["refs"].append(13)
+    assert store[0]["properties"]["refs"] == [10, 11, 12, 13]
+    assert store.getTag(0, "id") == -1
+    del store[1]["properties"]["amenity"]
+    assert "amenity" not in store[1]["properties"]
+    assert store[3]["properties"] == features[3]["properties"]
+    copy = pickle.loads(pickle.dumps(entry))
+    assert type(copy) == Feature
+    assert type(copy["properties"]) == dict
+    assert copy["properties"]["id"] == -1
+
+    # Empty tags can be changed too
+    empty = FeatureStore.fromFeatures(feature for feature in [Feature(geometry=Point((-108.0, 38.0)))])
+    empty[0]["properties"]["name"] = "Bear Creek"
+    assert empty[0]["properties"] == {"name": "Bear Creek"}
+
+def test_conflate():
+    """
+    Conflating with a store should get the same results as a list.
+    """
+    logging.info("-- Running test_conflate() --")
+    primary = [Feature(geometry=LineString([(-108.0 + (i * 0.001), 38.0 + (i * 0.0005)) for i in range(5)]),
+                       properties={"name": "Road 1", "highway": "track"})]
+    secondary = [Feature(geometry=LineString([(-108.0 + (i * 0.001), 38.00003 + (i * 0.0005)) for i in range(5)]),
+                         properties={"id": 1, "name": "Road 1", "highway": "track"})] + features
+    cutils = Conflator()
+    result = conflateThread(FeatureStore.fromFeatures(primary), FeatureStore.fromFeatures(secondary),
+                            threshold=10.0, cutils=cutils)
+    expected = conflateThread(primary, secondary, threshold=10.0)
+
+    assert len(result[0]) > 0
+    assert result == expected
+
+def test_save(tmp_path):
+    """
+    A saved store should load with the same features, and the
+    projected coordinates.
+    """
+    logging.info("-- Running test_save() --")
+    from osm_merge.conflator import getTransformer
+    store = FeatureStore.fromFeatures(features)
+    store.project(getTransformer())
+    store.save(str(tmp_path / "store"))
+    loaded = FeatureStore.load(str(tmp_path / "store"))
+
+    assert len(loaded) == len(store)
+    assert list(loaded) == list(store)
+    assert loaded.getProjected(0).equals(store.getProjected(0))
+    assert loaded.getTag(0, "refs") == [10, 11, 12]
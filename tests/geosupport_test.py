@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import geojson
+import pytest
+import shapely
+from geojson import Feature, FeatureCollection, LineString, MultiLineString, MultiPoint, MultiPolygon, Point, Polygon
+
+# This needs the postgres client, even though these don't use it
+pytest.importorskip("asyncpg")
+from osm_merge.geosupport import makeRecords, groupRecords, readFeatures, tables
+
+square = [[(-108.0, 38.0), (-108.0, 38.1), (-107.9, 38.1), (-108.0, 38.0)]]
+features = [Feature(geometry=Point((-108.0, 38.0)), properties={"id": 1, "name": "O'Brien \"Spring\""}),
+            Feature(geometry=MultiPoint([(-108.0, 38.0), (-108.1, 38.1)]), properties={"id": 2}),
+            Feature(geometry=LineString([(-108.0, 38.0), (-108.1, 38.1)]), properties={"id": 3, "refs": [1, 2]}),
+            Feature(geometry=None, properties={"id": 4}),
+            Feature(geometry=MultiLineString([[(-108.0, 38.0), (-108.1, 38.1)]]), properties={"id": 5}),
+            Feature(geometry=Polygon(square), properties={"id": 6, "name": "Lake"}),
+            Feature(geometry=MultiPolygon([square]), properties={"id": 7, "height": 1.5}),
+            ]
+
+def test_read(tmp_path):
+    """
+    Reading the features one at a time should get the same features
+    as loading the whole file, however it's split into blocks.
+    """
+    logging.info("-- Running test_read() --")
+    filespec = str(tmp_path / "data.geojson")
+    data = FeatureCollection(features, name="test", bbox=[-108.1, 38.0, -107.9, 38.1])
+    with open(filespec, "w") as file:
+        geojson.dump(data, file, indent=2)
+    expected = geojson.load(open(filespec))["features"]
+    for blocksize in (1, 7, 1024 * 1024):
+        assert list(readFeatures(filespec, blocksize)) == expected
+
+    # Newline delimited GeoJson, with the record separators too
+    filespec = str(tmp_path / "data.geojsonl")
+    with open(filespec, "w") as file:
+        for feature in features:
+            file.write(f"\x1e{geojson.dumps(feature)}\n\n")
+    for blocksize in (1, 1024 * 1024):
+        assert list(readFeatures(filespec, blocksize)) == expected
+
+    with open(filespec, "a") as file:
+        file.write('{"type": "Feature", "geometry": null')
+    with pytest.raises(ValueError):
+        list(readFeatures(filespec))
+
+def test_records():
+    """
+    The features should go in the table for their geometry, in batches,
+    with the geometry as EWKB.
+    """
+    logging.info("-- Running test_records() --")
+    batches = list(makeRecords(features, 2))
+
+    # The feature without a geometry doesn't count towards a batch
+    assert [sum(len(rows) for rows in batch.values()) for batch in batches] == [2, 2, 2]
+    records = dict()
+    for batch in batches:
+        for table, rows in batch.items():
+            records.setdefault(table, list()).extend(rows)
+    assert {table: [json.loads(tags)["id"] for geom, tags in rows] for table, rows in records.items()} == \
+        {"nodes": [1, 2], "ways_line": [3, 5], "ways_poly": [6, 7]}
+
+    geoms = {json.loads(tags)["id"]: geom for rows in records.values() for geom, tags in rows}
+    for feature in features:
+        if feature["geometry"] is None:
+            assert feature["properties"]["id"] not in geoms
+            continue
+        geom = shapely.from_wkb(geoms[feature["properties"]["id"]])
+        assert shapely.get_srid(geom) == 4326
+        assert geom.equals(shapely.geometry.shape(feature["geometry"]))
+        assert tables[geom.geom_type] in records
+
+    # The quotes in the values don't need escaping in JSON
+    assert json.loads(records["nodes"][0][1]) == features[0]["properties"]
+    assert groupRecords([], [], []) == dict()
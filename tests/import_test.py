@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import subprocess
+import sys
+import pytest
+
+# The programs that get run many times by the batch scripts
+programs = ["osm_merge.conflator",
+            "osm_merge.utilities.mvum",
+            "osm_merge.utilities.blm",
+            "osm_merge.utilities.local_roads",
+            "osm_merge.utilities.trails",
+            "osm_merge.utilities.nps",
+            "osm_merge.utilities.tm_splitter",
+            "osm_merge.utilities.osmhighways",
+            ]
+
+# These are slow to import, and only some runs need them, so they
+# should only be loaded when they're used.
+deferred = ["cpuinfo", "pandas", "fiona", "osmium", "osgeo", "pyproj"]
+
+# The most time importing a program can take in seconds. Shapely and
+# numpy are most of it.
+budget = 2.0
+
+@pytest.mark.parametrize("program", programs)
+def test_imports(program):
+    """
+    Importing a program should be fast, and not load the slow modules.
+    """
+    logging.info("-- Running test_imports() --")
+    code = f"""
+import sys, types, time
+start = time.perf_counter()
+import {program}
+print(time.perf_counter() - start)
+print(" ".join(name for name, module in sys.modules.items() if type(module) is types.ModuleType))
+"""
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    seconds, modules = result.stdout.strip().split("\n")[-2:]
+    loaded = set(modules.split())
+
+    assert [name for name in deferred if name in loaded] == []
+    assert float(seconds) < budget
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+from array import array
+import numpy
+from osm_merge.nodeindex import NodeIndex
+
+rootdir = os.path.dirname(os.path.abspath(__file__))
+
+def test_build(tmp_path):
+    """
+    The nodes can be in any order, and missing nodes are skipped. A
+    saved index is memory mapped.
+    """
+    logging.info("-- Running test_build() --")
+    ids = array("q", [3, 1, 2])
+    coords = array("i", [-1063000000, 403000000, -1061000000, 401000000, -1062000000, 402000000])
+    index = NodeIndex.build(ids, coords)
+
+    assert len(index) == 3
+    assert 2 in index
+    assert 5 not in index
+    assert index.lookup([1, 2, 5, 3]) == [(-106.1, 40.1), (-106.2, 40.2), (-106.3, 40.3)]
+    assert index.lookup([]) == []
+
+    filespec = str(tmp_path / "nodes")
+    saved = NodeIndex.build(ids, coords, filespec)
+    assert isinstance(saved.ids, numpy.memmap)
+    assert saved.lookup([3, 1]) == [(-106.3, 40.3), (-106.1, 40.1)]
+
+def test_file(tmp_path):
+    """
+    An index made from an OSM file should only be reused for the same
+    file, with the same nodes, until the file changes.
+    """
+    logging.info("-- Running test_file() --")
+    import shutil
+    osmfile = str(tmp_path / "osm.osm")
+    shutil.copy(f"{rootdir}/data/osm.osm", osmfile)
+    filespec = str(tmp_path / "osm")
+    refs = numpy.array([6252940454, 6252940455])
+    index = NodeIndex.fromFile(osmfile, filespec, refs, "test")
+
+    assert len(index) == 2
+    assert index.lookup([6252940455]) == [(-106.8926887, 40.910638)]
+    assert NodeIndex.isCurrent(filespec, osmfile, "test")
+    assert NodeIndex.isCurrent(filespec, osmfile, "test", refs)
+
+    # Different nodes, or a different filter, make a new index
+    assert not NodeIndex.isCurrent(filespec, osmfile, "test", refs[:1])
+    assert not NodeIndex.isCurrent(filespec, osmfile, "other")
+    assert len(NodeIndex.fromFile(osmfile, filespec, refs[:1], "test")) == 1
+    assert len(NodeIndex.fromFile(osmfile, filespec)) > 1000
+    assert NodeIndex.isCurrent(filespec, osmfile)
+
+    # So does a different file with the same name
+    other = tmp_path / "other"
+    other.mkdir()
+    shutil.copy(osmfile, other / "osm.osm")
+    assert not NodeIndex.isCurrent(filespec, str(other / "osm.osm"))
+
+    # Or the same file once it changes
+    os.utime(osmfile, (0, 0))
+    assert not NodeIndex.isCurrent(filespec, osmfile)
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+from osm_merge.osmfile import OsmFile
+
+rootdir = os.path.dirname(os.path.abspath(__file__))
+
+def test_load():
+    """
+    Only the tagged nodes and the ways should be loaded.
+    """
+    logging.info("-- Running test_load() --")
+    osm = OsmFile()
+    data = osm.loadFile(f"{rootdir}/data/osm.osm")
+    nodes = [entry for entry in data if entry["geometry"]["type"] == "Point"]
+    ways = [entry for entry in data if entry["geometry"]["type"] == "LineString"]
+
+    assert len(ways) == 87
+    assert len(nodes) == 6
+    assert len(nodes[0]["properties"]) > 3
+    assert ways[0]["properties"]["refs"][:2] == [6252940455, 6252940454]
+    assert list(ways[0]["geometry"]["coordinates"][0]) == [-106.892689, 40.910638]
+
+def test_unsorted(tmp_path):
+    """
+    The way's own version should be used, and the nodes don't have
+    to be sorted. Missing nodes are skipped.
+    """
+    logging.info("-- Running test_unsorted() --")
+    filespec = str(tmp_path / "test.osm")
+    with open(filespec, "w") as file:
+        file.write("""<?xml version='1.0' encoding='UTF-8'?>
+<osm version='0.6'>
+  <node id='3' version='7' lat='40.3' lon='-106.3' />
+  <node id='1' version='7' lat='40.1' lon='-106.1'>
+    <tag k='natural' v='peak' />
+  </node>
+  <node id='2' lat='40.2' lon='-106.2' />
+  <way id='10' version='4'>
+    <nd ref='1' />
+    <nd ref='2' />
+    <nd ref='5' />
+    <nd ref='3' />
+    <tag k='highway' v=' track ' />
+  </way>
+  <relation id='20' version='1'>
+    <member type='way' ref='10' role='' />
+  </relation>
+</osm>
+""")
+    data = OsmFile().loadFile(filespec)
+
+    assert len(data) == 2
+    assert data[0]["properties"] == {"id": 1, "version": "7", "natural": "peak"}
+    assert data[1]["properties"] == {"id": 10, "refs": [1, 2, 5, 3], "version": "4", "highway": "track"}
+    assert [list(coords) for coords in data[1]["geometry"]["coordinates"]] == [[-106.1, 40.1], [-106.2, 40.2], [-106.3, 40.3]]
+
+def test_pbf(tmp_path):
+    """
+    A PBF file should load the same as the OSM XML file it came from,
+    and the tag filter should work for both.
+    """
+    logging.info("-- Running test_pbf() --")
+    import osmium
+    filespec = str(tmp_path / "osm.osm.pbf")
+    writer = osmium.SimpleWriter(filespec)
+    for obj in osmium.FileProcessor(f"{rootdir}/data/osm.osm"):
+        writer.add(obj)
+    writer.close()
+
+    xml = OsmFile().loadFile(f"{rootdir}/data/osm.osm")
+    pbf = OsmFile().loadFile(filespec)
+    assert pbf == xml
+
+    xml = OsmFile().loadFile(f"{rootdir}/data/osm.osm", ["highway"])
+    pbf = OsmFile().loadFile(filespec, ["highway"])
+    assert len(pbf) == 79
+    assert pbf == xml
+    assert all("highway" in entry["properties"] for entry in pbf)
+
+def test_write(tmp_path):
+    """
+    The features can come from a generator, and every element should
+    have the same timestamp.
+    """
+    logging.info("-- Running test_write() --")
+    from xml.etree import ElementTree
+    from geojson import Feature, Point
+
+    def features():
+        yield Feature(geometry=Point((-106.1, 40.1)),
+                      properties={"id": 1, "version": "2", "name": "O'Brien & Sons"})
+        # A way from OSM that has no geometry
+        yield Feature(geometry=None,
+                      properties={"id": 10, "version": 4, "refs": [1, 2], "lat": 0, "lon": 0, "highway": "track"})
+
+    filespec = str(tmp_path / "out.osm")
+    OsmFile().writeOSM(features(), filespec)
+    root = ElementTree.parse(filespec).getroot()
+    node = root.find("node")
+    way = root.find("way")
+
+    assert {tag.get("k"): tag.get("v") for tag in node.iter("tag")} == {"name": "O'Brien & Sons"}
+    assert [nd.get("ref") for nd in way.iter("nd")] == ["1", "2"]
+    assert node.get("timestamp") == way.get("timestamp")
+
+def test_parallel(tmp_path, monkeypatch):
+    """
+    Converting the features in blocks in other processes should
+    write exactly the same file, with the same IDs for new features,
+    and neither way should change the features.
+    """
+    logging.info("-- Running test_parallel() --")
+    import copy
+    import osm_merge.osmfile
+
+    data = OsmFile().loadFile(f"{rootdir}/data/osm.osm")[:10]
+    for entry in data:
+        del entry["properties"]["id"]
+    expected = copy.deepcopy(data)
+    monkeypatch.setattr(osm_merge.osmfile, "chunksize", 3)
+    output = list()
+    for workers in (1, 2):
+        osm = OsmFile()
+        osm.timestamp = "2025-01-01T00:00:00Z"
+        filespec = str(tmp_path / f"out-{workers}.osm")
+        osm.writeOSM(data, filespec, workers)
+        output.append(open(filespec, "rb").read())
+        assert osm.osmid == -11
+        assert data == expected
+
+    assert output[0] == output[1]
+    assert b"id='-10'" in output[1]
+
+def test_index():
+    """
+    Features can be found by their OSM ID, or by their location.
+    """
+    logging.info("-- Running test_index() --")
+    osm = OsmFile()
+    data = osm.loadFile(f"{rootdir}/data/osm.osm")
+    way = [entry for entry in data if entry["geometry"]["type"] == "LineString"][3]
+    node = [entry for entry in data if entry["geometry"]["type"] == "Point"][0]
+
+    assert osm.getFeature(way["properties"]["id"]) is way
+    assert osm.getFeature(str(node["properties"]["id"]), "node") is node
+    assert osm.getFeature(node["properties"]["id"], "way") is None
+    assert osm.getFeature(1) is None
+
+    fields = osm.getFields()
+    assert fields["highway"] == len([entry for entry in data if "highway" in entry["properties"]])
+    assert "refs" not in fields and "version" not in fields
+
+    lon, lat = way["geometry"]["coordinates"][1]
+    assert osm.getNearest(lon, lat) is way
+    assert osm.getNearest(0.0, 0.0, 1.0) is None
+    hits = osm.queryBounds((lon - 0.0001, lat - 0.0001, lon + 0.0001, lat + 0.0001))
+    assert way in hits
+    assert hits == [entry for entry in data if entry in hits]
+
+    # The indexes are updated when more data is loaded
+    count = len(data)
+    osm.loadFile(f"{rootdir}/data/osm.osm")
+    assert len(osm.data) == count * 2
+    assert osm.getFields()["highway"] == fields["highway"] * 2
+    assert osm.getFeature(way["properties"]["id"]) in osm.data[count:]
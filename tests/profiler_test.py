@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import sys
+import subprocess
+import cProfile
+import pstats
+import multiprocessing
+import concurrent.futures
+from pathlib import Path
+import osm_merge.profiler as profiler
+from osm_merge.profiler import startProfile, finishProfile, collapseStats, envvar
+
+def inner(count):
+    return sum(i * i for i in range(count))
+
+def outer(count):
+    return inner(count) + inner(count)
+
+def test_collapse():
+    """
+    The collapsed stacks should have all the time in the profile.
+    """
+    logging.info("-- Running test_collapse() --")
+    profile = cProfile.Profile()
+    profile.enable()
+    outer(100000)
+    profile.disable()
+    stats = pstats.Stats(profile)
+    stacks = collapseStats(stats)
+
+    assert abs(sum(stacks.values()) - stats.total_tt) < 0.000001
+    assert len([stack for stack in stacks if "(outer);" in stack and "(inner)" in stack]) > 0
+
+def test_workers(tmp_path):
+    """
+    Each worker process should write it's own stats, whether it's
+    forked or not, and they should all be merged when the profile is
+    finished. Other programs it runs shouldn't be profiled.
+    """
+    logging.info("-- Running test_workers() --")
+    startProfile(str(tmp_path))
+    prefix = profiler.profiler.prefix
+    assert envvar not in os.environ
+    for method in ("fork", "spawn"):
+        context = multiprocessing.get_context(method)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2, mp_context=context) as executor:
+            assert list(executor.map(outer, [10000, 20000, 30000])) == [outer(10000), outer(20000), outer(30000)]
+    code = f"import os; print(os.getenv('{envvar}'))"
+    assert subprocess.run([sys.executable, "-c", code], capture_output=True, text=True).stdout.strip() == "None"
+    finishProfile()
+
+    files = list(Path(tmp_path).glob(f"{Path(prefix).name}-*.pstats"))
+    assert len(files) == 5
+    stacks = open(f"{prefix}.folded").read()
+    assert "_process_worker" in stacks and "(outer)" in stacks
+    assert profiler.profiler is None
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2025 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+from geojson import Feature, LineString
+from osm_merge.sinks import GeoJsonSink, GeoJsonSeqSink, openSink
+
+features = [Feature(geometry=LineString([(-108.0, 38.0 + i), (-108.1, 38.1 + i)]),
+                    properties={"id": i, "name": f"Road {i}"}) for i in range(3)]
+
+def test_geojson(tmp_path):
+    """
+    A GeoJson sink should write a valid FeatureCollection.
+    """
+    logging.info("-- Running test_geojson() --")
+    filespec = str(tmp_path / "out.geojson")
+    with GeoJsonSink(filespec) as sink:
+        for feature in features:
+            sink.write(feature)
+    data = json.load(open(filespec))
+
+    assert data["type"] == "FeatureCollection"
+    assert [entry["properties"] for entry in data["features"]] == [entry["properties"] for entry in features]
+
+    # An empty one is still valid
+    filespec = str(tmp_path / "empty.geojson")
+    with openSink(filespec) as sink:
+        pass
+    assert json.load(open(filespec))["features"] == []
+
+def test_geojsonseq(tmp_path):
+    """
+    A GeoJsonSeq sink should write one feature per line.
+    """
+    logging.info("-- Running test_geojsonseq() --")
+    filespec = str(tmp_path / "out.geojsonl")
+    sink = openSink(filespec)
+    assert type(sink) == GeoJsonSeqSink
+    for feature in features:
+        sink.write(feature)
+    sink.close()
+    sink.close()
+    lines = open(filespec).readlines()
+
+    assert len(lines) == len(features)
+    assert [json.loads(line)["properties"] for line in lines] == [entry["properties"] for entry in features]
+
+def test_pbf(tmp_path):
+    """
+    A PBF sink should write the ways with the nodes from their geometry.
+    """
+    logging.info("-- Running test_pbf() --")
+    from osm_merge.osmfile import OsmFile
+    filespec = str(tmp_path / "out.osm.pbf")
+    ways = [Feature(geometry=LineString([(-108.0, 38.0), (-108.1, 38.1)]),
+                    properties={"id": 10, "version": 3, "refs": [1, 2], "highway": "track"}),
+            Feature(geometry=LineString([(-108.1, 38.1), (-108.2, 38.2)]),
+                    properties={"id": 11, "version": 1, "refs": [2, 3], "highway": "path"})]
+    with openSink(filespec) as sink:
+        for feature in ways:
+            sink.write(feature)
+        # New features aren't in OSM, so they're skipped
+        sink.write(features[0])
+    assert sink.count == 2
+
+    data = OsmFile().loadFile(filespec)
+    assert [entry["properties"] for entry in data] == [{"id": 10, "refs": [1, 2], "version": "3", "highway": "track"},
+                                                        {"id": 11, "refs": [2, 3], "version": "1", "highway": "path"}]
+    assert [list(coords) for coords in data[1]["geometry"]["coordinates"]] == [[-108.1, 38.1], [-108.2, 38.2]]
+
+def test_osc(tmp_path):
+    """
+    An osmChange sink should only have the ways with changed tags, and
+    keep the other tags from OSM.
+    """
+    logging.info("-- Running test_osc() --")
+    import os
+    from xml.etree import ElementTree
+    from osm_merge.osmfile import OsmFile
+    original = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "osm.osm")
+    data = [entry for entry in OsmFile().loadFile(original) if entry["geometry"]["type"] == "LineString"]
+    changed = data[0]
+    changed["properties"]["surface"] = "gravel"
+    changed["properties"]["debug"] = "hits: 3"
+    unchanged = data[1]
+
+    filespec = str(tmp_path / "out.osc")
+    with openSink(filespec, original) as sink:
+        sink.write(changed)
+        sink.write(unchanged)
+        # New features aren't in OSM, so they're skipped
+        sink.write(features[0])
+    assert sink.count == 1
+
+    root = ElementTree.parse(filespec).getroot()
+    assert root.tag == "osmChange"
+    ways = root.findall("modify/way")
+    assert len(ways) == 1
+    assert ways[0].get("id") == str(changed["properties"]["id"])
+    assert ways[0].get("version") == changed["properties"]["version"]
+    assert [int(nd.get("ref")) for nd in ways[0].iter("nd")] == changed["properties"]["refs"]
+    tags = {tag.get("k"): tag.get("v") for tag in ways[0].iter("tag")}
+    assert tags["surface"] == "gravel"
+    assert tags["highway"] == changed["properties"]["highway"]
+    assert "debug" not in tags
+
+def test_attributes(tmp_path):
+    """
+    All the OSM formats should write the same tags for a feature, without
+    the OSM attributes.
+    """
+    logging.info("-- Running test_attributes() --")
+    import os
+    from xml.etree import ElementTree
+    from osm_merge.osmfile import OsmFile, attributes
+    original = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "osm.osm")
+    data = [entry for entry in OsmFile().loadFile(original) if entry["geometry"]["type"] == "LineString"]
+    way = data[0]
+    way["properties"].update({"timestamp": "2025-01-01T00:00:00Z", "uid": 1, "user": "someone",
+                              "changeset": 2, "lat": 0, "lon": 0, "surface": "gravel"})
+    expected = {key: str(value) for key, value in way["properties"].items() if key not in attributes}
+
+    for suffix in ("osm", "osm.pbf", "osc"):
+        with openSink(str(tmp_path / f"out.{suffix}"), original) as sink:
+            if suffix == "osm":
+                # OSM XML only has the refs for a way from OSM
+                sink.write(Feature(geometry=None, properties=way["properties"]))
+            else:
+                sink.write(way)
+        if suffix == "osm.pbf":
+            props = OsmFile().loadFile(sink.filespec)[0]["properties"]
+            tags = {key: value for key, value in props.items() if key not in ("id", "refs", "version")}
+        else:
+            element = ElementTree.parse(sink.filespec).getroot().find(".//way")
+            tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag") if tag.get("k") != "note"}
+        assert tags == expected, suffix
+
+def test_writeall(tmp_path, monkeypatch):
+    """
+    Writing all the features in blocks in other processes should
+    make the same file as writing them one at a time.
+    """
+    logging.info("-- Running test_writeall() --")
+    import osm_merge.osmfile
+    monkeypatch.setattr(osm_merge.osmfile, "chunksize", 2)
+    for suffix in ("geojson", "geojsonl"):
+        output = list()
+        with openSink(str(tmp_path / f"one.{suffix}")) as sink:
+            for feature in features:
+                sink.write(feature)
+        output.append(open(sink.filespec, "rb").read())
+        with openSink(str(tmp_path / f"all.{suffix}")) as sink:
+            sink.writeAll(features[:1], 2)
+            sink.writeAll(features[1:], 2)
+        assert sink.count == len(features)
+        output.append(open(sink.filespec, "rb").read())
+
+        assert output[0] == output[1]
+
+def test_writeosm(tmp_path, monkeypatch):
+    """
+    Writing all the features to OSM XML in blocks in other processes
+    should make the same file as writing them one at a time, with the
+    same negative IDs for the new features.
+    """
+    logging.info("-- Running test_writeosm() --")
+    import osm_merge.osmfile
+    from geojson import Point
+    monkeypatch.setattr(osm_merge.osmfile, "chunksize", 2)
+    data = [Feature(geometry=Point((-108.0, 38.0 + i)), properties={"name": f"Spring {i}"}) for i in range(3)]
+    # A way that isn't in OSM is skipped, but still uses up an ID
+    data.append(Feature(geometry=None, properties={"name": "New Road"}))
+    data.append(Feature(geometry=None, properties={"id": 10, "version": 1, "refs": [1, 2], "highway": "track"}))
+    data.append(Feature(geometry=Point((-108.0, 39.0)), properties={"id": 11, "version": 2, "name": "Lake"}))
+    data.append(Feature(geometry=Point((-108.0, 40.0)), properties={"name": "Spring 4"}))
+
+    output = list()
+    with openSink(str(tmp_path / "one.osm")) as sink:
+        sink.osm.timestamp = "2025-01-01T00:00:00Z"
+        for feature in data:
+            sink.write(feature)
+    output.append(open(sink.filespec, "rb").read())
+    assert sink.osm.osmid == -8
+    with openSink(str(tmp_path / "all.osm")) as sink:
+        sink.osm.timestamp = "2025-01-01T00:00:00Z"
+        sink.writeAll(data[:3], 2)
+        sink.writeAll(data[3:], 2)
+    output.append(open(sink.filespec, "rb").read())
+    assert sink.osm.osmid == -8
+
+    assert output[0] == output[1]
+    assert b"id='-7'" in output[0]